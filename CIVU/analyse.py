@@ -7,12 +7,10 @@ Created by Simos Kalfas
 """
 
 import utils
+import instrument
 import time
 import numpy as np
-from operator import add
-from matplotlib import pyplot as plt
-import itertools
-import seaborn as sns
+import json
 
 
 def weighted_average(forward, reverse):
@@ -43,7 +41,7 @@ def weighted_average(forward, reverse):
         weighted_av = np.average(weighted_av, axis=0)
     else:
         weighted_av = np.average(weighted_av, axis=0, weights=weights)
-    print weighted_av
+    instrument.log(weighted_av)
     return weighted_av
 
 
@@ -62,8 +60,9 @@ def list_of_gaus(arrival_time, intensities, fitted_parameters_f,
         norm_factor: Scale factor for unnormalised data
 
 Returns:
-        gausslist: List of gaussian distributions for each fitting method 
-                [[average], [forward], [reverse]]
+        gausslist: Arrays of gaussian distributions for each fitting method 
+                [[average], [forward], [reverse]], one row per peak followed by
+                the fit and the ATD curve
         min_error: Minimum error between fitting methods
         errorlist: List of error values 
                 [forward, reverse, average]
@@ -71,32 +70,14 @@ Returns:
     average = weighted_average(fitted_parameters_f, fitted_parameters_r, ) 
     average = list(average)
     average = [list(i) for i in average]
-    gausslist = [[], [], []] #[[average], [forward], [reverse]]
-    for i in range(len(fitted_parameters_r)):
-        gausslist[2].append(utils.gaussian(arrival_time, 
-                *fitted_parameters_r[i]))
-        gausslist[1].append(utils.gaussian(arrival_time, 
-                *fitted_parameters_f[i]))
-    for i in range(len(average)):
-        gausslist[0].append(utils.gaussian(arrival_time, *average[i]))
-    #Get sum of fitted peaks to compare to ATD curve
-    fit_av = list(np.zeros((len(intensities))))
-    fit_f = list(np.zeros((len(intensities))))
-    fit_r = list(np.zeros((len(intensities))))
-    for i in gausslist[0]:
-        fit_av = map(add, fit_av, i)
-    for i in gausslist[1]:
-        fit_f = map(add, fit_f, i)
-    for i in gausslist[2]:
-        fit_r = map(add, fit_r, i)
-    #The last element of each list in gausslist is the ATD curve and the second 
-    #last the fit produced from the respective method
-    gausslist[2].append(fit_r)
-    gausslist[1].append(fit_f)
-    gausslist[0].append(fit_av)
-    gausslist[2].append(intensities)
-    gausslist[1].append(intensities)
-    gausslist[0].append(intensities)
+    #Each entry holds one row per peak, followed by the fit produced from the
+    #respective method and the ATD curve itself
+    gausslist = [] #[[average], [forward], [reverse]]
+    for parameters in [average, fitted_parameters_f, fitted_parameters_r]:
+        curves = utils.gaussians(arrival_time, parameters)
+        gausslist.append(np.vstack([curves, curves.sum(axis=0), intensities]))
+    fit_f = gausslist[1][-2]
+    fit_r = gausslist[2][-2]
     #Calculate errors normalising with scaling factor
     error_f = utils.rmsd(fit_f, intensities) * norm_factor
     error_r = utils.rmsd(fit_r, intensities) * norm_factor
@@ -108,8 +89,82 @@ Returns:
     return parlist[erind], gausslist, min_error, errorlist
 
 
+def result_record(filename, fit, arrival_time):
+    """Makes a machine-readable record of the fit of one ATD.
+
+    Args:
+        filename: File name of data file without file extension
+        fit: Results of deconvolute.fit_voltage
+        arrival_time: Arrival time series
+
+    Returns:
+        record: Dictionary of plain numbers and strings
+            {'file', 'voltage', 'means', 'mean_times', 'peaks', 'errors', 
+            'min_error', 'best', 'areas', 'fwhms', 'time', 'iterations', 
+            'start'}
+            means are indices and mean_times their arrival times, peaks a 
+            list of {'height', 'mean', 'sd'} (numerical mean), errors a 
+            dictionary of the 'average', 'forward' and 'reverse' errors and 
+            best the fitting method of min_error. Ensemble fits also have 
+            'ensemble', see deconvolute.ensemble_fits.
+    """
+    methods = ['average', 'forward', 'reverse'] #Order of list_of_gaus errors
+    record = {'file': filename, 
+            'voltage': fit['voltage'], 
+            'means': [int(i) for i in fit['means']],
+            'mean_times': [float(arrival_time[i]) for i in fit['means']],
+            'peaks': [{'height': float(p[0]), 'mean': float(p[1]), 
+                'sd': float(p[2])} for p in fit['parameters']],
+            'errors': dict((methods[i], float(fit['errors'][i])) for i in 
+                range(len(methods))),
+            'min_error': float(fit['min_error']),
+            'best': methods[fit['erind']],
+            'areas': [float(i) for i in fit['areas']],
+            'fwhms': [float(i) for i in fit['fwhms']],
+            'time': float(fit['time']),
+            'iterations': int(fit['iterations']),
+            'start': fit['start']}
+    if 'ensemble' in fit:
+        ensemble = fit['ensemble']
+        record['ensemble'] = {'size': int(ensemble['size']), 
+                'best': int(ensemble['best']), 
+                'errors': [float(i) for i in ensemble['errors']], 
+                'error_spread': float(ensemble['error_spread']), 
+                'area_spread': [float(i) for i in ensemble['area_spread']]}
+    return record
+
+
+def write_result(f, filename, fit, arrival_time):
+    """Appends the record of a fit to a JSON lines results file.
+
+    Args:
+        f: Results file already open when this function is called
+        filename: File name of data file without file extension
+        fit: Results of deconvolute.fit_voltage
+        arrival_time: Arrival time series
+
+    Returns:
+        Nothing
+    """
+    f.write(json.dumps(result_record(filename, fit, arrival_time), 
+            sort_keys=True) + '\n')
+
+
+def read_results(path):
+    """Reads a JSON lines results file written by write_result.
+
+    Args:
+        path: Path of the results file
+
+    Returns:
+        List of records in file order, see result_record
+    """
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
 def results(f, av_error, areas, fwhms, datadic, results_dir, filename, 
-        res_filename, title, xticks):
+        res_filename, title, xticks, formats=utils.PLOT_FORMATS):
     """Produces plots for presentation of the results.
 
     Args:
@@ -117,32 +172,24 @@ def results(f, av_error, areas, fwhms, datadic, results_dir, filename,
         av_error: Global average error
         areas: Data for area under the curve plot
         fwhms: Data for FWHM plot
-        datadic: Dictionary of parsed data
+        datadic: Dictionary of parsed data or its column labels, only the 
+            labels are used
         results_dir: Results directory name
         filename: File name of data file without file extension
         res_dilename: Identifier for result file names
+        formats(optional): Image formats of the area plot, see 
+            plots.save_figure. No plot is made if empty.
 
         Returns:
             Nothing
     """
     av_error = np.average(av_error)
     f.write(str(av_error)) #Write average error to error log
-    if all([True if len(i) == len(areas[0]) else False for i in areas]):
-        fig2 = plt.figure() #Make area under the curve figure
-        ax2 = fig2.add_subplot(1, 1, 1)
-        areas = np.array(areas)
-        areas = np.transpose(areas)
-        colours = itertools.cycle(sns.color_palette('husl', len(areas)))
-        for i in range(len(areas)):
-            ax2.plot(np.sort([int(sorted(datadic)[j][:-1]) for j in range(
-                    len(areas[i]))]), areas[i], color=colours.next(), label=i+1)
-        ax2.legend()
-        ax2.set_xlabel('Activation energy (V)')
-        ax2.set_ylabel('Percentage area under the curve')
-        ax2.set_xticks(xticks)
-        fig2.suptitle(title + ' population tracking')
-        fig2.savefig(results_dir + filename + res_filename + '_areas.png')
-        fig2.savefig(results_dir + filename + res_filename + '_areas.svg')
+    if formats and all([True if len(i) == len(areas[0]) else False for i in 
+            areas]):
+        import plots #Only loaded when plotting
+        plots.area_tracking_plot(areas, datadic, results_dir, filename, 
+                res_filename, title, xticks, formats)
         return
     else:
         return
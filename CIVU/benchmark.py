@@ -0,0 +1,416 @@
+"""Benchmarks of the fitting pipeline on synthetic and demo CIU datasets.
+
+Synthetic heatmaps are mixtures of Gaussian peaks with known parameters. The
+peaks keep their means (conformations) while their heights shift from the
+first to the last population as the voltage rises, as in an unfolding
+experiment. Each stage of the pipeline (parse, smooth, find_means, fit,
+list_of_gaus, plot) is timed, and the fits of the synthetic datasets are
+compared with the ground truth. The demo data files are run as the real data
+baseline, where only the timings and fit errors can be reported.
+
+The results are printed and written to benchmark<label>.tsv one level above
+the script. With --startup, the cold start time of the fitting (headless) and
+plotting imports is measured as well and written to
+benchmark<label>_startup.tsv.
+
+
+Created by Simos Kalfas
+    email:simos.kalfas@gmail.com
+    github: https://github.com/simoskalfas/
+"""
+
+import deconvolute
+import instrument
+import parse
+import smoother
+import utils
+import analyse
+import optimisation
+import numpy as np
+import argparse
+import glob
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+#Stages of the pipeline timed for every ATD, in pipeline order
+STAGES = ['parse', 'smooth', 'find_means', 'fit', 'list_of_gaus', 'plot']
+
+#Imports timed by startup_times: the bare interpreter, the headless fitting 
+#path and the fitting path with plotting
+STARTUP = [('interpreter', 'pass'), ('fitting', 'import deconvolute'), 
+        ('plotting', 'import deconvolute, plots')]
+
+
+def synthetic_heatmap(bins, peaks, voltages, noise=0.01, seed=0):
+    """Makes a CIU-like heatmap of Gaussian mixtures with known parameters.
+
+    The means are spread evenly over the arrival time range and do not change
+    with voltage. The population moves from the first peak to the last one
+    over the voltages, so the heights change while the means stay fixed.
+
+    Args:
+        bins: Number of drift (arrival time) bins
+        peaks: Number of peaks in each ATD
+        voltages: Number of ATDs
+        noise(optional): Standard deviation of the added noise, as a fraction
+            of the highest intensity
+        seed(optional): Seed of the random noise
+
+    Returns:
+        labels: Column labels ['synthetic', voltage1, ...]
+        arrival_time: Arrival time series as an array
+        matrix: Intensities as an array of shape [voltages, bins]
+        truth: Parameters of the peaks of each ATD
+            [[[height1, mean1, sd1], ...], ...]
+    """
+    random = np.random.RandomState(seed)
+    arrival_time = np.linspace(60, 110, bins)
+    spacing = (arrival_time[-1] - arrival_time[0]) / (peaks + 1)
+    means = arrival_time[0] + spacing * np.arange(1, peaks + 1)
+    sds = np.linspace(spacing / 5, spacing / 3, peaks)
+    #Position of the unfolding transition, from the first peak to the last
+    progress = np.linspace(0, peaks - 1, voltages)
+    matrix = np.zeros((voltages, bins))
+    truth = []
+    for i in range(voltages):
+        heights = 100 * np.exp(-(np.arange(peaks) - progress[i]) ** 2) + 5
+        parameters = np.column_stack([heights, means, sds])
+        curve = utils.mixture(arrival_time, parameters)
+        curve += random.normal(0, noise * curve.max(), bins)
+        matrix[i] = np.maximum(curve, 0)
+        truth.append(parameters.tolist())
+    labels = ['synthetic'] + [str(i * 10) + 'V' for i in range(voltages)]
+    return labels, arrival_time, matrix, truth
+
+
+def write_dataset(path, labels, arrival_time, matrix):
+    """Writes a heatmap as a tab separated data file, as parse expects.
+
+    Args:
+        path: Path of the data file
+        labels: Column labels [name, voltage1, ...]
+        arrival_time: Arrival time series
+        matrix: Intensities of shape [voltages, bins]
+
+    Returns:
+        Nothing
+    """
+    with open(path, 'w') as f:
+        f.write('\t'.join(labels) + '\n')
+        for i in range(len(arrival_time)):
+            f.write('\t'.join([repr(arrival_time[i])] +
+                    [repr(v) for v in matrix[:, i]]) + '\n')
+
+
+def timed(times, stage, function, *args):
+    """Calls a function and adds its wall time to the times of a stage.
+
+    Args:
+        times: Dictionary of total time per stage
+        stage: Stage name, see STAGES
+        function: Function to call
+        *args: Arguments of the function
+
+    Returns:
+        Result of the function
+    """
+    start_time = time.time()
+    result = function(*args)
+    times[stage] = times.get(stage, 0) + time.time() - start_time
+    return result
+
+
+def recovery(arrival_time, fit, parameters, truth):
+    """Compares a fit with the ground truth of a synthetic ATD.
+
+    Every true peak is matched with the fitted peak nearest to its mean.
+
+    Args:
+        arrival_time: Arrival time series
+        fit: Sum of the fitted peaks
+        parameters: Fitted parameters [[height1, mean1, sd1], ...]
+        truth: True parameters [[height1, mean1, sd1], ...]
+
+    Returns:
+        accuracy: Dictionary of errors
+            {'curve': RMSD to the noiseless curve as % of its maximum,
+             'height': mean relative height error,
+             'sd': mean relative sd error,
+             'area': mean absolute error of the % area of each population}
+    """
+    truth = np.asarray(truth, dtype=float)
+    parameters = np.asarray(parameters, dtype=float).reshape(-1, 3)
+    true_curve = utils.mixture(arrival_time, truth)
+    matched = np.array([parameters[np.argmin(abs(parameters[:, 1] - p[1]))]
+            for p in truth])
+    true_areas = truth[:, 0] * truth[:, 2]
+    fitted_areas = matched[:, 0] * matched[:, 2] #Area is proportional to h*sd
+    return {'curve': utils.rmsd(fit, true_curve) * 100 / true_curve.max(),
+            'height': np.mean(abs(matched[:, 0] - truth[:, 0]) / truth[:, 0]),
+            'sd': np.mean(abs(matched[:, 2] - truth[:, 2]) / truth[:, 2]),
+            'area': np.mean(abs(fitted_areas / fitted_areas.sum() -
+                true_areas / true_areas.sum())) * 100}
+
+
+def benchmark_dataset(name, path, settings, truth=None):
+    """Runs the pipeline stage by stage over every ATD of a data file.
+
+    Follows the cold start of deconvolute.fit_voltage, or with the 'batched'
+    backend deconvolute.batched_fits, where all ATDs are fitted at once.
+
+    Args:
+        name: Dataset name
+        path: Path of the data file
+        settings: Dictionary of fit settings
+            {'smooth', 'means', 'cycles', 'backend', 'search', 'support', 
+            'plots', 'label'}
+            means is a mean mode of deconvolute.deconvolve, or 'truth' for
+            the indices of the true means (synthetic data only)
+        truth(optional): True parameters of each ATD, see synthetic_heatmap
+
+    Returns:
+        row: Dictionary of results
+            {'name', 'bins', 'voltages', 'times', 'total', 'error',
+            'accuracy'}
+            times has the total time of every stage and accuracy the averages
+            of recovery over the ATDs, or None without truth.
+    """
+    times = {}
+    labels, arrival_time, matrix = timed(times, 'parse', parse.read_matrix,
+            path, name)
+    arrival_time = arrival_time.tolist()
+    errors = []
+    accuracy = []
+    atds = []
+    for i in range(len(matrix)):
+        intensities = list(timed(times, 'smooth', smoother.smooth,
+                matrix[i].tolist(), settings['smooth']))
+        mode = settings['means']
+        if mode == 'truth':
+            mode = [int(np.argmin(abs(np.array(arrival_time) - p[1]))) for p
+                    in truth[i]]
+        means = timed(times, 'find_means', deconvolute.determine_means,
+                intensities, arrival_time, {'mean_mode': mode,
+                'criterion': 'bic'})
+        atds.append((intensities, means))
+    initial_sds = [[0.01 for _ in means] for _, means in atds]
+    initial_heights = [[intensities[j] for j in means] for intensities, means
+            in atds]
+    if settings['backend'] == 'batched': #All ATDs are fitted together
+        fits = timed(times, 'fit', optimisation.batch_fit, 
+                settings['cycles'], arrival_time, [a[0] for a in atds], 
+                initial_sds, initial_heights, [a[1] for a in atds])
+    else:
+        fits = [timed(times, 'fit', optimisation.fit_atd,
+                settings['backend'], settings['cycles'], arrival_time,
+                atds[i][0], initial_sds[i], initial_heights[i], atds[i][1], 
+                0, None, settings['search'], settings['support']) for i in 
+                range(len(atds))]
+    for i in range(len(atds)):
+        intensities = atds[i][0]
+        norm_factor = 100 / max(intensities)
+        fitted = fits[i]
+        parameters, gausslist, min_error, error = timed(times, 'list_of_gaus',
+                analyse.list_of_gaus, arrival_time, intensities, fitted[0],
+                fitted[2], norm_factor)
+        erind = error.index(min_error)
+        errors.append(min_error)
+        if settings['plots']:
+            import plots #Only loaded when plotting
+            timed(times, 'plot', plots.plot_things, arrival_time,
+                    [gausslist[erind]], name, labels[i + 1],
+                    '_benchmark' + settings['label'], name, True, ['png'])
+        if truth is not None:
+            accuracy.append(recovery(np.array(arrival_time),
+                    gausslist[erind][-2], parameters, truth[i]))
+    if accuracy:
+        accuracy = dict((k, np.mean([a[k] for a in accuracy])) for k in
+                accuracy[0])
+    else:
+        accuracy = None
+    return {'name': name, 'bins': len(arrival_time), 'voltages': len(matrix),
+            'times': times, 'total': sum(times.values()),
+            'error': np.mean(errors), 'accuracy': accuracy}
+
+
+def run(sizes, settings, demo=True, seed=0):
+    """Benchmarks synthetic datasets of the given sizes and the demo data.
+
+    Args:
+        sizes: List of (bins, peaks, voltages) of the synthetic datasets
+        settings: Dictionary of fit settings, see benchmark_dataset
+        demo(optional): If True the demo data files are benchmarked as well,
+            with the mode of settings['means_demo']
+        seed(optional): Seed of the synthetic noise
+
+    Returns:
+        rows: List of results, see benchmark_dataset
+    """
+    rows = []
+    folder = tempfile.mkdtemp()
+    try:
+        for bins, peaks, voltages in sizes:
+            name = 'synthetic_%d_%d_%d' % (bins, peaks, voltages)
+            labels, arrival_time, matrix, truth = synthetic_heatmap(bins,
+                    peaks, voltages, seed=seed)
+            path = os.path.join(folder, name + '.txt')
+            write_dataset(path, labels, arrival_time, matrix)
+            rows.append(benchmark_dataset(name, path, settings, truth))
+    finally:
+        shutil.rmtree(folder)
+    if demo:
+        demo_settings = dict(settings)
+        demo_settings['means'] = settings['means_demo']
+        files = [os.path.basename(i) for i in glob.glob('../Data/*.txt')]
+        for name in sorted(files, key=utils.natural_keys):
+            name = os.path.splitext(name)[0]
+            rows.append(benchmark_dataset(name, parse.data_path(name),
+                    demo_settings))
+    return rows
+
+
+def startup_times(repeats=5):
+    """Measures the cold start time of the imports in STARTUP.
+
+    Each import runs in a new interpreter, as a script or worker process
+    would, and the fastest of the repeats is kept.
+
+    Args:
+        repeats(optional): Number of times each import is run
+
+    Returns:
+        startup: List of (name, time in seconds, True if matplotlib was 
+            loaded), in the order of STARTUP
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    startup = []
+    for name, statement in STARTUP:
+        best = None
+        for _ in range(repeats):
+            start_time = time.time()
+            loaded = subprocess.check_output([sys.executable, '-c', statement +
+                    "\nimport sys\nprint 'matplotlib' in sys.modules"], 
+                    cwd=script_dir)
+            duration = time.time() - start_time
+            if best is None or duration < best:
+                best = duration
+        startup.append((name, best, loaded.strip() == 'True'))
+    return startup
+
+
+def write_table(rows, path):
+    """Writes the benchmark results as a tab separated table.
+
+    Args:
+        rows: List of results, see benchmark_dataset
+        path: Path of the table
+
+    Returns:
+        Nothing
+    """
+    accuracy = ['curve', 'height', 'sd', 'area']
+    with open(path, 'w') as f:
+        f.write('\t'.join(['Dataset', 'Bins', 'Voltages'] +
+                [i + ' (s)' for i in STAGES] + ['Total (s)', 'Average error']
+                + [i + ' error' for i in accuracy]) + '\n')
+        for row in rows:
+            f.write('\t'.join([row['name'], str(row['bins']),
+                str(row['voltages'])] + ['%.4f' % row['times'].get(i, 0) for
+                i in STAGES] + ['%.4f' % row['total'], '%.4f' % row['error']]
+                + [('%.4f' % row['accuracy'][i]) if row['accuracy'] else ''
+                for i in accuracy]) + '\n')
+
+
+def parse_sizes(text):
+    """Parses the sizes of the synthetic datasets.
+
+    Args:
+        text: Comma separated bins x peaks x voltages, e.g. '200x3x8,1000x3x8'
+
+    Returns:
+        List of (bins, peaks, voltages)
+    """
+    return [tuple(int(j) for j in i.split('x')) for i in text.split(',') if
+            i.strip()]
+
+
+def main():
+    start_time = time.time()
+    parser = argparse.ArgumentParser(description="""Benchmark of the fitting
+        pipeline on synthetic and demo datasets.""")
+    parser.add_argument('label', type=str, help="""Label for the benchmark
+        table (and plots) written a level above the script.""")
+    parser.add_argument('-z', '--sizes', default='200x3x8,1000x3x8,200x6x8,'
+        '200x3x32', type=str, metavar='', help="""Synthetic datasets as comma
+        separated bins x peaks x voltages. Default is
+        '200x3x8,1000x3x8,200x6x8,200x3x32'.""")
+    parser.add_argument('-n', '--means', default='truth', type=str,
+        metavar='', help="""Mode of mean determination for the synthetic data,
+        'truth' for the true means (default) or a mode of deconvolute.py.""")
+    parser.add_argument('-d', '--demo-means', default='der', type=str,
+        metavar='', help="""Mode of mean determination for the demo data.
+        Default is 'der'.""")
+    parser.add_argument('--no-demo', action='store_true', help="""Include to
+        skip the demo data files.""")
+    parser.add_argument('-s', '--smooth', default='', type=str, metavar='',
+        help="""Smoothing as [window size, interval]. No smoothing if left
+        empty.""")
+    parser.add_argument('-r', '--repeats', default=5, type=int, metavar='',
+        help="""Number of recursions (depth of analysis). Default is 5.""")
+    parser.add_argument('-b', '--backend', default='stepwise',
+        choices=optimisation.BACKENDS, metavar='',
+        help="""Fitting engine, see deconvolute.py. Default is 'stepwise'.""")
+    parser.add_argument('--search', default='fixed',
+        choices=optimisation.SEARCHES, metavar='', help="""Parameter search
+        of the stepwise optimiser, see deconvolute.py. Default is
+        'fixed'.""")
+    parser.add_argument('--support', default=0, type=float, metavar='',
+        help="""Support of the peaks in standard deviations, see
+        deconvolute.py. Default is 0, the whole series.""")
+    parser.add_argument('-p', '--plots', action='store_true', help="""Include
+        to time the plotting stage. The plots are written to a results folder
+        for each dataset.""")
+    parser.add_argument('--seed', default=0, type=int, metavar='',
+        help="""Seed of the synthetic noise. Default is 0.""")
+    parser.add_argument('--startup', action='store_true', help="""Include to
+        also measure the cold start time of the fitting and plotting
+        imports.""")
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help="""Include to print progress messages.""")
+    args = parser.parse_args()
+    instrument.set_verbose(args.verbose)
+    means = args.means
+    if means != 'truth':
+        means = deconvolute.parse_means(means)
+    settings = {'smooth': [int(i) for i in re.findall(r'\d+', args.smooth)],
+            'means': means,
+            'means_demo': deconvolute.parse_means(args.demo_means),
+            'cycles': args.repeats, 'backend': args.backend,
+            'search': args.search, 'support': args.support,
+            'plots': args.plots, 'label': args.label}
+    rows = run(parse_sizes(args.sizes), settings, not args.no_demo, args.seed)
+    script_dir = os.path.abspath(os.path.join(__file__, "../.."))
+    write_table(rows, os.path.join(script_dir, 'benchmark' + args.label +
+            '.tsv'))
+    for row in rows:
+        print row['name'], '%.3f s' % row['total'], row['times'],
+        print row['accuracy']
+    if args.startup:
+        startup = startup_times()
+        with open(os.path.join(script_dir, 'benchmark' + args.label +
+                '_startup.tsv'), 'w') as f:
+            f.write('Imports\tTime (s)\tMatplotlib loaded\n')
+            for name, duration, loaded in startup:
+                f.write('%s\t%.4f\t%s\n' % (name, duration, loaded))
+                print name, '%.3f s' % duration, 'matplotlib' if loaded else ''
+    instrument.log('Full time elapsed:', time.time() - start_time)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 """Main module of Deconvolution package. 
 
-Alter this module's main() function to run. Options are described in the main() 
-and deconvolve() functions.
+Alter this module's main() function to run. Options are described in the 
+main() and deconvolve() functions.
 
 Created by Simos Kalfas
     email:simos.kalfas@gmail.com
@@ -14,12 +14,503 @@ import smoother
 import utils
 import analyse
 import optimisation
+import instrument
+import fitcache
 import time
 import argparse
 import re
+import itertools
+import multiprocessing
+import collections
+import numpy as np
+
+#Number of ATDs read ahead of each worker when streaming, see bounded_imap
+STREAM_AHEAD = 4
+
+def run_fit(arrival_time, intensities, means, initial_sds, initial_heights, 
+        norm_factor, settings, stats):
+    """Fits an ATD from the given starting values and evaluates the fit.
+
+    Args:
+        arrival_time: Arrival time series
+        intensities: ATD curve (distribution)
+        means: Mean values as indices
+        initial_sds: Initial standard deviation values
+        initial_heights: Initial height values
+        norm_factor: Scale factor for unnormalised data
+        settings: Dictionary of fit settings, see deconvolve
+        stats: Dictionary updated with the number of optimiser 'iterations'
+            and events if profiling, see instrument.new_stats
+
+    Returns:
+        Same as analyse.list_of_gaus
+    """
+    with instrument.timed(stats, 'fit', backend=settings['backend']):
+        fitted_parameters_f, fit_f, fitted_parameters_r, fit_r = \
+                optimisation.fit_atd(settings['backend'], settings['cycles'], 
+                                arrival_time, intensities, initial_sds,
+                                initial_heights, means, stats=stats, 
+                                search=settings['search'], 
+                                support=settings['support'])
+    with instrument.timed(stats, 'list_of_gaus'):
+        return analyse.list_of_gaus(arrival_time, intensities, 
+                fitted_parameters_f, fitted_parameters_r, norm_factor)
+
+
+def determine_means(intensities, arrival_time, settings, stats=None):
+    """Finds the means of an ATD with the mean mode of the settings.
+
+    For 'auto' the number of peaks is chosen with optimisation.select_means
+    among the means of the second derivative method.
+
+    Args:
+        intensities: ATD curve (distribution)
+        arrival_time: Arrival time series
+        settings: Dictionary of fit settings, see fit_voltage
+        stats(optional): Dictionary of stats, see instrument.new_stats
+
+    Returns:
+        means: Means as indices, in ascending order
+    """
+    if settings['mean_mode'] == 'auto':
+        candidates = utils.find_means(intensities, arrival_time, 'der')
+        return optimisation.select_means(arrival_time, intensities, 
+                candidates, settings['criterion'], stats=stats)
+    return sorted(utils.find_means(intensities, arrival_time, 
+            settings['mean_mode']))
+
+
+def populations(intensities, arrival_time, curves, parameters, norm_factor):
+    """Calculates the relative area and FWHM of every fitted peak.
+
+    Args:
+        intensities: ATD curve (distribution)
+        arrival_time: Arrival time series
+        curves: Fitted peaks followed by their sum and the ATD, see 
+            analyse.list_of_gaus
+        parameters: Fitted parameters [[height1, mean1, sd1], ...]
+        norm_factor: Scale factor for unnormalised data
+
+    Returns:
+        areacur: Area of each peak as percentage of the area of the ATD
+        fwhmcur: Full width half maximum of each peak
+    """
+    areacur = []
+    fwhmcur = []
+    total_area = utils.auc(intensities, arrival_time) * norm_factor
+    #For area under the curve plot
+    for i in range(len(curves) - 2):
+        areacur.append(((utils.auc(curves[i], arrival_time) * 
+            norm_factor) / total_area) * 100)
+    #For full width half maximum plot
+    for i in range(len(curves) - 2):
+        fwhmcur.append(utils.fwhm(parameters[i][2]))
+    return areacur, fwhmcur
+
+
+def fit_voltage(job):
+    """Fits and analyses the ATD of a single voltage.
+
+    Kept at module level so that it can be sent to worker processes. Each ATD
+    is independent, so the result only depends on the job.
+
+    If a seed is given and has as many peaks as the ATD, the ATD is fitted 
+    both from the seed (warm start) and from narrow peaks at the ATD 
+    intensities (cold start). The warm fit is kept unless its error exceeds 
+    the error of the cold fit by more than settings['warm_tolerance'] times,
+    and saved_iterations counts the iterations the warm fit needed less than
+    the cold fit of the same ATD. Without a seed only the cold start is run.
+
+    If settings has a 'cache' folder, cold starts are looked up in the fit 
+    cache (see fitcache) after smoothing, and stored there when fitted.
+
+    Args:
+        job: Tuple of (voltage, intensities, arrival_time, settings, seed). 
+            settings is a dictionary with the 'smooth', 'mean_mode', 'cycles', 
+            'backend', 'warm_tolerance', 'profile', 'criterion', 
+            'smooth_kernel', 'search' and 'support' options of deconvolve, 
+            and optionally 'cache'. 
+            seed is None or the [[height1, mean1, sd1], ...] of a previous
+            fit.
+
+    Returns:
+        fit: Dictionary with the results for the ATD
+            {'voltage', 'intensities', 'means', 'parameters', 'gausslist', 
+            'errors', 'min_error', 'erind', 'areas', 'fwhms', 'start', 
+            'iterations', 'warm_iterations', 'time', 'events'}, with 
+            'saved_iterations' added if seeded.
+            start is 'cold', 'warm', 'fallback' (warm start rejected) or 
+            'cached' (read from the fit cache, with no iterations) and
+            warm_iterations the part of the iterations spent on the warm start.
+            time is the wall time of the fit in seconds. events are the 
+            events recorded if profiling, see instrument.record, each with the
+            voltage added.
+    """
+    start_time = time.time()
+    voltage, intensities, arrival_time, settings, seed = job
+    stats = instrument.new_stats(settings['profile'])
+    with instrument.timed(stats, 'smooth'):
+        intensities = list(smoother.smooth(intensities, settings['smooth'], 
+                settings['smooth_kernel'])) 
+    key = None
+    if settings.get('cache') and seed is None:
+        with instrument.timed(stats, 'cache'):
+            key = fitcache.fit_key(intensities, arrival_time, settings)
+            fit = fitcache.load(settings['cache'], key)
+        if fit is not None:
+            fit.update({'voltage': voltage, 'start': 'cached', 
+                    'iterations': 0, 'warm_iterations': 0, 
+                    'time': time.time() - start_time, 
+                    'events': stats.get('events', [])})
+            for event in fit['events']:
+                event['voltage'] = voltage
+            return fit
+    norm_factor = 100 / max(intensities) #Scale factor for normalisation
+    with instrument.timed(stats, 'find_means'):
+        means = determine_means(intensities, arrival_time, settings, stats)
+    selection_iterations = stats['iterations']
+    warm_iterations = 0
+    start = 'cold'
+    seeded = seed is not None and len(seed) == len(means)
+    if seeded:
+        warm_fit = run_fit(arrival_time, intensities, means, 
+                [p[2] for p in seed], [p[0] for p in seed], norm_factor, 
+                settings, stats)
+        warm_iterations = stats['iterations'] - selection_iterations
+    initial_sds = [0.01 for _ in range(len(means))]
+    initial_heights = [intensities[i] for i in means]
+    av_par, gausslist, min_er, error = run_fit(arrival_time, intensities, 
+            means, initial_sds, initial_heights, norm_factor, settings, stats)
+    if seeded:
+        cold_iterations = stats['iterations'] - selection_iterations - \
+                warm_iterations
+        start = 'fallback'
+        if warm_fit[2] <= min_er * settings['warm_tolerance']:
+            start = 'warm'
+            av_par, gausslist, min_er, error = warm_fit
+    erind = error.index(min_er)
+    with instrument.timed(stats, 'areas'):
+        areacur, fwhmcur = populations(intensities, arrival_time, 
+                gausslist[erind], av_par, norm_factor)
+    fit = {'voltage': voltage, 'intensities': intensities, 'means': means, 
+            'parameters': av_par, 'gausslist': gausslist, 'errors': error, 
+            'min_error': min_er, 'erind': erind, 'areas': areacur, 
+            'fwhms': fwhmcur, 'start': start, 
+            'iterations': stats['iterations'], 
+            'warm_iterations': warm_iterations, 'events': []}
+    if seeded:
+        fit['saved_iterations'] = cold_iterations - warm_iterations
+    if key is not None:
+        with instrument.timed(stats, 'cache'):
+            fitcache.store(settings['cache'], key, fit)
+    events = stats.get('events', [])
+    for event in events:
+        event['voltage'] = voltage
+    fit.update({'time': time.time() - start_time, 'events': events})
+    return fit
+
+
+def warm_start_fits(jobs):
+    """Fits ATDs in order, seeding each fit with the previous result.
+
+    Args:
+        jobs: Iterable of jobs for fit_voltage, in voltage order
+
+    Yields:
+        fit: Results of fit_voltage, with 'saved_iterations' 0 for ATDs 
+            fitted from a cold start only
+    """
+    seed = None
+    for voltage, intensities, arrival_time, settings, _ in jobs:
+        fit = fit_voltage((voltage, intensities, arrival_time, settings, seed))
+        fit.setdefault('saved_iterations', 0)
+        seed = fit['parameters']
+        yield fit
+
+
+def render_plot(job):
+    """Renders one plot of the results.
+
+    Kept at module level so that it can be sent to worker processes.
+
+    Args:
+        job: Tuple of (kind, arguments). kind is 'atd' for plots.plot_things
+            or 'areas' for plots.indiv_area_plot, arguments the positional 
+            arguments of that function.
+
+    Returns:
+        Nothing
+    """
+    import plots #Only loaded when plotting
+    kind, arguments = job
+    if kind == 'atd':
+        plots.plot_things(*arguments)
+    elif kind == 'areas':
+        plots.indiv_area_plot(*arguments)
+
+
+def global_fits(jobs):
+    """Fits all ATDs of a ramp jointly, see optimisation.global_fit.
+
+    The means are found once, on the average of the normalised ATDs, and are 
+    shared by all voltages, so every ATD has the same peaks. The time and 
+    iterations of the joint fit are shared evenly between the voltages and its
+    events are given with the first voltage, as voltage 'all'.
+
+    Args:
+        jobs: Iterable of jobs for fit_voltage, in voltage order. settings 
+            also has the 'widths' option of deconvolve.
+
+    Yields:
+        fit: Same as fit_voltage, with start 'global'
+    """
+    start_time = time.time()
+    jobs = list(jobs)
+    settings = jobs[0][3]
+    arrival_time = jobs[0][2]
+    stats = instrument.new_stats(settings['profile'])
+    with instrument.timed(stats, 'smooth'):
+        atds = [list(smoother.smooth(job[1], settings['smooth'], 
+                settings['smooth_kernel'])) for job in jobs]
+    #Scale factors for normalisation
+    norm_factors = [100 / max(i) for i in atds]
+    with instrument.timed(stats, 'find_means'):
+        average = np.mean([np.array(atds[i]) * norm_factors[i] for i in 
+                range(len(atds))], axis=0)
+        means = determine_means(list(average), arrival_time, settings, 
+                stats)
+    with instrument.timed(stats, 'fit', backend='global'):
+        parameters, _ = optimisation.global_fit(arrival_time, atds, means, 
+                settings['widths'], stats=stats)
+    events = stats.get('events', [])
+    for event in events:
+        event['voltage'] = 'all'
+    share = (time.time() - start_time) / len(jobs)
+    iterations = [stats['iterations'] // len(jobs) for _ in jobs]
+    iterations[0] += stats['iterations'] % len(jobs)
+    for i in range(len(jobs)):
+        fit_time = time.time()
+        voltage_stats = instrument.new_stats(settings['profile'])
+        with instrument.timed(voltage_stats, 'list_of_gaus'):
+            av_par, gausslist, min_er, error = analyse.list_of_gaus(
+                    arrival_time, atds[i], parameters[i], parameters[i], 
+                    norm_factors[i])
+        erind = error.index(min_er)
+        with instrument.timed(voltage_stats, 'areas'):
+            areacur, fwhmcur = populations(atds[i], arrival_time, 
+                    gausslist[erind], av_par, norm_factors[i])
+        for event in voltage_stats.get('events', []):
+            event['voltage'] = jobs[i][0]
+            events.append(event)
+        yield {'voltage': jobs[i][0], 'intensities': atds[i], 'means': means, 
+                'parameters': av_par, 'gausslist': gausslist, 'errors': error,
+                'min_error': min_er, 'erind': erind, 'areas': areacur, 
+                'fwhms': fwhmcur, 'start': 'global', 
+                'iterations': iterations[i], 'warm_iterations': 0, 
+                'time': share + time.time() - fit_time, 'events': events}
+        events = []
+
+
+def batched_fits(jobs):
+    """Fits all ATDs of a ramp together with optimisation.batch_fit.
+
+    Each ATD keeps its own means, found as in fit_voltage, and is fitted from
+    a cold start with the same optimiser as the 'stepwise' backend, but all 
+    ATDs advance together. ATDs found in the fit cache (see fit_voltage) are
+    not fitted again. The time and iterations of the joint fit are shared 
+    evenly between the ATDs fitted and its events are given as voltage 'all'.
+
+    Args:
+        jobs: Iterable of jobs for fit_voltage, in voltage order
+
+    Yields:
+        fit: Same as fit_voltage
+    """
+    start_time = time.time()
+    jobs = list(jobs)
+    settings = jobs[0][3]
+    arrival_time = jobs[0][2]
+    stats = instrument.new_stats(settings['profile'])
+    fits = {}
+    keys = {}
+    atds = {}
+    means = {}
+    for voltage, intensities, _, _, _ in jobs:
+        with instrument.timed(stats, 'smooth'):
+            atds[voltage] = list(smoother.smooth(intensities, 
+                    settings['smooth'], settings['smooth_kernel']))
+        if settings.get('cache'):
+            with instrument.timed(stats, 'cache'):
+                keys[voltage] = fitcache.fit_key(atds[voltage], arrival_time,
+                        settings)
+                fit = fitcache.load(settings['cache'], keys[voltage])
+            if fit is not None:
+                fit.update({'voltage': voltage, 'start': 'cached', 
+                        'iterations': 0, 'warm_iterations': 0, 'time': 0, 
+                        'events': []})
+                fits[voltage] = fit
+                continue
+        with instrument.timed(stats, 'find_means'):
+            means[voltage] = determine_means(atds[voltage], arrival_time, 
+                    settings, stats)
+    voltages = [job[0] for job in jobs if job[0] not in fits]
+    if voltages:
+        with instrument.timed(stats, 'fit', backend='batched'):
+            results = optimisation.batch_fit(settings['cycles'], arrival_time,
+                    [atds[i] for i in voltages], 
+                    [[0.01 for _ in means[i]] for i in voltages],
+                    [[atds[i][j] for j in means[i]] for i in voltages],
+                    [means[i] for i in voltages], stats=stats)
+        share = (time.time() - start_time) / len(voltages)
+        for voltage, result in zip(voltages, results):
+            intensities = atds[voltage]
+            norm_factor = 100 / max(intensities)
+            fitted_parameters_f, _, fitted_parameters_r, _ = result
+            av_par, gausslist, min_er, error = analyse.list_of_gaus(
+                    arrival_time, intensities, fitted_parameters_f, 
+                    fitted_parameters_r, norm_factor)
+            erind = error.index(min_er)
+            areacur, fwhmcur = populations(intensities, arrival_time, 
+                    gausslist[erind], av_par, norm_factor)
+            fit = {'voltage': voltage, 'intensities': intensities, 
+                    'means': means[voltage], 'parameters': av_par, 
+                    'gausslist': gausslist, 'errors': error, 
+                    'min_error': min_er, 'erind': erind, 'areas': areacur, 
+                    'fwhms': fwhmcur, 'start': 'cold', 'iterations': 0, 
+                    'warm_iterations': 0, 'events': []}
+            if voltage in keys:
+                fitcache.store(settings['cache'], keys[voltage], fit)
+            fits[voltage] = dict(fit, iterations=stats['iterations'] // 
+                    len(voltages), time=share)
+    events = stats.get('events', [])
+    for event in events:
+        event['voltage'] = 'all'
+    fits[jobs[0][0]]['events'] = events
+    for job in jobs:
+        yield fits[job[0]]
+
+
+def ensemble_fits(jobs, pool=None):
+    """Fits every ATD from several jittered starting points.
+
+    Each ATD is smoothed and its means found as in fit_voltage, and it is then
+    fitted from settings['ensemble'] starts (see optimisation.ensemble_starts)
+    with the 'stepwise' optimiser. The forward and reverse chains of all 
+    starts run at once in the pool (see optimisation.ensemble_fit) and the 
+    start with the lowest error is kept. The spread of the ensemble is 
+    reported with the fit. ATDs found in the fit cache are not fitted again.
+
+    Args:
+        jobs: Iterable of jobs for fit_voltage. settings also has the 
+            'ensemble' option of deconvolve.
+        pool(optional): multiprocessing.Pool running the chains. If None the 
+            chains are run one after another.
+
+    Yields:
+        fit: Same as fit_voltage, with 'ensemble' added
+            {'size', 'best', 'errors', 'error_spread', 'area_spread'}
+            best is the index of the start kept and errors the lowest error 
+            of each start. error_spread is the standard deviation of errors 
+            and area_spread that of the area of each peak across starts.
+    """
+    for voltage, intensities, arrival_time, settings, _ in jobs:
+        start_time = time.time()
+        stats = instrument.new_stats(settings['profile'])
+        with instrument.timed(stats, 'smooth'):
+            intensities = list(smoother.smooth(intensities, 
+                    settings['smooth'], settings['smooth_kernel']))
+        key = None
+        if settings.get('cache'):
+            with instrument.timed(stats, 'cache'):
+                key = fitcache.fit_key(intensities, arrival_time, settings)
+                fit = fitcache.load(settings['cache'], key)
+            if fit is not None:
+                fit.update({'voltage': voltage, 'start': 'cached', 
+                        'iterations': 0, 'warm_iterations': 0, 
+                        'time': time.time() - start_time, 'events': []})
+                yield fit
+                continue
+        norm_factor = 100 / max(intensities) #Scale factor for normalisation
+        with instrument.timed(stats, 'find_means'):
+            means = determine_means(intensities, arrival_time, settings, stats)
+        starts = optimisation.ensemble_starts(arrival_time, intensities, means,
+                settings['ensemble'])
+        with instrument.timed(stats, 'fit', backend='ensemble'):
+            results = optimisation.ensemble_fit(settings['cycles'], 
+                    arrival_time, intensities, starts, stats=stats, 
+                    search=settings['search'], support=settings['support'],
+                    pool=pool)
+        members = []
+        with instrument.timed(stats, 'list_of_gaus'):
+            for fitted_parameters_f, _, fitted_parameters_r, _ in results:
+                members.append(analyse.list_of_gaus(arrival_time, intensities,
+                        fitted_parameters_f, fitted_parameters_r, 
+                        norm_factor))
+        with instrument.timed(stats, 'areas'):
+            member_areas = []
+            for av_par, gausslist, min_er, error in members:
+                member_areas.append(populations(intensities, arrival_time, 
+                        gausslist[error.index(min_er)], av_par, 
+                        norm_factor))
+        min_errors = [member[2] for member in members]
+        best = min_errors.index(min(min_errors))
+        av_par, gausslist, min_er, error = members[best]
+        areacur, fwhmcur = member_areas[best]
+        fit = {'voltage': voltage, 'intensities': intensities, 
+                'means': starts[best][0], 'parameters': av_par, 
+                'gausslist': gausslist, 'errors': error, 'min_error': min_er, 
+                'erind': error.index(min_er), 'areas': areacur, 
+                'fwhms': fwhmcur, 'start': 'ensemble', 
+                'iterations': stats['iterations'], 'warm_iterations': 0, 
+                'events': [], 
+                'ensemble': {'size': len(starts), 'best': best, 
+                    'errors': min_errors, 
+                    'error_spread': float(np.std(min_errors)), 
+                    'area_spread': list(np.std([i[0] for i in member_areas],
+                        axis=0))}}
+        if key is not None:
+            with instrument.timed(stats, 'cache'):
+                fitcache.store(settings['cache'], key, fit)
+        events = stats.get('events', [])
+        for event in events:
+            event['voltage'] = voltage
+        fit.update({'time': time.time() - start_time, 'events': events})
+        yield fit
+
+
+def bounded_imap(pool, function, jobs, ahead):
+    """Maps a function over jobs in a pool, reading only a few jobs ahead.
+
+    Unlike pool.imap, which reads the whole iterable of jobs straight away,
+    at most ahead jobs are waiting or running at any time, so a stream of 
+    jobs is never held in memory at once.
+
+    Args:
+        pool: multiprocessing.Pool
+        function: Function of one job, at module level
+        jobs: Iterable of jobs
+        ahead: Number of jobs sent to the pool before waiting for a result
+
+    Yields:
+        Results of function in the order of the jobs
+    """
+    pending = collections.deque()
+    for job in jobs:
+        pending.append(pool.apply_async(function, (job,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
 
 def deconvolve(filename, res_filename, smooth, mean_mode, title, xticks, 
-    ciu, cycles, aline, indiv_areas, print_res=True,):
+    ciu, cycles, aline, indiv_areas, print_res=True, backend='stepwise', 
+    workers=1, warm_start=False, warm_tolerance=1.05, stream=False, 
+    plot_formats=utils.PLOT_FORMATS, plot_workers=0, profile=False, 
+    verbose=False, global_fit=False, widths='shared', criterion='bic', 
+    smooth_kernel='box', smooth_voltages=0, align_method='max', 
+    fit_cache=False, cache_size=fitcache.CACHE_SIZE, search='fixed', 
+    ensemble=0, support=0):
     """Handles deconvolution and result processing
 
     Works as a control center for the package, handling all processes and 
@@ -28,28 +519,126 @@ def deconvolve(filename, res_filename, smooth, mean_mode, title, xticks,
     Args:
         filename: Data file name without file extension
         res_filename: Identifier for result file names
-        smooth: Moving average smoothing factor in format: 
-            [window size, interval]. No smoothing if left empty
+        smooth: Smoothing factor in format: [number, window], see 
+            smoother.smooth_matrix. No smoothing if left empty
         mean_mode: 'der' for second derivative
                    'rel_max' for relative maxima
+                   'auto' for the second derivative means, keeping as many 
+                        as the criterion chooses, see determine_means
                    [mean1, mean2, ... ] for given means, where mean is float 
                         for x-axis value, int for index
                    [] to return unfitted data
         cycles: Number of optimisation iterations.
         print res: If True returns plots and error log, in a folder one level 
                 above.
-                   If False returns dict with parameters for deconvoluted peaks 
-                for each ATD
+                   If False only returns the results
+            In both cases a record of each fit is written to the JSON lines
+            file <filename><res_filename>_results.jsonl in the same folder,
+            see analyse.result_record.
         aline(optional): If True all data will be alined according to the 
             smallest x value for a global maximum in the dataset
+        backend(optional): Fitting engine, see optimisation.fit_atd. 
+            'stepwise' (default) for the iterative optimiser, 'lsq' for joint
+            least squares fitting, 'batched' for the iterative optimiser run
+            on all ATDs at once with the same fits as 'stepwise' (see 
+            batched_fits), 
+            'dictionary' for joint least squares fitting started from a 
+            non-negative solve over a cached bank of fixed width peaks (see 
+            optimisation.dictionary_fit)
+        workers(optional): Number of processes fitting ATDs in parallel. The 
+            results are collected in voltage order, so the output is the same
+            as with a single process (default). Cannot be combined with 
+            global_fit or the 'batched' backend.
+        warm_start(optional): If True each ATD is also fitted starting from 
+            the parameters of the previous voltage, see fit_voltage. The ATDs 
+            are then fitted one after another, so workers is not used.
+        warm_tolerance(optional): Factor by which a warm start error may 
+            exceed the cold start error of the same ATD before the cold fit is
+            kept instead. Default is 1.05.
+        stream(optional): If True the data is read through the memory-mapped
+            heatmap of parse.open_heatmap, one voltage at a time, instead of
+            being loaded whole. Cannot be combined with aline, global_fit or
+            the 'batched' backend, which need all ATDs at once. Only 
+            STREAM_AHEAD ATDs per worker are read ahead of the fits, plots
+            are rendered as soon as each ATD is fitted and the fits returned
+            do not keep their curves, so memory does not grow with the 
+            number of voltages.
+        plot_formats(optional): Image formats of the plots, e.g. ['png']. No 
+            plots are made if empty.
+        plot_workers(optional): Number of processes rendering plots while the
+            ATDs are fitted. If 0 (default), the plots are rendered after all
+            ATDs have been fitted.
+        profile(optional): If True the time, iterations and exit reasons of 
+            every stage are recorded (see instrument) and written to 
+            <filename><res_filename>_profile.jsonl, with a summary at the end
+            of the error log.
+        verbose(optional): If True progress messages are printed
+        global_fit(optional): If True all ATDs are fitted jointly with shared
+            means, see global_fits. backend and warm_start are then not 
+            used.
+        widths(optional): Standard deviations of the global fit, 'shared' by
+            all ATDs or 'smooth' for each ATD, changing smoothly with voltage
+        criterion(optional): Information criterion of the 'auto' mean mode, 
+            'bic' (default) or 'aic'
+        smooth_kernel(optional): Smoothing kernel, 'box' (default, moving 
+            average), 'savgol' or 'gaussian', see smoother.smooth_matrix
+        smooth_voltages(optional): If more than 1, the ATDs are also smoothed
+            across this many neighbouring voltages. Cannot be combined with 
+            stream.
+        align_method(optional): 'max' (default) or 'xcorr', see 
+            parse.align_matrix
+        fit_cache(optional): If True, fits of ATDs already fitted with the 
+            same settings are read from the fit cache in fitcache.CACHE_DIR
+            instead of being fitted again. Not used with warm_start or 
+            global_fit, where each fit depends on the others.
+        cache_size(optional): Number of fits kept in the fit cache, the least
+            recently used are removed
+        search(optional): Parameter search of the 'stepwise' backend, 'fixed'
+            (default) steps or 'adaptive' steps, see optimisation.optimiser.
+            Cannot be combined with global_fit or the 'batched' backend.
+        ensemble(optional): If more than 1, each ATD is fitted from this many
+            jittered starting points and the best fit is kept, see 
+            ensemble_fits. The chains of all starts run in workers processes.
+            Needs the 'stepwise' backend.
+        support(optional): If more than 0, the 'stepwise' optimiser only 
+            evaluates peaks within this many standard deviations of their 
+            mean, see optimisation.optimiser. Speeds up long arrival time 
+            series with narrow peaks. The fits differ slightly from those 
+            with 0 (default, the whole series): with 8, fitted sds moved by
+            up to 0.03 and errors by up to 0.002 on the demo data. Cannot be
+            combined with global_fit or the 'batched' backend.
 
     Returns:
-        If print_res is False:
-           retdic: Dictionary with fitted parameters and errors"""
-    datadic = parse.handle_file(filename)
-    if aline:  #Aline file if desired
-        datadic = parse.aline(parse.handle_file(filename), filename)
-    arrival_time = datadic[filename]
+        retdic: Dictionary with fitted parameters and errors for each voltage
+            {voltage: fit}, see fit_voltage. When streaming, the fits have 
+            no 'intensities' and 'gausslist'."""
+    instrument.set_verbose(verbose)
+    stats = instrument.new_stats(profile)
+    if stream and (aline or smooth_voltages > 1):
+        raise ValueError('Alignment and smoothing across voltages need the '
+                'whole dataset and cannot be combined with streaming')
+    if stream and (global_fit or backend == 'batched'):
+        raise ValueError('Global and batched fits hold all ATDs at once and '
+                'cannot be combined with streaming')
+    if (global_fit or backend == 'batched') and (search != 'fixed' or 
+            support > 0 or workers > 1):
+        raise ValueError('Global and batched fits run in one process with '
+                'fixed steps over the whole series, so search, support and '
+                'workers cannot be set')
+    if ensemble > 1 and backend != 'stepwise':
+        raise ValueError('Ensemble fits use the stepwise optimiser, not the ' 
+                + backend + ' backend')
+    with instrument.timed(stats, 'parse'):
+        if stream:  #Only the labels and arrival times are loaded here
+            labels, arrival_time, _ = parse.open_heatmap(filename)
+            arrival_time = arrival_time.tolist()
+        else:
+            datadic = parse.handle_file(filename)
+            if aline:  #Aline file if desired
+                datadic = parse.aline(datadic, filename, 
+                        method=align_method)
+            arrival_time = datadic[filename]
+            labels = list(datadic)
     av_error = []
     areas = []
     fwhms = []
@@ -59,43 +648,76 @@ def deconvolve(filename, res_filename, smooth, mean_mode, title, xticks,
     results_dir = os.path.join(script_dir, filename + res_filename + '/')
     if not os.path.isdir(results_dir):
         os.makedirs(results_dir)
+    voltages = [key for key in sorted(labels, key=utils.natural_keys) if 
+            key != filename] #Exclude arrival times
+    settings = {'smooth': smooth, 'mean_mode': mean_mode, 'cycles': cycles, 
+            'backend': backend, 'warm_tolerance': warm_tolerance, 
+            'profile': profile, 'widths': widths, 'criterion': criterion, 
+            'smooth_kernel': smooth_kernel, 'cache': None, 'search': search,
+            'ensemble': ensemble, 'support': support}
+    if fit_cache and not (warm_start or global_fit):
+        settings['cache'] = fitcache.CACHE_DIR
+    if stream: #Each ATD is smoothed on its own when it is fitted
+        atds = parse.stream_heatmap(filename, voltages)
+    else: #All ATDs are smoothed at once
+        matrix = [datadic[voltage] for voltage in voltages]
+        if smooth or smooth_voltages > 1:
+            with instrument.timed(stats, 'smooth'):
+                matrix = smoother.smooth_matrix(matrix, smooth, smooth_kernel,
+                        smooth_voltages).tolist()
+            settings['smooth'] = [] #Already smoothed
+        atds = itertools.izip(voltages, matrix)
+    jobs = ((voltage, intensities, arrival_time, settings, None) for 
+            voltage, intensities in atds)
+    pool = None
+    render_pool = None
+    plot_jobs = [] #Plots rendered once fitting is done
+    rendering = [] #Plots rendered in the background
+    if plot_formats and plot_workers > 0:
+        render_pool = multiprocessing.Pool(plot_workers)
+    if global_fit: #All ATDs are fitted at once
+        fits = global_fits(jobs)
+    elif warm_start: #Each fit is seeded with the previous one
+        fits = warm_start_fits(jobs)
+    elif backend == 'batched': #All ATDs are fitted together
+        fits = batched_fits(jobs)
+    elif ensemble > 1: #The chains of each ATD are fitted in parallel
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+        fits = ensemble_fits(jobs, pool)
+    elif workers > 1: #Fit in parallel, results are still returned in order
+        pool = multiprocessing.Pool(workers)
+        if stream: #Only read as many ATDs as the workers can take
+            fits = bounded_imap(pool, fit_voltage, jobs, 
+                    workers * STREAM_AHEAD)
+        else:
+            fits = pool.imap(fit_voltage, jobs)
+    else:
+        fits = itertools.imap(fit_voltage, jobs)
     #Create error log file
-    with open(results_dir + filename + res_filename + '_errorlog_' + str(cycles) 
-            + '.txt', 'w') as f:
-        for key in sorted(datadic, key=utils.natural_keys): #Loop over ATDs
-            voltage = key
-            if voltage == filename: #Exclude arrival times
-                continue
-            print voltage
-            intensities = list(smoother.smooth(datadic[voltage], smooth)) 
-            norm_factor = 100 / max(intensities) #Scale factor for normalisation
-            means = utils.find_means(intensities, arrival_time, mean_mode)  
-            means.sort()
-            print 'Mean indices: ' + str(means)
-            initial_sds = [0.01 for _ in range(len(means))]
-            initial_heights = [intensities[i] for i in means]
-            fitted_parameters_f, fit_f, fitted_parameters_r, fit_r = optimisation.run_opt_cycles(
-                                        cycles, arrival_time, intensities,
-                                        initial_sds,initial_heights, means)
-            av_par, gausslist, min_er, error = analyse.list_of_gaus(
-                                arrival_time, intensities, fitted_parameters_f,
-                                            fitted_parameters_r, norm_factor)
-            av_error.append(min_er) #For final average error calculation
-            areacur = []
-            fwhmcur = []
-            total_area = utils.auc(intensities, arrival_time) * norm_factor
-            erind = error.index(min_er)
-            #For area under the curve plot
-            for i in range(len(gausslist[erind]) - 2):
-                areacur.append(((utils.auc(gausslist[erind][i], arrival_time) * 
-                    norm_factor) / total_area) * 100)
-            if len(datadic) == 2 or indiv_areas:
-                utils.indiv_area_plot(areacur, filename, results_dir, title, voltage)
-            #For full width half maximum plot
-            for i in range(len(gausslist[erind]) - 2):
-                fwhmcur.append(utils.fwhm(gausslist[erind][i][2]))
+    with open(results_dir + filename + res_filename + '_errorlog_' + 
+            str(cycles) + '.txt', 'w') as f, open(results_dir + filename + 
+            res_filename + '_results.jsonl', 'w') as r:
+        for fit in fits: #Loop over ATDs
+            voltage = fit['voltage']
+            key = voltage
+            instrument.log(voltage)
+            instrument.log('Mean indices: ' + str(fit['means']))
+            if profile:
+                stats['events'].extend(fit['events'])
+            av_par = fit['parameters']
+            gausslist = fit['gausslist']
+            error = fit['errors']
+            erind = fit['erind']
+            areacur = fit['areas']
+            #For final average error calculation
+            av_error.append(fit['min_error'])
+            plots = []
+            if len(labels) == 2 or indiv_areas:
+                plots.append(('areas', (areacur, filename, results_dir, title, 
+                    voltage, plot_formats)))
             areas.append(areacur)
-            fwhms.append(fwhmcur)
+            fwhms.append(fit['fwhms'])
             if print_res: #Create plots and error log
                 f.write(key + '\n')
                 f.write(str(error[0]) + ' forward error' + '\n')
@@ -108,25 +730,102 @@ def deconvolve(filename, res_filename, smooth, mean_mode, title, xticks,
                 for i in av_par:
                     f.write(str(i))
                     f.write('\n')
+                if warm_start:
+                    f.write('\nOptimiser iterations: ' + str(fit['iterations'])
+                        + ' (' + fit['start'] + ' start, ' + 
+                        str(fit['saved_iterations']) + 
+                        ' saved against its cold start)\n')
+                if 'ensemble' in fit:
+                    f.write('\nEnsemble: start ' + str(fit['ensemble']['best'])
+                        + ' of ' + str(fit['ensemble']['size']) + 
+                        ' kept, error spread ' + 
+                        str(fit['ensemble']['error_spread']) + '\n')
                 f.write('\n\n\n\n')
-                #utils.plot_things is a versatile plotting function
-                utils.plot_things(arrival_time, [gausslist[erind]], filename, 
-                    voltage, res_filename, title, ciu)
-            # else: #Make dict output with parameters and error values
-            #     erlist = error
-            #     parlist = fitted_parameters_f
-            #     minind = erlist.index(min(erlist))
-            #     retdic[voltage] = []
-            #     retdic[voltage].append(means)
-            #     retdic[voltage].append(parlist[minind])
-            #     retdic[voltage].append(erlist[minind])
-            #     retdic[voltage].append([fit_f, fit_r, fit_av][minind])
+                #plots.plot_things is a versatile plotting function
+                plots.append(('atd', (arrival_time, [gausslist[erind]], 
+                    filename, voltage, res_filename, title, ciu, 
+                    plot_formats)))
+            if plot_formats:
+                for job in plots:
+                    if render_pool is None and stream: #Do not keep the curves
+                        with instrument.timed(stats, 'plots'):
+                            render_plot(job)
+                    elif render_pool is None:
+                        plot_jobs.append(job)
+                    else:
+                        if stream and len(rendering) >= plot_workers * \
+                                STREAM_AHEAD: #Wait for the oldest plot
+                            rendering.pop(0).get()
+                        rendering.append(render_pool.apply_async(render_plot, 
+                            (job,)))
+            analyse.write_result(r, filename, fit, arrival_time)
+            if stream: #Only the results are kept, not the curves
+                fit = dict((k, fit[k]) for k in fit if k not in 
+                        ['intensities', 'gausslist'])
+            retdic[voltage] = fit
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if settings['cache']:
+            with instrument.timed(stats, 'cache'):
+                fitcache.evict(settings['cache'], cache_size)
+            instrument.log('Fits read from cache: ' + str(len([i for i in 
+                    retdic if retdic[i]['start'] == 'cached'])))
+        with instrument.timed(stats, 'plots'):
+            for job in plot_jobs:
+                render_plot(job)
+            for result in rendering: #Raises errors of background rendering
+                result.get()
+        if render_pool is not None:
+            render_pool.close()
+            render_pool.join()
+        if print_res and warm_start:
+            f.write('Optimiser iterations saved by warm starts against ' + 
+                'cold starts of the same ATDs: ' + str(sum(
+                [retdic[i]['saved_iterations'] for i in retdic])) + '\n\n')
         if print_res: #Return results concerning full CIU: area plot, FWHM plot
-            analyse.results(f, av_error, areas, fwhms, datadic, results_dir, 
-                filename, res_filename, title, xticks)
-            print av_error
-        else:
-            return retdic
+            with instrument.timed(stats, 'results'):
+                analyse.results(f, av_error, areas, fwhms, labels, 
+                    results_dir, filename, res_filename, title, xticks, 
+                    plot_formats)
+            instrument.log(av_error)
+        if profile:
+            instrument.write_events(results_dir + filename + res_filename + 
+                    '_profile.jsonl', stats['events'])
+            if print_res:
+                f.write('\n\nProfile:\n')
+                instrument.write_summary(f, stats['events'])
+    return retdic
+
+
+def parse_means(mean_mode):
+    """Parses the mean determination mode given as text.
+
+    Args:
+        mean_mode: 'der', 'rel_max', 'auto' or a list written as text, e.g. 
+            '[12, 40]' for indices or '[3.5, 7.1]' for numerical means
+
+    Returns:
+        The mode as expected by utils.find_means
+    """
+    if mean_mode[0] != '[':
+        return mean_mode
+    elif any([i for i in mean_mode if i == '.']):
+        return [float(i) for i in mean_mode[1:-1].split(',')]
+    else:
+        return [int(i) for i in mean_mode[1:-1].split(',')]
+
+
+def parse_xticks(xlabels):
+    """Parses the comma separated x-axis labels of the area tracking plot.
+
+    Args:
+        xlabels: Labels as text, e.g. '0V,120V,240V'
+
+    Returns:
+        List of int
+    """
+    return [int(re.sub("[^0-9]", "", i)) for i in xlabels.split(',')]
 
 
 def main():
@@ -142,13 +841,23 @@ def main():
   					'der' for automatic determination with second derivative 
   					method, \n
   					'rel_max' for relative maxima to be taken as the means, \n
+  					'auto' for the second derivative means, keeping only as 
+  					many as needed (see --criterion), \n
   					list of float for numerical means, \n
   					list of integers for indices.""")
     parser.add_argument('directory_label', type=str, help="""Label for results
     	directory which will be created a level above the script""")
     parser.add_argument('-s', '--smooth', default=[], type=list, metavar='',
-    	help="""[window size, interval]. If not included or empty there will be 
-    	no smoothing.""")
+    	help="""[number of repeats, window size]. If not included or empty there
+    	will be no smoothing.""")
+    parser.add_argument('-k', '--kernel', default='box', 
+        choices=smoother.KERNELS, metavar='', 
+        help="""Smoothing kernel: 'box' for moving average (default), 
+        'savgol' for Savitzky-Golay with -s as [polynomial order, window] or 
+        'gaussian' with -s as [repeats, standard deviation in bins].""")
+    parser.add_argument('--smooth-voltages', default=0, type=int, 
+        metavar='', help="""Number of neighbouring voltages each ATD is 
+        also averaged over. Default is 0, no smoothing across voltages.""")
     parser.add_argument('-x', '--xlabels', default=[], type=str, metavar='', 
     	help="""Labels for x-axis of the area tracking plot (optional). Leave 
     	empty no x-axis labels. Should be given as a list of numbers.""")
@@ -157,37 +866,113 @@ def main():
     parser.add_argument('-r', '--repeats', default=5, type=int, metavar='', 
     	help="""Number of recursions (depth of analysis). Default (recommended) 
     	is 5.""")
+    parser.add_argument('-b', '--backend', default='stepwise', 
+        choices=optimisation.BACKENDS, metavar='',
+        help="""Fitting engine: 'stepwise' for the iterative optimiser 
+        (default), 'lsq' for joint least squares fitting of heights and 
+        standard deviations, 'batched' for the iterative optimiser run on 
+        all ATDs at once in one process, with the same fits as 'stepwise', 
+        'dictionary' for joint least squares fitting started from a solve 
+        over a bank of fixed width peaks. 'batched' pays off from about 8 
+        voltages and is slower with fewer.""")
+    parser.add_argument('--search', default='fixed', 
+        choices=optimisation.SEARCHES, metavar='', 
+        help="""Parameter search of the stepwise optimiser: 'fixed' steps 
+        (default) or 'adaptive' steps that grow and shrink with the distance
+        to the optimum. Cannot be combined with -g or -b batched.""")
+    parser.add_argument('-e', '--ensemble', default=0, type=int, metavar='',
+        help="""Number of jittered starting points of each ATD. The forward
+        and reverse chains of all starts are run at once on the workers and
+        the best fit is kept. Default is 0, a single start.""")
+    parser.add_argument('--support', default=0, type=float, metavar='',
+        help="""Evaluate peaks only within this many standard deviations of
+        their mean, e.g. 8, for long arrival time series with narrow peaks. 
+        Fits then differ slightly from the default: with 8, sds moved by up
+        to 0.03 and errors by up to 0.002 on the demo data. Default is 0,
+        the whole series. Cannot be combined with -g or -b batched.""")
+    parser.add_argument('-w', '--workers', default=1, type=int, metavar='', 
+        help="""Number of processes fitting ATDs in parallel. Default is 1. 
+        Cannot be combined with -g or -b batched.""")
+    parser.add_argument('--warm-start', action='store_true', 
+        help="""Include to also fit each ATD from the parameters of the 
+        previous voltage, keeping that fit unless its error is more than 5%% 
+        above the cold start error. The optimiser iterations the warm fits 
+        save against the cold fits are reported in the error log.""")
+    parser.add_argument('--stream', action='store_true', 
+        help="""Include to read the data one voltage at a time from a 
+        memory-mapped binary copy of the data file, for files too large to 
+        load whole. Cannot be combined with --align, -g or -b batched.""")
+    parser.add_argument('--no-plots', action='store_true', 
+        help="""Include to skip all plots. The error log is still written.""")
+    parser.add_argument('-f', '--plot-formats', default='png,svg', type=str, 
+        metavar='', help="""Comma separated image formats of the plots. 
+        Default is 'png,svg'.""")
+    parser.add_argument('-p', '--plot-workers', default=0, type=int, 
+        metavar='', help="""Number of processes rendering plots while the ATDs
+        are fitted. Default is 0, rendering after fitting.""")
+    parser.add_argument('--profile', action='store_true', 
+        help="""Include to record the time, iterations and exit reasons of 
+        every stage. The events are written to a _profile.jsonl file and 
+        summarised at the end of the error log.""")
+    parser.add_argument('-v', '--verbose', action='store_true', 
+        help="""Include to print progress messages.""")
+    parser.add_argument('-g', '--global-fit', action='store_true', 
+        help="""Include to fit all ATDs jointly, with the means (and 
+        standard deviations) shared across voltages. Gives consistent peaks
+        for population tracking.""")
+    parser.add_argument('--widths', default='shared', 
+        choices=optimisation.WIDTHS, metavar='', 
+        help="""Standard deviations of the global fit: 'shared' (default) 
+        by all ATDs or 'smooth' for each ATD, changing smoothly with 
+        voltage.""")
+    parser.add_argument('--criterion', default='bic', 
+        choices=optimisation.CRITERIA, metavar='', 
+        help="""Information criterion choosing the number of peaks in the 
+        'auto' mean mode: 'bic' (default) or 'aic'.""")
+    parser.add_argument('--fit-cache', action='store_true', 
+        help="""Include to reuse the fits of ATDs already fitted with the 
+        same settings in earlier runs. Not used with --warm-start or 
+        --global-fit.""")
+    parser.add_argument('--cache-size', default=fitcache.CACHE_SIZE, 
+        type=int, metavar='', help="""Number of fits kept in the fit cache. 
+        Default is %d.""" % fitcache.CACHE_SIZE)
     parser.add_argument('-a', '--align', action='store_true',  
     	help="""Include if the data should be aligned.""")
+    parser.add_argument('--align-method', default='max', 
+        choices=parse.ALIGN_METHODS, metavar='', 
+        help="""Alignment method: 'max' to line up the highest points 
+        (default), 'xcorr' for cross-correlation with sub-bin shifts.""")
     parser.add_argument('-i', '--areas', action='store_true',  
         help="""Include to output bar charts area percentage of individual 
         ATDs.""")
     args = parser.parse_args()
+    if args.stream and (args.global_fit or args.backend == 'batched'):
+        parser.error('--stream cannot be combined with -g or -b batched, '
+                'which fit all ATDs at once')
+    if (args.global_fit or args.backend == 'batched') and (args.search != 
+            'fixed' or args.support > 0 or args.workers > 1):
+        parser.error('--search, --support and -w cannot be combined with -g '
+                'or -b batched, which run in one process with fixed steps '
+                'over the whole series')
     # #Input filename of data file here without file extension
-    if (args.mean_mode)[0] != '[':
-		means = args.mean_mode
-    elif any([i for i in args.mean_mode if i =='.']):
-		means = [float(i) for i in args.mean_mode[1:-1].split(',')]	
-    else:
-		means = [int(i) for i in args.mean_mode[1:-1].split(',')]	
-    print means 
+    means = parse_means(args.mean_mode)
+    instrument.set_verbose(args.verbose)
+    instrument.log(means)
     filename = args.filename[:-4]
     title = args.title
     # #Identifier for result file
     res_filename = args.directory_label
-    # #Moving average smoothing in format: [window size, interval]. No smoothing 
-    # #if left empty
+    # #Moving average smoothing in format: [window size, interval]. No 
+    # #smoothing if left empty
     smooth = []
     if args.smooth != smooth:
     	smooth = [int(i) for i in args.smooth if unicode(i).isnumeric()]
-    # #Ticks for data on the area under the curve plot. Should correspond to the
-    # #voltages of the ATDs in the dataset.
+    # #Ticks for data on the area under the curve plot. Should correspond to 
+    # #the voltages of the ATDs in the dataset.
     xticks = [] 
     if args.xlabels != xticks:
     	#xticks = [int(i) for i in args.xlabels if unicode(i).isnumeric()]
-        xticks = args.xlabels
-        xticks = xticks.split(',')
-        xticks = [int(re.sub("[^0-9]", "", i)) for i in xticks]
+        xticks = parse_xticks(args.xlabels)
     # #Mode of mean determination: 'der' for second derivative, 'rel_max' for 
     # #relative maxima, [int, ..., int] for indices, [float, ..., float] for 
     # #numerical
@@ -195,11 +980,25 @@ def main():
     cycles = args.repeats
     aline = args.align
     indiv_areas = args.areas
+    backend = args.backend
+    workers = args.workers
+    warm_start = args.warm_start
+    stream = args.stream
+    plot_formats = [i.strip() for i in args.plot_formats.split(',') if 
+            i.strip()]
+    if args.no_plots:
+        plot_formats = []
     #If analysing a CIU dataset change ciu to True and aline to False.
     deconvolve(filename, res_filename, smooth, means, title, xticks, ciu, 
-        cycles, aline, indiv_areas)
-    print time.time() - start_time
-    print 'full time elapsed'
+        cycles, aline, indiv_areas, backend=backend, workers=workers, 
+        warm_start=warm_start, stream=stream, plot_formats=plot_formats, 
+        plot_workers=args.plot_workers, profile=args.profile, 
+        verbose=args.verbose, global_fit=args.global_fit, widths=args.widths, 
+        criterion=args.criterion, smooth_kernel=args.kernel, 
+        smooth_voltages=args.smooth_voltages, align_method=args.align_method,
+        fit_cache=args.fit_cache, cache_size=args.cache_size, 
+        search=args.search, ensemble=args.ensemble, support=args.support)
+    instrument.log('Full time elapsed:', time.time() - start_time)
 
 
 if __name__ == '__main__':
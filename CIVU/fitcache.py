@@ -0,0 +1,130 @@
+"""Persistent cache of the fits of single ATDs.
+
+Each fit of deconvolute.fit_voltage is stored in its own file, named after a
+hash of the smoothed ATD, the arrival times and the fit settings that change
+the result. A rerun with the same data and settings then reads the fit instead
+of fitting again, e.g. when only the means of a few voltages are changed. Files
+are touched when read, and evict removes the least recently used ones.
+
+
+Created by Simos Kalfas
+    email:simos.kalfas@gmail.com
+    github: https://github.com/simoskalfas/
+"""
+import cPickle
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+
+#Version of the fits, bump when the fitting changes to invalidate the cache
+CACHE_VERSION = 1
+
+#Folder of the cache, shared by all data files
+CACHE_DIR = '../Data/fit_cache/'
+
+#Number of fits kept by default
+CACHE_SIZE = 1000
+
+#Fit settings of deconvolute.fit_voltage that change the result. The means are
+#found from the smoothed ATD and the mean mode, so they are covered as well.
+KEY_SETTINGS = ['mean_mode', 'criterion', 'cycles', 'backend', 'search', 
+        'ensemble', 'support']
+
+
+def fit_key(intensities, arrival_time, settings):
+    """Hash identifying the fit of an ATD.
+
+    Args:
+        intensities: ATD curve after smoothing
+        arrival_time: Arrival time series
+        settings: Dictionary of fit settings, see deconvolute.fit_voltage
+
+    Returns:
+        Hexadecimal digest
+    """
+    digest = hashlib.sha1()
+    digest.update(json.dumps([CACHE_VERSION] + [settings[k] for k in
+            KEY_SETTINGS]))
+    digest.update(np.asarray(intensities, dtype=float).tobytes())
+    digest.update(np.asarray(arrival_time, dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+def fit_path(directory, key):
+    """Path of the file of a cached fit."""
+    return os.path.join(directory, key + '.fit')
+
+
+def load(directory, key):
+    """Reads a cached fit and marks it as recently used.
+
+    Args:
+        directory: Folder of the cache
+        key: Key of the fit, see fit_key
+
+    Returns:
+        fit: Cached fit, or None if it is not in the cache (or unreadable)
+    """
+    path = fit_path(directory, key)
+    try:
+        with open(path, 'rb') as f:
+            fit = cPickle.load(f)
+        os.utime(path, None)
+    except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+        return None
+    return fit
+
+
+def store(directory, key, fit):
+    """Writes a fit to the cache.
+
+    The file is written under a temporary name and then renamed, so that
+    processes reading the cache at the same time never see part of a fit.
+
+    Args:
+        directory: Folder of the cache
+        key: Key of the fit, see fit_key
+        fit: Results of deconvolute.fit_voltage
+
+    Returns:
+        Nothing
+    """
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError: #Made by another process in the meantime
+            pass
+    handle, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(handle, 'wb') as f:
+        cPickle.dump(fit, f, 2)
+    os.rename(temporary, fit_path(directory, key))
+
+
+def evict(directory, size=CACHE_SIZE):
+    """Removes the least recently used fits beyond the size of the cache.
+
+    Args:
+        directory: Folder of the cache
+        size(optional): Number of fits to keep
+
+    Returns:
+        Number of fits removed
+    """
+    if not os.path.isdir(directory):
+        return 0
+    paths = [os.path.join(directory, i) for i in os.listdir(directory) if
+            i.endswith('.fit')]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    for path in paths[size:]:
+        os.remove(path)
+    return max(0, len(paths) - size)
+
+
+def main():
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""Opt-in instrumentation of the deconvolution pipeline.
+
+The fitting functions take an optional stats dictionary (see
+optimisation.fit_atd). If it holds an 'events' list, each stage appends a
+dictionary describing what it did, e.g. its wall time, iterations and, for the
+optimiser, why each peak stopped. Without the list nothing is recorded.
+
+Progress messages go through log and are only printed if verbose output has
+been switched on with set_verbose.
+
+
+Created by Simos Kalfas
+    email:simos.kalfas@gmail.com
+    github: https://github.com/simoskalfas/
+"""
+
+import contextlib
+import json
+import time
+
+#If True, log prints its messages
+VERBOSE = False
+
+
+def set_verbose(verbose):
+    """Switches the progress messages of log on or off.
+
+    Args:
+        verbose: True to print the messages
+
+    Returns:
+        Nothing
+    """
+    global VERBOSE
+    VERBOSE = verbose
+
+
+def log(*parts):
+    """Prints a progress message if verbose output is switched on.
+
+    Args:
+        *parts: Parts of the message, joined with spaces
+
+    Returns:
+        Nothing
+    """
+    if VERBOSE:
+        print ' '.join([str(i) for i in parts])
+
+
+def new_stats(profile=False):
+    """Makes a stats dictionary for the fitting functions.
+
+    Args:
+        profile(optional): If True, events are recorded as well
+
+    Returns:
+        stats: {'iterations': 0}, with an empty 'events' list if profiling
+    """
+    stats = {'iterations': 0}
+    if profile:
+        stats['events'] = []
+    return stats
+
+
+def profiling(stats):
+    """True if events should be recorded in stats."""
+    return stats is not None and 'events' in stats
+
+
+def record(stats, stage, **fields):
+    """Records an event if profiling.
+
+    Args:
+        stats: Stats dictionary, see new_stats. May be None.
+        stage: Name of the stage, e.g. 'optimiser'
+        **fields: Values describing the event, e.g. time=0.1
+
+    Returns:
+        Nothing
+    """
+    if profiling(stats):
+        fields['stage'] = stage
+        stats['events'].append(fields)
+
+
+@contextlib.contextmanager
+def timed(stats, stage, **fields):
+    """Records the wall time of the enclosed block as an event if profiling.
+
+    Example:
+        with instrument.timed(stats, 'smooth'):
+            intensities = smoother.smooth(intensities, mode)
+
+    Args:
+        stats: Stats dictionary, see new_stats. May be None.
+        stage: Name of the stage
+        **fields: Further values describing the event
+
+    Yields:
+        Nothing
+    """
+    start_time = time.time()
+    yield
+    if profiling(stats):
+        record(stats, stage, time=time.time() - start_time, **fields)
+
+
+def summary(events):
+    """Sums up events by stage.
+
+    Args:
+        events: List of events, see record
+
+    Returns:
+        summary: Dictionary per stage
+            {stage: {'calls', 'time', 'iterations', 'exits'}}
+            exits counts the reasons the optimiser stopped for each peak.
+    """
+    stages = {}
+    for event in events:
+        total = stages.setdefault(event['stage'], {'calls': 0, 'time': 0.0,
+                'iterations': 0, 'exits': {}})
+        total['calls'] += 1
+        total['time'] += event.get('time', 0)
+        total['iterations'] += event.get('iterations', 0)
+        for reason in event.get('exits', []):
+            total['exits'][reason] = total['exits'].get(reason, 0) + 1
+    return stages
+
+
+def write_summary(f, events):
+    """Writes the summary of events as a table.
+
+    Args:
+        f: File already open when this function is called
+        events: List of events, see record
+
+    Returns:
+        Nothing
+    """
+    stages = summary(events)
+    f.write('Stage\tCalls\tTime (s)\tIterations\tExits\n')
+    for stage in sorted(stages, key=lambda i: -stages[i]['time']):
+        total = stages[stage]
+        f.write('\t'.join([stage, str(total['calls']), '%.4f' % total['time'],
+            str(total['iterations']), ', '.join([i + ': ' +
+            str(total['exits'][i]) for i in sorted(total['exits'])])]) + '\n')
+
+
+def write_events(path, events):
+    """Writes events to a JSON lines file, one event per line.
+
+    Args:
+        path: Path of the file
+        events: List of events, see record
+
+    Returns:
+        Nothing
+    """
+    with open(path, 'w') as f:
+        for event in events:
+            f.write(json.dumps(event, sort_keys=True) + '\n')
+
+
+def main():
+    return
+
+
+if __name__ == '__main__':
+    main()
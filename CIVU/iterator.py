@@ -1,5 +1,9 @@
-"""Iterates over directory with data. Requires very specific architecture and 
-the map file.
+"""Batch deconvolution of whole directories of datasets.
+
+The datasets are given either by a manifest or by a glob pattern over the 
+Data folder and are scheduled across a pool of worker processes. A summary 
+table with the timing, average error and population areas of every file is 
+written one level above the script, next to the results folders.
 
 
 Created by Simos Kalfas
@@ -7,74 +11,220 @@ Created by Simos Kalfas
     github: https://github.com/simoskalfas/
 """
 
-import Deconvolute_main
+import deconvolute
+import instrument
+import optimisation
+import utils
+import numpy as np
+import argparse
+import csv
+import glob
+import multiprocessing
+import os
+import re
 import time
 
 
-def smooth_iterator():
-	"""Iterator function.
-
-	This function was made to parse and analyse a specific data set. It is not
-	recomended to use. If it is required, a file in the style of 
-	Cyclic_means_full.tsv will need to be present in the same directory as the 
-	package directory. An example is provided. The parsing will have to be 
-	altered to produce appropriate titles.
-
-	Args:
-		None.
-
-	Returns:
-		Nothing.
-	"""
-	with open('../Cyclic_means_full.tsv', 'r') as f:
-		means = {}
-		for line in f:
-			l = line.replace('\n', '')
-			l = l.replace('[', '')
-			l = l.replace(']', '')
-			l = l.replace(' ', '')
-			l = l.split('\t')
-			l[1] = l[1].split(',')
-			l[2] = l[2].split('.')
-			l[2] = [int(i) for i in l[2]]
-			l[1] = [int(i) for i in l[1]]
-			means[l[0]] = [l[1], l[2]]
-	smooth = [3, 2]
-	res_filename = '_3_2_erind'
-	for key in means:
-		print key
-		filename = 'adc_' + key
-		title = key[::]
-		title = title.replace('_combined', '')
-		title = title.replace('_', ' ')
-		title = title.replace('blac', r'$\beta$' + 'Lac')
-		title = title.replace('cytc', 'CytC')
-		title = title.replace('cona', 'ConA')
-		title = title.replace('amac', 'AmAc buffer')
-		title = title.replace('wma', 'WMA buffer')
-		title = title.replace('trapBIAS', 'CIU')
-		title = title.replace('trapCE', 'CIU')
-		for i in range(len(title) - 1):
-			if title[i].isdigit() and not title[i+1].isdigit():
-				title = title[:i] + '+' + title[i:]
-				break
-		ciu=False
-		aline=True
-		if 'CIU' in title:
-			ciu=True
-			aline=False
-		Deconvolute_main.deconvolve(filename, res_filename, smooth, 
-			means[key][0], title, means[key][1], ciu=ciu, cycles=5, aline=aline)
+def parse_flag(text):
+    """Parses a yes/no manifest entry.
 
+    Args:
+        text: Manifest entry, e.g. 'yes', 'true', '1'
 
-def main():
-	start_time = time.time()
-	smooth_iterator()
-	print time.time() - start_time
-	print 'full time elapsed'
-	return
+    Returns:
+        True or False
+    """
+    return text.strip().lower() in ['yes', 'y', 'true', '1']
+
+
+def read_manifest(path, defaults):
+    """Reads a tab separated manifest of datasets.
+
+    The first line of the manifest is a header naming the columns. Only 'file'
+    is required. The optional columns are 'means', 'smooth', 'title', 'xticks',
+    'ciu' and 'align'; missing or empty entries take the default settings.
+    Example:
+        file    means   smooth  title
+        Demo_data_1 [70,85,100] [3,2]   Demo 1
+
+    Args:
+        path: Path of the manifest
+        defaults: Dictionary of default settings, see batch
+
+    Returns:
+        jobs: List of settings dictionaries, one per dataset
+    """
+    jobs = []
+    with open(path, 'r') as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            row = dict((k.strip(), v.strip()) for k, v in row.items() if
+                    k is not None and v is not None)
+            job = dict(defaults)
+            job['file'] = os.path.splitext(row['file'])[0]
+            job['title'] = job['file']
+            if row.get('means'):
+                job['means'] = deconvolute.parse_means(row['means'])
+            if row.get('smooth'):
+                job['smooth'] = [int(i) for i in re.findall(r'\d+',
+                        row['smooth'])]
+            if row.get('title'):
+                job['title'] = row['title']
+            if row.get('xticks'):
+                job['xticks'] = deconvolute.parse_xticks(row['xticks'])
+            if row.get('ciu'):
+                job['ciu'] = parse_flag(row['ciu'])
+            if row.get('align'):
+                job['align'] = parse_flag(row['align'])
+            jobs.append(job)
+    return jobs
+
+
+def glob_jobs(pattern, defaults):
+    """Makes a job for every data file matching a pattern in the Data folder.
+
+    Args:
+        pattern: Glob pattern, e.g. '*.txt' or 'Demo_data_*.txt'
+        defaults: Dictionary of default settings, see batch
+
+    Returns:
+        jobs: List of settings dictionaries, one per dataset
+    """
+    jobs = []
+    files = [os.path.basename(i) for i in glob.glob('../Data/' + pattern)]
+    for name in sorted(files, key=utils.natural_keys):
+        job = dict(defaults)
+        job['file'] = os.path.splitext(name)[0]
+        job['title'] = job['file']
+        jobs.append(job)
+    return jobs
 
 
+def run_job(job):
+    """Deconvolutes a single dataset. Runs in a worker process.
+
+    Args:
+        job: Settings dictionary, see batch
+
+    Returns:
+        summary: Dictionary with the timing, average error and areas of the
+            dataset
+            {'file', 'title', 'time', 'error', 'voltages', 'areas', 'status'}
+    """
+    start_time = time.time()
+    summary = {'file': job['file'], 'title': job['title'], 'error': None,
+            'voltages': [], 'areas': [], 'status': 'ok'}
+    try:
+        retdic = deconvolute.deconvolve(job['file'], job['label'],
+                job['smooth'], job['means'], job['title'], job['xticks'],
+                job['ciu'], job['cycles'], job['align'], False,
+                backend=job['backend'], workers=1,
+                plot_formats=job['plot_formats'], verbose=job['verbose'])
+    except Exception as e:  #One broken file should not stop the batch
+        summary['status'] = type(e).__name__ + ': ' + str(e)
+    else:
+        voltages = sorted(retdic, key=utils.natural_keys)
+        summary['voltages'] = voltages
+        summary['areas'] = [retdic[i]['areas'] for i in voltages]
+        summary['error'] = np.average([retdic[i]['min_error'] for i in
+                voltages])
+    summary['time'] = time.time() - start_time
+    return summary
+
+
+def batch(jobs, label, workers=1):
+    """Deconvolutes a list of datasets and writes a summary table.
+
+    Each dataset is processed with deconvolute.deconvolve, one dataset per
+    worker process. The summary table is written in the order of the jobs as
+    the results come in.
+
+    Args:
+        jobs: List of settings dictionaries, one per dataset
+            {'file', 'means', 'smooth', 'title', 'xticks', 'ciu', 'align',
+            'cycles', 'backend', 'label', 'plot_formats', 'verbose'}
+        label: Identifier of the summary table
+        workers: Number of datasets processed in parallel
+
+    Returns:
+        summaries: List of summary dictionaries, see run_job
+    """
+    script_dir = os.path.abspath(os.path.join(__file__, "../.."))
+    table = os.path.join(script_dir, 'batch_summary' + label + '.tsv')
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap(run_job, jobs)
+    else:
+        results = (run_job(job) for job in jobs)
+    summaries = []
+    with open(table, 'w') as f:
+        f.write('File\tTitle\tTime (s)\tAverage error\tVoltages\tAreas\t'
+                'Status\n')
+        for summary in results:
+            areas = [[round(a, 3) for a in i] for i in summary['areas']]
+            f.write('\t'.join([summary['file'], summary['title'],
+                '%.3f' % summary['time'], str(summary['error']),
+                ','.join(summary['voltages']), str(areas),
+                summary['status']]) + '\n')
+            f.flush()
+            summaries.append(summary)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return summaries
+
+
+def main():
+    start_time = time.time()
+    parser = argparse.ArgumentParser(description="""Batch Gaussian
+        deconvolution of the datasets in the Data folder.""")
+    parser.add_argument('directory_label', type=str, help="""Label for the
+        results directories and the summary table.""")
+    parser.add_argument('-m', '--manifest', default='', type=str, metavar='',
+        help="""Tab separated manifest with a header line. Columns: file
+        (required), means, smooth, title, xticks, ciu, align. Empty entries
+        take the defaults below.""")
+    parser.add_argument('-g', '--glob', default='*.txt', type=str, metavar='',
+        help="""Pattern of data files in the Data folder, used if no manifest
+        is given. Default is '*.txt'.""")
+    parser.add_argument('-n', '--means', default='der', type=str, metavar='',
+        help="""Default mode of mean determination, see deconvolute.py. Default
+        is 'der'.""")
+    parser.add_argument('-s', '--smooth', default='', type=str, metavar='',
+        help="""Default smoothing as [window size, interval]. No smoothing if
+        left empty.""")
+    parser.add_argument('-c', '--not_ciu', action='store_true',
+        help="""Include if data is not CIU.""")
+    parser.add_argument('-a', '--align', action='store_true',
+        help="""Include if the data should be aligned.""")
+    parser.add_argument('-r', '--repeats', default=5, type=int, metavar='',
+        help="""Number of recursions (depth of analysis). Default is 5.""")
+    parser.add_argument('-b', '--backend', default='stepwise',
+        choices=optimisation.BACKENDS, metavar='',
+        help="""Fitting engine, see deconvolute.py. Default is 'stepwise'.""")
+    parser.add_argument('--no-plots', action='store_true',
+        help="""Include to skip all plots, only the error logs and summary
+        table are written.""")
+    parser.add_argument('-w', '--workers', default=1, type=int, metavar='',
+        help="""Number of datasets processed in parallel. Default is 1.""")
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help="""Include to print progress messages.""")
+    args = parser.parse_args()
+    instrument.set_verbose(args.verbose)
+    defaults = {'means': deconvolute.parse_means(args.means),
+            'smooth': [int(i) for i in re.findall(r'\d+', args.smooth)],
+            'xticks': [], 'ciu': not args.not_ciu, 'align': args.align,
+            'cycles': args.repeats, 'backend': args.backend,
+            'label': args.directory_label, 'verbose': args.verbose,
+            'plot_formats': [] if args.no_plots else utils.PLOT_FORMATS}
+    if args.manifest:
+        jobs = read_manifest(args.manifest, defaults)
+    else:
+        jobs = glob_jobs(args.glob, defaults)
+    batch(jobs, args.directory_label, args.workers)
+    instrument.log('Full time elapsed:', time.time() - start_time)
+    return
+
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -9,8 +9,36 @@ Created by Simos Kalfas
 """ 
 
 import time
+import collections
+import numpy as np
+from scipy.optimize import least_squares, nnls
+from scipy import sparse
 import utils
-from operator import add
+import instrument
+
+#Fitting engines selectable in deconvolute.deconvolve
+BACKENDS = ['stepwise', 'lsq', 'batched', 'dictionary']
+
+#Width models of global_fit
+WIDTHS = ['shared', 'smooth']
+
+#Information criteria of select_means
+CRITERIA = ['bic', 'aic']
+
+#Parameter searches of optimiser
+SEARCHES = ['fixed', 'adaptive']
+
+#Largest move of a mean between the starts of ensemble_starts, in bins
+ENSEMBLE_JITTER = 2
+
+#Number of standard deviations in the basis bank of dictionary_fit
+BANK_WIDTHS = 32
+
+#Number of arrival time grids whose basis banks are kept, see basis_bank
+BANK_CACHE = 8
+
+#Basis banks by arrival time grid, most recently used last
+_banks = collections.OrderedDict()
 
 
 
@@ -37,7 +65,8 @@ def windowmaker(x, means, direction):
         return windowlist[::-1]
 
 
-def run_opt_cycles(num, x, goal, initial_sd, initial_h, means, threshold=0):
+def run_opt_cycles(num, x, goal, initial_sd, initial_h, means, threshold=0, 
+        stats=None, search='fixed', support=0):
     """Handles iterative optimisation.
 
     Each cycle entails optimisation of the standard deviation for each peak
@@ -54,6 +83,12 @@ def run_opt_cycles(num, x, goal, initial_sd, initial_h, means, threshold=0):
         means: Mean values.
         threshold: Error threshold to stop optimisation. If left 0 the cycles 
             will run to the iteration limit.
+        stats(optional): Dictionary updated with the number of optimiser 
+            'iterations'
+        search(optional): Parameter search of optimiser, 'fixed' (default) 
+            or 'adaptive'
+        support(optional): Support of the peaks in standard deviations, see
+            optimiser. 0 (default) for the whole arrival time series.
 
     Returns:
         fitted_parameters_f: Parameters for forward Gaussian peaks.
@@ -64,40 +99,290 @@ def run_opt_cycles(num, x, goal, initial_sd, initial_h, means, threshold=0):
         fit_r: Sum of fitted peaks for reverse method
     """
     opt_time = time.time()
-    sd_f = initial_sd[::]
-    heights_f = initial_h[::]
+    fitted_parameters_f, fit_f = run_chain(num, x, goal, initial_sd, 
+            initial_h, means, threshold, 'f', stats, search, support)
+    fitted_parameters_r, fit_r = run_chain(num, x, goal, initial_sd, 
+            initial_h, means, threshold, 'r', stats, search, support)
+    instrument.log('optimisation time = ' + str(time.time() - opt_time))
+    return fitted_parameters_f, fit_f, fitted_parameters_r, fit_r
+
+
+def run_chain(num, x, goal, initial_sd, initial_h, means, threshold=0, 
+        direction='f', stats=None, search='fixed', support=0):
+    """Runs the optimisation cycles of run_opt_cycles in one direction.
+
+    The forward and reverse chains do not depend on each other, so they can 
+    be run apart, e.g. in different processes (see ensemble_fit).
+
+    Args:
+        num: Number of cycles
+        x: Arrival time series
+        goal: Given distribution
+        initial_sd: Initial standard deviation values
+        initial_h: Initial height values
+        means: Mean values as indices
+        threshold(optional): Error threshold to stop optimisation
+        direction(optional): 'f' for forward, 'r' for reverse optimisation
+        stats(optional): Dictionary updated with the number of optimiser 
+            'iterations'
+        search(optional): Parameter search of optimiser
+        support(optional): Support of the peaks, see optimiser
+
+    Returns:
+        fitted_parameters: Parameters of the peaks [[height1, mean1, sd1], ...]
+        fit: Sum of the fitted peaks
+    """
+    sds = initial_sd[::]
+    heights = initial_h[::]
     #Standard deviations are optimised with initial height values.
-    fitted_parameters_f, fit_f = optimiser(x, goal, sd_f, heights_f, means,
-            threshold, 'sd', 'f')
-    sd_f = [s[2] for s in fitted_parameters_f] #Update values
-    sd_r = initial_sd[::]
-    heights_r = initial_h[::]
-    fitted_parameters_r, fit_r = optimiser(x, goal, sd_r, heights_r, means, 
-            threshold, 'sd', 'r')
-    sd_r = [s[2] for s in fitted_parameters_r]
+    fitted_parameters, fit = optimiser(x, goal, sds, heights, means, 
+            threshold, 'sd', direction, stats, search, support)
+    sds = [s[2] for s in fitted_parameters] #Update values
     for _ in range(num):
-        fitted_parameters_f, fit_f = optimiser(x, goal, sd_f, heights_f, means, 
-                threshold, 'h', 'f')
-        heights_f = [h[0] for h in fitted_parameters_f]
-        fitted_parameters_f, fit_f = optimiser(x, goal, sd_f, heights_f, means, 
-                threshold, 'sd', 'f')
-        sd_f = [s[2] for s in fitted_parameters_f]
-        fitted_parameters_r, fit_r = optimiser(x, goal, sd_r, heights_r, means, 
-                threshold, 'h', 'r')
-        heights_r = [h[0] for h in fitted_parameters_r]
-        fitted_parameters_r, fit_r = optimiser(x, goal, sd_r, heights_r, means, 
-                threshold, 'sd', 'r')
-        sd_r = [s[2] for s in fitted_parameters_r]
-    print 'optimisation time = ' + str(time.time() - opt_time)
-    return fitted_parameters_f, fit_f, fitted_parameters_r, fit_r
+        fitted_parameters, fit = optimiser(x, goal, sds, heights, means, 
+                threshold, 'h', direction, stats, search, support)
+        heights = [h[0] for h in fitted_parameters]
+        fitted_parameters, fit = optimiser(x, goal, sds, heights, means, 
+                threshold, 'sd', direction, stats, search, support)
+        sds = [s[2] for s in fitted_parameters]
+    return fitted_parameters, fit
+
+
+def ensemble_starts(x, goal, means, size, jitter=ENSEMBLE_JITTER, seed=0):
+    """Makes the starting points of an ensemble fit.
+
+    The first start is the usual cold start: narrow peaks at the intensities
+    of the means. Every other start moves each mean by up to jitter bins and 
+    starts all peaks from the next width of a geometric grid, from the cold 
+    start width up to a twentieth of the drift range. Starts whose moved means
+    would merge keep the given means. The same arguments always give the same 
+    starts.
+
+    Args:
+        x: Arrival time series
+        goal: Given distribution
+        means: Mean values as indices, in ascending order
+        size: Number of starts
+        jitter(optional): Largest move of a mean, in bins
+        seed(optional): Seed of the random moves
+
+    Returns:
+        starts: List of (means, initial_sd, initial_h)
+    """
+    random = np.random.RandomState(seed)
+    widths = np.geomspace(0.01, max(0.01, (x[-1] - x[0]) / 20.0), 
+            max(size, 2))
+    starts = []
+    for i in range(size):
+        start_means = list(means)
+        if i > 0:
+            moves = random.randint(-jitter, jitter + 1, len(means))
+            moved = [int(min(max(m + d, 0), len(x) - 1)) for m, d in 
+                    zip(means, moves)]
+            if len(set(moved)) == len(moved):
+                start_means = sorted(moved)
+        starts.append((start_means, [float(widths[i]) for _ in means], 
+                [goal[m] for m in start_means]))
+    return starts
+
+
+def chain_job(job):
+    """Runs one chain of an ensemble fit, see run_chain.
+
+    Kept at module level so that it can be sent to worker processes.
+
+    Args:
+        job: Tuple of (num, x, goal, initial_sd, initial_h, means, threshold,
+            direction, profile, search, support)
+
+    Returns:
+        fitted_parameters, fit: Same as run_chain
+        stats: Stats of the chain, see instrument.new_stats
+    """
+    num, x, goal, initial_sd, initial_h, means, threshold, direction, \
+            profile, search, support = job
+    stats = instrument.new_stats(profile)
+    fitted_parameters, fit = run_chain(num, x, goal, initial_sd, initial_h, 
+            means, threshold, direction, stats, search, support)
+    return fitted_parameters, fit, stats
+
+
+def ensemble_fit(num, x, goal, starts, threshold=0, stats=None, 
+        search='fixed', support=0, pool=None):
+    """Fits an ATD from several starting points.
+
+    The forward and reverse chains of every start are independent, so with a 
+    pool they all run at once, and the ensemble takes about the wall time of 
+    its slowest chain.
+
+    Args:
+        num: Number of cycles
+        x: Arrival time series
+        goal: Given distribution
+        starts: Starting points, see ensemble_starts
+        threshold(optional): Error threshold to stop optimisation
+        stats(optional): Dictionary updated with the number of optimiser 
+            'iterations' of all chains
+        search(optional): Parameter search of optimiser
+        support(optional): Support of the peaks, see optimiser
+        pool(optional): multiprocessing.Pool running the chains. If None the
+            chains are run one after another.
+
+    Returns:
+        results: One tuple per start, same as run_opt_cycles
+    """
+    opt_time = time.time()
+    profile = instrument.profiling(stats)
+    jobs = [(num, x, goal, initial_sd, initial_h, means, threshold, direction,
+            profile, search, support) for means, initial_sd, initial_h in 
+            starts for direction in ['f', 'r']]
+    chains = map(chain_job, jobs) if pool is None else pool.map(chain_job, 
+            jobs)
+    if stats is not None:
+        for _, _, chain_stats in chains:
+            stats['iterations'] += chain_stats['iterations']
+            if profile:
+                stats['events'].extend(chain_stats['events'])
+    instrument.log('optimisation time = ' + str(time.time() - opt_time))
+    return [chains[i][:2] + chains[i + 1][:2] for i in range(0, len(chains), 
+            2)]
+
+
+def window_error(peak, fit, curve):
+    """Calculates the error of a candidate peak over an optimisation window.
+
+    The RMSD between the fit with the candidate added and the distribution 
+    within the window. The operations are those of utils.rmsd on the full 
+    fit, in the same order, so the errors are the same to the last bit and 
+    the optimiser settles near ties as it would on the full fit.
+
+    Args:
+        peak: Candidate peak evaluated over the window
+        fit: Sum of the fixed peaks over the same window
+        curve: Distribution over the same window
+
+    Returns:
+        RMSD value
+    """
+    return np.sqrt((((fit + peak) - curve) ** 2).mean())
+
+
+def truncated_window_error(x_window, params, residual, tails, support):
+    """Calculates window_error with the peak evaluated only within its support.
+
+    Outside the support the peak is taken as 0, so the error there is the sum
+    of squares of the residual before and after the support, read from its 
+    sums from the start and from the end of the window (see residual_tails).
+    The cost therefore depends on the width of the peak and not on the 
+    window.
+
+    Args:
+        x_window: Arrival times of the window
+        params: Parameters of the candidate peak [height, mean, sd]
+        residual: Distribution minus the fixed peaks over the window
+        tails: Sums of the squared residual, see residual_tails
+        support: Half width of the support in standard deviations, see 
+            utils.peak_support
+
+    Returns:
+        RMSD value
+    """
+    start, end = utils.peak_support(x_window, params[1], params[2], support)
+    peak = utils.gaussian(x_window[start:end], *params)
+    inside = ((peak - residual[start:end]) ** 2).sum()
+    before, after = tails
+    return np.sqrt((inside + before[start] + after[end]) / len(residual))
+
+
+def residual_tails(residual):
+    """Sums of the squared residual for truncated_window_error.
+
+    The sums before and after a support are accumulated separately, from 
+    either end, instead of being taken as differences of one cumulative sum,
+    which would lose the small tails to cancellation against the whole sum.
+
+    Args:
+        residual: Distribution minus the fixed peaks over the window
+
+    Returns:
+        before: Array, before[i] is the sum over residual[:i]
+        after: Array, after[i] is the sum over residual[i:]
+    """
+    squares = residual ** 2
+    before = np.concatenate([[0.0], np.cumsum(squares)])
+    after = np.concatenate([np.cumsum(squares[::-1])[::-1], [0.0]])
+    return before, after
+
+
+def add_peak(fit, x, params, support):
+    """Adds a fitted peak to the fit, within its support if support > 0."""
+    if support > 0:
+        utils.add_gaussian(fit, x, *params, k=support)
+    else:
+        fit += utils.gaussian(x, *params)
 
 
-def optimiser(x, curve, sd, heights, mean_indices, threshold, parameter, direction):
+def line_search(error_function, value, step, lower, upper, threshold, 
+        tolerance, max_evaluations=100):
+    """Minimises an error over one parameter with growing and shrinking steps.
+
+    From the starting value, a step is tried up and down (the last successful
+    direction first). A step that lowers the error (or keeps it, going up) is 
+    taken and doubled, if neither does the step is halved. The search ends 
+    when the step is below the tolerance, the error reaches the threshold or 
+    the evaluations run out.
+    Steps therefore adapt to the scale of the parameter, and the optimum is 
+    found in a few tens of evaluations whether it is near or far.
+
+    Args:
+        error_function: Function of the parameter value returning the error
+        value: Starting value
+        step: Starting step
+        lower: Values must be above this bound
+        upper: Values must not exceed this bound
+        threshold: Error threshold to stop the search
+        tolerance: Smallest step
+        max_evaluations(optional): Largest number of error evaluations
+
+    Returns:
+        value: Value with the lowest error found
+        error: Its error
+        evaluations: Number of error evaluations
+        exit_reason: 'threshold', 'converged' or 'limit'
+    """
+    error = error_function(value)
+    evaluations = 1
+    sign = 1
+    while error > threshold:
+        if step < tolerance:
+            return value, error, evaluations, 'converged'
+        improved = False
+        for direction in [sign, -sign]:
+            candidate = min(value + direction * step, upper)
+            if candidate <= lower or candidate == value:
+                continue
+            if evaluations == max_evaluations:
+                return value, error, evaluations, 'limit'
+            candidate_error = error_function(candidate)
+            evaluations += 1
+            #Ties go up, as in the fixed search, to leave flat regions such as
+            #peaks narrower than the arrival time step
+            if candidate_error < error or (candidate_error == error and 
+                    direction > 0):
+                value, error, sign = candidate, candidate_error, direction
+                improved = True
+                break
+        step = step * 2 if improved else step / 2
+    return value, error, evaluations, 'threshold'
+
+
+def optimiser(x, curve, sd, heights, mean_indices, threshold, parameter, 
+        direction, stats=None, search='fixed', support=0):
     """Main optimisation function.
 
-    Optimises the value of the chosen parameter with the rest constant. The main
-    loop can be changed to allow for more iterations. However, this is rarely 
-    useful except if the iteration step is drastically reduced.
+    Optimises the value of the chosen parameter with the rest constant. The 
+    main loop can be changed to allow for more iterations. However, this is 
+    rarely useful except if the iteration step is drastically reduced.
     
     Args:
         x: Arrival time series
@@ -111,12 +396,35 @@ def optimiser(x, curve, sd, heights, mean_indices, threshold, parameter, directi
                    'h' to optimise height
         direction: 'f' for forward optimisation
                    'r' for reverse optimisation
+        stats(optional): Dictionary updated with the number of 'iterations'.
+            If profiling (see instrument.new_stats), an 'optimiser' event is
+            recorded with the time, iterations and, for each peak, the reason
+            the search stopped ('threshold', 'oscillation', 'converged' or 
+            'limit'), the final window error and the number of 'evaluations'
+            of the window error.
+        search(optional): 'fixed' (default) to move the parameter by a fixed
+            step until the error oscillates or 200 steps are taken, 
+            'adaptive' to search with expanding and shrinking steps (see 
+            line_search) down to a tenth of the fixed step. Each 
+            evaluation of the adaptive search counts as an iteration.
+        support(optional): If more than 0, peaks are only evaluated within
+            this many standard deviations of their mean (see 
+            truncated_window_error and utils.add_gaussian), so that narrow
+            peaks on long arrival time series are cheap. 0 (default) 
+            evaluates them over the whole window. Each evaluated peak is 
+            off by less than exp(-support**2 / 2) of its height, but the 
+            fitted parameters are not the same as with 0: the search 
+            settles near ties at the level of rounding, so these small 
+            changes can move a parameter by a few steps. With support 8 on
+            the demo data, sds moved by up to 0.03 and errors by up to 
+            0.002. Below about 6 the changes grow quickly.
 
     Returns:
         parameter_lists: List of optimised parameters 
             [[height1, mean1, sd1], ...]
         fit: Sum of fitted gaussians
 """
+    opt_time = time.time()
     windows = windowmaker(x, mean_indices, direction) #Create windows
     num_means = [x[i] for i in mean_indices]  #Get numerical means
     norm_factor = 100 / max(curve)  #Scale factor for unnormalised data
@@ -133,22 +441,70 @@ def optimiser(x, curve, sd, heights, mean_indices, threshold, parameter, directi
             range(len(heights))]
     if direction == 'r':
         parameter_lists = parameter_lists[::-1]
-    fit = [0 * value for value in curve]
+    x = np.asarray(x, dtype=float)
+    curve = np.asarray(curve, dtype=float)
+    curve_max = curve.max()
+    fit = np.zeros(len(curve))
+    residual_buffer = np.empty(len(curve))
     prev_params = []
+    exits = []
+    final_errors = []
+    evaluations = []
+    iterations = 0
     for i in range(len(parameter_lists)): #Iterate over peaks
         params = parameter_lists[i]
-        cur_gaussian = utils.gaussian(x, *params)
-        cur_fit = map(add, fit, cur_gaussian)
-        cur_window_opt = curve[windows[i][0]:windows[i][1]]
-        error = utils.rmsd(cur_fit[windows[i][0]:windows[i][1]], cur_window_opt) 
+        start, end = windows[i]
+        x_window = x[start:end]
+        if support > 0:
+            #Part of the window not yet explained by the previously fitted 
+            #peaks. Only the contribution of the current peak changes from 
+            #here on.
+            residual = residual_buffer[:len(x_window)]
+            np.subtract(curve[start:end], fit[start:end], out=residual)
+            tails = residual_tails(residual)
+            def peak_error(peak_params):
+                return truncated_window_error(x_window, peak_params, residual,
+                        tails, support)
+        else: #The fit only changes once the peak has converged
+            fit_window = fit[start:end]
+            curve_window = curve[start:end]
+            def peak_error(peak_params):
+                return window_error(utils.gaussian(x_window, *peak_params), 
+                        fit_window, curve_window)
+        if search == 'adaptive':
+            def trial_error(value):
+                trial = params[::]
+                trial[optimisation_index] = value
+                return peak_error(trial)
+            #Within the reach of the fixed search (200 steps) and the bounds
+            #of the parameter
+            value = params[optimisation_index]
+            reach = 200 * fluctuation_factor
+            upper = min(value + reach, {0: curve_max, 1: x_window[-1], 
+                    2: x[-1] - x[0]}[optimisation_index])
+            lower = max(value - reach, {0: 0, 1: x_window[0], 
+                    2: 0}[optimisation_index])
+            value, error, j, exit_reason = line_search(trial_error, value, 
+                    fluctuation_factor, lower, upper, threshold, 
+                    fluctuation_factor / 10)
+            params[optimisation_index] = value
+            add_peak(fit, x, params, support)
+            parameter_lists[i] = params
+            iterations += j
+            exits.append(exit_reason)
+            final_errors.append(error)
+            evaluations.append(j)
+            continue
+        error = peak_error(params)
         minimum_error = max(heights) * 100  #Initial value for minimum error 
-        min_error_parameter = None  #Initial parameter value at the minimum error
+        min_error_parameter = None  #Parameter value at the minimum error
         j = 0 
         prev_params = []
+        exit_reason = 'threshold'
         while error > threshold and j < 201:
             if j == 200: #Iteration limit
                 params[optimisation_index] = min_error_parameter
-                cur_gaussian = utils.gaussian(x, *params)
+                exit_reason = 'limit'
                 break
             up_par = params[optimisation_index] + fluctuation_factor
             up_params = params[::]
@@ -156,42 +512,912 @@ def optimiser(x, curve, sd, heights, mean_indices, threshold, parameter, directi
             if down_par <= 0: #Ensuring the parameter values stay over 0
                 down_par = up_par
             if parameter == 'h': #Ensuring height does not exceed maximum
-                if up_par > max(curve):
+                if up_par > curve_max:
                     up_par = down_par
             up_params[optimisation_index] = up_par
-            up_gaus = utils.gaussian(x, *up_params)
+            up_error = peak_error(up_params)
             down_params = params[::]
             down_params[optimisation_index] = down_par
-            down_gaus = utils.gaussian(x, *down_params)
-            up_cur_fit = map(add, fit, up_gaus)
-            down_cur_fit = map(add, fit, down_gaus)
+            down_error = peak_error(down_params)
             #Checking if incrementing down or up is better (gives lower error)
-            if utils.rmsd(up_cur_fit[windows[i][0]:windows[i][1]], 
-                cur_window_opt) > utils.rmsd(down_cur_fit[windows[i][0]:windows[i][1]],
-                    cur_window_opt) and down_params[optimisation_index] > 0:
+            if up_error > down_error and down_params[optimisation_index] > 0:
                 params = down_params
+                error = down_error
             else:
                 params = up_params
-            cur_gaussian = utils.gaussian(x, *params) #Update current peak shape
-            cur_fit = map(add, fit, cur_gaussian)   #Update current sum
-            error = utils.rmsd(cur_fit[windows[i][0]:windows[i][1]], 
-                    cur_window_opt) #Update current error
-            if error < minimum_error: #Check if the current error is the minimum 
+                error = up_error
+            if error < minimum_error: #Check if the error is the minimum 
                 minimum_error = error
-                min_error_parameter = params[optimisation_index] #Update optimal 
+                min_error_parameter = params[optimisation_index] #Optimum
             if j > 2 and prev_params[-2] == params[optimisation_index]:
                 params[optimisation_index] = min_error_parameter
-                cur_gaussian = utils.gaussian(x, *params)
+                exit_reason = 'oscillation'
                 break
             prev_params.append(params[optimisation_index])
             j += 1
-        fit = map(add, fit, cur_gaussian)
+        add_peak(fit, x, params, support)
         parameter_lists[i] = params
+        iterations += j
+        exits.append(exit_reason)
+        final_errors.append(error if exit_reason == 'threshold' else 
+                minimum_error)
+        evaluations.append(2 * j + 1)
+    if stats is not None:
+        stats['iterations'] = stats.get('iterations', 0) + iterations
     if direction == 'r': #Reverse list for reverse results
         parameter_lists = parameter_lists[::-1]
+        exits = exits[::-1]
+        final_errors = final_errors[::-1]
+        evaluations = evaluations[::-1]
+    instrument.record(stats, 'optimiser', parameter=parameter, 
+            direction=direction, time=time.time() - opt_time, 
+            iterations=iterations, exits=exits, 
+            errors=[float(e) for e in final_errors], evaluations=evaluations)
     return parameter_lists, fit
 
 
+def fit_atd(backend, num, x, goal, initial_sd, initial_h, means, threshold=0, 
+        stats=None, search='fixed', support=0):
+    """Fits a single ATD with the chosen fitting engine.
+
+    Args:
+        backend: 'stepwise' for the iterative coordinate optimiser 
+                    (run_opt_cycles), kept as the reference engine
+                 'lsq' for joint least squares fitting (least_squares_fit)
+                 'batched' for the same optimiser as 'stepwise' run with 
+                    batch_fit, with the same results, meant for many ATDs 
+                    at once
+                 'dictionary' for one non-negative least squares solve over
+                    a bank of fixed width peaks, refined by one joint least
+                    squares pass (dictionary_fit)
+        num: Number of cycles (stepwise and batched only)
+        x: Arrival time series
+        goal: Given distribution
+        initial_sd: Initial standard deviation values
+        initial_h: Initial height values
+        means: Mean values as indices
+        threshold: Error threshold to stop optimisation (stepwise and batched 
+            only)
+        stats(optional): Dictionary updated with the number of 'iterations' 
+            used by the engine
+        search(optional): Parameter search of optimiser, 'fixed' (default) 
+            or 'adaptive' (stepwise only)
+        support(optional): Support of the peaks in standard deviations, see 
+            optimiser (stepwise only). 0 (default) for the whole series.
+
+    Returns:
+        Same as run_opt_cycles
+    """
+    if backend == 'stepwise':
+        return run_opt_cycles(num, x, goal, initial_sd, initial_h, means, 
+                threshold, stats, search, support)
+    elif backend == 'lsq':
+        return least_squares_fit(x, goal, initial_sd, initial_h, means, stats)
+    elif backend == 'batched':
+        return batch_fit(num, x, [goal], [initial_sd], [initial_h], [means], 
+                threshold, stats)[0]
+    elif backend == 'dictionary':
+        return dictionary_fit(x, goal, means, stats)
+    raise ValueError('Unknown fitting backend: ' + str(backend))
+
+
+def least_squares_fit(x, goal, initial_sd, initial_h, means, stats=None):
+    """Fits heights and standard deviations of all peaks jointly.
+
+    The means are kept fixed. For the starting standard deviations the heights
+    are a linear problem and are first solved with non-negative least squares. 
+    Heights and standard deviations are then refined together by bounded 
+    nonlinear least squares with an analytic Jacobian. There is no direction 
+    of fitting, so the forward and reverse results are the same.
+
+    Args:
+        x: Arrival time series
+        goal: Given distribution
+        initial_sd: Initial standard deviation values. Values narrower than 
+            the arrival time step are widened to the step.
+        initial_h: Initial height values. Only used if the linear solve fails.
+        means: Mean values as indices
+        stats(optional): Dictionary updated with the number of 'iterations', 
+            counted as evaluations of the residuals. If profiling, an 'lsq' 
+            event is recorded with the time, iterations and the exit reason 
+            ('converged' or 'limit').
+
+    Returns:
+        Same as run_opt_cycles
+    """
+    opt_time = time.time()
+    x = np.asarray(x, dtype=float)
+    goal = np.asarray(goal, dtype=float)
+    num_means = x[list(means)]
+    num_peaks = len(num_means)
+    step = np.median(np.diff(x))
+    sds = np.maximum(np.asarray(initial_sd, dtype=float), step)
+    shapes = utils.gaussians(x, np.column_stack([np.ones(num_peaks), 
+            num_means, sds]))
+    try:
+        heights = nnls(shapes.T, goal)[0]
+    except RuntimeError:  #Iteration limit of the linear solve
+        heights = np.asarray(initial_h, dtype=float)
+    heights = np.minimum(heights, goal.max())
+    lower = np.concatenate([np.zeros(num_peaks), 
+            np.ones(num_peaks) * step / 10])
+    upper = np.concatenate([np.ones(num_peaks) * goal.max(), 
+            np.ones(num_peaks) * (x[-1] - x[0])])
+    start = np.clip(np.concatenate([heights, sds]), lower, upper)
+    solution = least_squares(_lsq_residuals, start, jac=_lsq_jacobian, 
+            bounds=(lower, upper), args=(x, goal, num_means))
+    if stats is not None:
+        stats['iterations'] = stats.get('iterations', 0) + solution.nfev
+    heights = solution.x[:num_peaks]
+    sds = solution.x[num_peaks:]
+    fitted_parameters = [[heights[i], num_means[i], sds[i]] for i in 
+            range(num_peaks)]
+    fit = utils.mixture(x, fitted_parameters)
+    instrument.record(stats, 'lsq', time=time.time() - opt_time, 
+            iterations=int(solution.nfev), 
+            exits=['converged' if solution.status > 0 else 'limit'])
+    instrument.log('optimisation time = ' + str(time.time() - opt_time))
+    return (fitted_parameters, fit, [p[::] for p in fitted_parameters], 
+            fit.copy())
+
+
+def _lsq_residuals(p, x, goal, num_means):
+    """Residuals of the mixture for least_squares_fit. p is [heights, sds]."""
+    num_peaks = len(num_means)
+    parameters = np.column_stack([p[:num_peaks], num_means, p[num_peaks:]])
+    return utils.mixture(x, parameters) - goal
+
+
+def _lsq_jacobian(p, x, goal, num_means):
+    """Analytic Jacobian of _lsq_residuals with respect to heights and sds."""
+    num_peaks = len(num_means)
+    sds = p[num_peaks:]
+    shapes = utils.gaussians(x, np.column_stack([np.ones(num_peaks), 
+            num_means, sds]))
+    sq_dist = (x - num_means[:, None]) ** 2
+    d_sds = shapes * p[:num_peaks, None] * sq_dist / (sds[:, None] ** 3)
+    return np.vstack([shapes, d_sds]).T
+
+
+def basis_bank(x):
+    """Finds or makes the basis bank of an arrival time grid.
+
+    The bank holds, for each mean index, the peaks of unit height at that 
+    mean for a geometric grid of BANK_WIDTHS standard deviations, from half 
+    the arrival time step to a quarter of the drift range. Columns are only
+    computed the first time a mean is used, and banks are kept for the 
+    BANK_CACHE most recently used grids, so every ATD and data file with the
+    same arrival times shares them (within a process).
+
+    Args:
+        x: Arrival time series
+
+    Returns:
+        bank: Dictionary {'x', 'sds', 'columns'}
+            x is the grid as an array, sds the standard deviations and 
+            columns the computed basis, {mean index: array of shape 
+            [len(x), BANK_WIDTHS]}
+    """
+    x = np.asarray(x, dtype=float)
+    key = x.tobytes()
+    if key in _banks:
+        bank = _banks.pop(key)
+    else:
+        step = np.median(np.diff(x))
+        bank = {'x': x, 'columns': {}, 'sds': np.geomspace(step / 2, 
+                max(step, (x[-1] - x[0]) / 4), BANK_WIDTHS)}
+        while len(_banks) >= BANK_CACHE:
+            _banks.popitem(last=False)
+    _banks[key] = bank
+    return bank
+
+
+def bank_columns(bank, means):
+    """Basis columns of a bank at the given means.
+
+    The widths of each mean are capped at the distance to the nearest other 
+    mean, so that a peak cannot be explained by a basis peak spread over its
+    neighbours. A single mean keeps all widths of the bank.
+
+    Args:
+        bank: Basis bank, see basis_bank
+        means: Mean values as indices
+
+    Returns:
+        columns: Array of shape [len(x), number of widths kept], the widths
+            of each mean next to each other
+        widths: Indices in bank['sds'] of the widths kept for each mean
+    """
+    x = bank['x']
+    sds = bank['sds']
+    blocks = []
+    widths = []
+    for mean in means:
+        if mean not in bank['columns']:
+            bank['columns'][mean] = utils.gaussians(x, [[1, x[mean], sd] for 
+                    sd in sds]).T
+        spacing = [abs(x[mean] - x[i]) for i in means if i != mean]
+        cap = max(min(spacing), sds[0]) if spacing else sds[-1]
+        kept = np.flatnonzero(sds <= cap)
+        blocks.append(bank['columns'][mean][:, kept])
+        widths.append(kept)
+    return np.hstack(blocks), widths
+
+
+def dictionary_fit(x, goal, means, stats=None):
+    """Fits an ATD starting from a non-negative solve over a basis bank.
+
+    With the means fixed, the heights of the peaks of every width of the bank
+    at each mean (see basis_bank and bank_columns) are found with a single
+    non-negative least squares solve. The width with the largest area at each
+    mean then starts one pass of least_squares_fit, so the parameters 
+    reported are those of the fitted curve. Starting this close to the 
+    optimum, the pass needs few evaluations. There is no direction of 
+    fitting, so the forward and reverse results are the same.
+
+    Args:
+        x: Arrival time series
+        goal: Given distribution
+        means: Mean values as indices
+        stats(optional): Dictionary updated with the number of 'iterations', 
+            counted as one for the solve and as in least_squares_fit for the
+            pass. If profiling, a 'dictionary' event is recorded with the 
+            time of the solve, the number of basis peaks used and the exit 
+            reason ('converged' or 'limit'), followed by the 'lsq' event.
+
+    Returns:
+        Same as run_opt_cycles
+    """
+    opt_time = time.time()
+    bank = basis_bank(x)
+    goal = np.asarray(goal, dtype=float)
+    columns, widths = bank_columns(bank, means)
+    exit = 'converged'
+    try:
+        weights = nnls(columns, goal)[0]
+    except RuntimeError:  #Iteration limit of the solve, keep what it can
+        weights = nnls(columns, goal, maxiter=50 * columns.shape[1])[0]
+        exit = 'limit'
+    sds = bank['sds']
+    initial_sd = []
+    initial_h = []
+    start = 0
+    for kept in widths:
+        mean_weights = weights[start:start + len(kept)]
+        start += len(kept)
+        dominant = np.argmax(mean_weights * sds[kept]) #Largest area
+        initial_sd.append(sds[kept][dominant])
+        initial_h.append(mean_weights[dominant])
+    if stats is not None:
+        stats['iterations'] = stats.get('iterations', 0) + 1
+    instrument.record(stats, 'dictionary', time=time.time() - opt_time, 
+            iterations=1, basis=int((weights > 0).sum()), exits=[exit])
+    return least_squares_fit(x, goal, initial_sd, initial_h, means, stats)
+
+
+def _batch_peaks(x, heights, means, sds):
+    """Peaks of many ATDs, computed as utils.gaussian computes each of them.
+
+    The squares of the standard deviations are taken with np.power, which 
+    rounds as the scalar power in utils.gaussian does (ndarray ** 2 does not
+    always), so every row is the same to the last bit.
+
+    Args:
+        x: Arrival times, array
+        heights: Heights, array of shape [ATDs, 1]
+        means: Means, array of shape [ATDs, 1]
+        sds: Standard deviations, array of shape [ATDs, 1]
+
+    Returns:
+        peaks: Array of shape [ATDs, len(x)]
+    """
+    return heights * np.exp(-((x - means) ** 2) / (2 * np.power(sds, 2.0)))
+
+
+def _batch_search(x, fits, curves, rows, params, windows, index, step, 
+        curve_max, minimum_error, threshold):
+    """Runs the fixed step search of optimiser on one peak of many ATDs.
+
+    The errors of all ATDs are computed together over the span of their 
+    windows, with everything outside the window of an ATD masked. The terms 
+    of each sum are those of window_error, only added in another order, so 
+    each error is within a few span * eps of the error optimiser computes. 
+    Where two errors (or an error and the threshold) are closer than that, 
+    the ones of these ATDs are computed again with window_error, so every 
+    ATD takes exactly the steps it takes in optimiser. An ATD leaves the 
+    working arrays as soon as its search stops.
+
+    Args:
+        x: Arrival time series, array
+        fits: Sums of the fixed peaks of every ATD, array of shape 
+            [all ATDs, len(x)]
+        curves: Distributions of every ATD, array of the same shape
+        rows: Rows of the searched ATDs in fits and curves, array
+        params: [height, mean, sd] of the peak of each searched ATD, array 
+            of shape [ATDs, 3]
+        windows: Windows of the searched ATDs as [start, end] indices, array
+            of shape [ATDs, 2]
+        index: Index of the optimised parameter in params
+        step: Step of each searched ATD, array
+        curve_max: Maximum of each distribution, array
+        minimum_error: Initial value for the minimum error of each ATD, array
+        threshold: Error threshold to stop optimisation
+
+    Returns:
+        values: Optimised parameter of each ATD, array
+        errors: Final window error of each ATD as reported by optimiser, up 
+            to rounding, array
+        steps: Number of steps of each ATD, array
+        exits: Reason each search stopped, see optimiser
+    """
+    num = len(rows)
+    start, end = windows[:, 0].min(), windows[:, 1].max()
+    x_span = x[start:end]
+    bins = np.arange(start, end)
+    work = {'atd': np.arange(num), 'row': rows, 'windows': windows,
+            'size': (windows[:, 1] - windows[:, 0]).astype(float),
+            'mask': ((bins >= windows[:, 0:1]) & 
+                (bins < windows[:, 1:2])).astype(float),
+            'fit': fits[rows, start:end], 'curve': curves[rows, start:end],
+            'heights': params[:, 0:1], 'means': params[:, 1:2], 
+            'sds': params[:, 2:3], 'step': step, 'curve_max': curve_max, 
+            'minimum': np.array(minimum_error, dtype=float), 
+            'best': np.zeros(num), 'last': np.zeros(num), 
+            'before_last': np.zeros(num), 'steps': np.zeros(num, dtype=int)}
+    #The parts of the peaks that do not change during the search
+    if index == 0:
+        work['shape'] = np.exp(-((x_span - work['means']) ** 2) / 
+                (2 * np.power(work['sds'], 2.0)))
+    elif index == 2:
+        work['shape'] = -((x_span - work['means']) ** 2)
+    work['best_terms'] = np.zeros((num, len(x_span)))
+    buffers = np.empty((2, num, len(x_span)))
+    tolerance = 4 * len(x_span) * np.finfo(float).eps
+
+    def errors(values, peaks):
+        """Window errors of the working ATDs with the parameter at values.
+        The squared differences are left in peaks."""
+        if index == 0:
+            np.multiply(values[:, None], work['shape'], out=peaks)
+        else:
+            if index == 2:
+                np.divide(work['shape'], 2 * np.power(values[:, None], 2.0), 
+                        out=peaks)
+            else:
+                np.subtract(x_span, values[:, None], out=peaks)
+                np.square(peaks, out=peaks)
+                np.negative(peaks, out=peaks)
+                np.divide(peaks, 2 * np.power(work['sds'], 2.0), out=peaks)
+            np.exp(peaks, out=peaks)
+            np.multiply(work['heights'], peaks, out=peaks)
+        np.add(work['fit'], peaks, out=peaks)
+        np.subtract(peaks, work['curve'], out=peaks)
+        np.multiply(peaks, work['mask'], out=peaks)
+        np.square(peaks, out=peaks)
+        return np.sqrt(peaks.sum(axis=1) / work['size'])
+
+    def exact(k, value):
+        """window_error of working ATD k with the parameter at value."""
+        row = work['row'][k]
+        first, last = work['windows'][k]
+        peak_params = [work['heights'][k, 0], work['means'][k, 0], 
+                work['sds'][k, 0]]
+        peak_params[index] = value
+        return window_error(utils.gaussian(x[first:last], *peak_params), 
+                fits[row, first:last], curves[row, first:last])
+
+    def close(a, b):
+        """Where a and b are too close to be told apart by errors."""
+        return abs(a - b) <= tolerance * np.maximum(a, b)
+
+    def reached(error):
+        """Where the searches reach the threshold, as in optimiser. A sum of
+        squares is 0 in any order only if all of them are, so a threshold of
+        0 is never too close."""
+        done = error <= threshold
+        if threshold > 0:
+            for k in np.flatnonzero(close(error, threshold)):
+                error[k] = exact(k, work['values'][k])
+                done[k] = error[k] <= threshold
+        return done
+
+    work['values'] = params[:, index].copy()
+    work['error'] = errors(work['values'], buffers[0])
+    values = work['values'].copy()
+    final_errors = work['error'].copy()
+    steps = np.zeros(num, dtype=int)
+    exits = np.array(['threshold'] * num, dtype=object)
+    stopped = reached(work['error'])
+    final_errors[stopped] = work['error'][stopped]
+    while True:
+        if stopped.any(): #Results are kept, the rest is worked on
+            for key in work:
+                work[key] = work[key][~stopped]
+        if not len(work['atd']):
+            break
+        current = work['values']
+        up_par = current + work['step']
+        down_par = current - work['step']
+        #Ensuring the parameter values stay over 0
+        down_par = np.where(down_par <= 0, up_par, down_par)
+        if index == 0: #Ensuring height does not exceed maximum
+            up_par = np.where(up_par > work['curve_max'], down_par, up_par)
+        up_terms = buffers[0, :len(current)]
+        down_terms = buffers[1, :len(current)]
+        up_error = errors(up_par, up_terms)
+        down_error = errors(down_par, down_terms)
+        #Errors of the same terms are equal in optimiser too
+        ties = np.flatnonzero(close(up_error, down_error) & 
+                (up_par != down_par))
+        if len(ties):
+            same = (up_terms[ties] == down_terms[ties]).all(axis=1)
+            for k in ties[~same]:
+                up_error[k] = exact(k, up_par[k])
+                down_error[k] = exact(k, down_par[k])
+        #Checking if incrementing down or up is better (gives lower error)
+        down = (up_error > down_error) & (down_par > 0)
+        current = np.where(down, down_par, up_par)
+        error = np.where(down, down_error, up_error)
+
+        def terms(k):
+            """Squared differences of the accepted steps of ATDs k."""
+            return np.where(down[k, None], down_terms[k], up_terms[k])
+
+        better = error < work['minimum']
+        ties = np.flatnonzero(close(error, work['minimum']) & 
+                (current != work['best']))
+        if len(ties):
+            same = (terms(ties) == work['best_terms'][ties]).all(axis=1)
+            better[ties[same]] = False
+            for k in ties[~same]:
+                error[k] = exact(k, current[k])
+                better[k] = error[k] < exact(k, work['best'][k])
+        better = np.flatnonzero(better)
+        if len(better):
+            work['minimum'][better] = error[better]
+            work['best'][better] = current[better]
+            work['best_terms'][better] = terms(better)
+        oscillation = (work['steps'] > 2) & (work['before_last'] == current)
+        work['before_last'] = work['last']
+        work['last'] = current
+        work['steps'] = work['steps'] + ~oscillation
+        work['values'] = current
+        work['error'] = error
+        done = ~oscillation & reached(error)
+        limit = ~oscillation & ~done & (work['steps'] == 200)
+        stopped = oscillation | done | limit
+        atds = work['atd']
+        values[atds] = np.where(done, current, work['best'])
+        final_errors[atds] = np.where(done, error, work['minimum'])
+        steps[atds] = work['steps']
+        exits[atds[oscillation]] = 'oscillation'
+        exits[atds[limit]] = 'limit'
+    return values, final_errors, steps, exits.tolist()
+
+
+def batch_optimiser(x, curves, sds, heights, means, counts, threshold, 
+        parameter, direction, stats=None):
+    """Runs optimiser on many ATDs at once.
+
+    The peaks are optimised in the same order and with the same steps and 
+    stopping rules as in optimiser, and the k-th peak of every ATD is 
+    optimised at the same time, over an array of shape [ATDs, drift bins] 
+    (see _batch_search). Each ATD keeps its own window, step and exit; ATDs
+    with fewer peaks are left out once their peaks are done. The fits are 
+    the same as with optimiser.
+
+    Args:
+        x: Arrival time series
+        curves: Given distributions, array of shape [ATDs, drift bins]
+        sds: Initial sd values, array of shape [ATDs, peaks]
+        heights: Initial height values, array of shape [ATDs, peaks]
+        means: Indices of means on x value list, array of shape 
+            [ATDs, peaks]
+        counts: Number of peaks of each ATD. Entries past the count of an ATD
+            are padding and are ignored.
+        threshold: Error threshold to stop optimisation
+        parameter: 'sd', 'm' or 'h', see optimiser
+        direction: 'f' or 'r', see optimiser
+        stats(optional): Dictionary updated with the number of 'iterations'
+            of all ATDs. If profiling, an 'optimiser' event is recorded as in
+            optimiser, with the exits and errors of every peak of every ATD.
+
+    Returns:
+        parameters: Optimised parameters, array of shape [ATDs, peaks, 3] 
+            with [height, mean, sd] of each peak, in the order of means
+        fits: Sums of fitted gaussians, array of shape [ATDs, drift bins]
+    """
+    opt_time = time.time()
+    x = np.asarray(x, dtype=float)
+    curves = np.asarray(curves, dtype=float)
+    means = np.asarray(means, dtype=int)
+    counts = np.asarray(counts, dtype=int)
+    num_atds, num_peaks = means.shape
+    rows = np.arange(num_atds)
+    curve_max = curves.max(axis=1)
+    norm_factor = 100 / curve_max  #Scale factor for unnormalised data
+    if parameter == 'sd':
+        optimisation_index = 2
+        fluctuation_factor = np.ones(num_atds) * 0.01
+    elif parameter == 'm':
+        optimisation_index = 1
+        fluctuation_factor = np.ones(num_atds) * 0.2
+    elif parameter == 'h':
+        optimisation_index = 0
+        fluctuation_factor = 0.5 / norm_factor #Scaled iteration step 
+    parameters = np.dstack([np.asarray(heights, dtype=float), x[means], 
+            np.asarray(sds, dtype=float)])
+    valid = np.arange(num_peaks) < counts[:, None]
+    initial_minimum = np.where(valid, parameters[:, :, 0], -np.inf).max(
+            axis=1) * 100  #Initial value for minimum error 
+    fits = np.zeros(curves.shape)
+    exits = [[] for _ in range(num_atds)]
+    final_errors = [[] for _ in range(num_atds)]
+    iterations = 0
+    for i in range(num_peaks): #Iterate over peaks in the order of direction
+        atds = rows[counts > i] #ATDs with an i-th peak
+        if direction == 'f':
+            peak = np.ones(len(atds), dtype=int) * i
+            mean_index = means[atds, peak]
+            windows = np.column_stack([np.zeros(len(atds), dtype=int), 
+                    np.minimum(mean_index + 3, len(x))])
+        else:
+            peak = counts[atds] - 1 - i
+            mean_index = means[atds, peak]
+            windows = np.column_stack([mean_index, 
+                    np.ones(len(atds), dtype=int) * len(x)])
+        params = parameters[atds, peak]
+        values, errors, steps, reasons = _batch_search(x, fits, curves, atds,
+                params, windows, optimisation_index, 
+                fluctuation_factor[atds], curve_max[atds], 
+                initial_minimum[atds], threshold)
+        params[:, optimisation_index] = values
+        parameters[atds, peak] = params
+        fits[atds] += _batch_peaks(x, params[:, 0:1], params[:, 1:2], 
+                params[:, 2:3])
+        iterations += int(steps.sum())
+        for j in range(len(atds)):
+            exits[atds[j]].append(reasons[j])
+            final_errors[atds[j]].append(float(errors[j]))
+    if stats is not None:
+        stats['iterations'] = stats.get('iterations', 0) + iterations
+    if direction == 'r': #Exits in the order of means, as in optimiser
+        exits = [e[::-1] for e in exits]
+        final_errors = [e[::-1] for e in final_errors]
+    instrument.record(stats, 'optimiser', parameter=parameter, 
+            direction=direction, time=time.time() - opt_time, 
+            iterations=iterations, atds=num_atds, exits=sum(exits, []), 
+            errors=sum(final_errors, []))
+    return parameters, fits
+
+
+def batch_fit(num, x, goals, initial_sds, initial_heights, means, 
+        threshold=0, stats=None):
+    """Fits many ATDs at once with the cycles of run_opt_cycles.
+
+    Every call to optimiser in run_opt_cycles is replaced by one call to 
+    batch_optimiser for all ATDs, so the fits are the same as with 
+    run_opt_cycles. The steps of all ATDs share their array operations, 
+    which pays off from about 8 ATDs. On synthetic ramps of 200 bins and 3
+    peaks, 128 ATDs took 1.3 s against 14 s one by one when they had the 
+    same means, and 12 s against 59 s when each had its own ('der'). With 4
+    ATDs of their own means it is slower (2.6 s against 1.5 s).
+
+    Args:
+        num: Number of cycles
+        x: Arrival time series
+        goals: Given distributions, one per ATD
+        initial_sds: Initial standard deviation values of each ATD
+        initial_heights: Initial height values of each ATD
+        means: Mean values as indices of each ATD. The number of means may 
+            differ between ATDs.
+        threshold(optional): Error threshold to stop optimisation
+        stats(optional): Dictionary updated with the number of optimiser 
+            'iterations' of all ATDs
+
+    Returns:
+        fits: One tuple per ATD, same as run_opt_cycles
+    """
+    opt_time = time.time()
+    counts = np.array([len(m) for m in means])
+    num_peaks = max(counts.max(), 1)
+
+    def padded(values, fill):
+        table = np.ones((len(values), num_peaks)) * fill
+        for i in range(len(values)):
+            table[i, :counts[i]] = values[i]
+        return table
+
+    means = padded(means, 0).astype(int)
+    goals = np.asarray(goals, dtype=float)
+    sd_f = padded(initial_sds, 1)
+    heights_f = padded(initial_heights, 0)
+    sd_r = sd_f.copy()
+    heights_r = heights_f.copy()
+    #Standard deviations are optimised with initial height values.
+    parameters_f, fits_f = batch_optimiser(x, goals, sd_f, heights_f, means, 
+            counts, threshold, 'sd', 'f', stats)
+    sd_f = parameters_f[:, :, 2]
+    parameters_r, fits_r = batch_optimiser(x, goals, sd_r, heights_r, means, 
+            counts, threshold, 'sd', 'r', stats)
+    sd_r = parameters_r[:, :, 2]
+    for _ in range(num):
+        parameters_f, fits_f = batch_optimiser(x, goals, sd_f, heights_f, 
+                means, counts, threshold, 'h', 'f', stats)
+        heights_f = parameters_f[:, :, 0]
+        parameters_f, fits_f = batch_optimiser(x, goals, sd_f, heights_f, 
+                means, counts, threshold, 'sd', 'f', stats)
+        sd_f = parameters_f[:, :, 2]
+        parameters_r, fits_r = batch_optimiser(x, goals, sd_r, heights_r, 
+                means, counts, threshold, 'h', 'r', stats)
+        heights_r = parameters_r[:, :, 0]
+        parameters_r, fits_r = batch_optimiser(x, goals, sd_r, heights_r, 
+                means, counts, threshold, 'sd', 'r', stats)
+        sd_r = parameters_r[:, :, 2]
+    instrument.log('optimisation time = ' + str(time.time() - opt_time))
+    return [(parameters_f[i, :counts[i]].tolist(), fits_f[i], 
+            parameters_r[i, :counts[i]].tolist(), fits_r[i]) for i in 
+            range(len(counts))]
+
+
+def information_criterion(goal, fit, num_parameters, criterion='bic'):
+    """Scores a fit, penalising the number of parameters. Lower is better.
+
+    Args:
+        goal: Given distribution
+        fit: Sum of the fitted peaks
+        num_parameters: Number of fitted parameters
+        criterion(optional): 'bic' (Bayesian) or 'aic' (Akaike)
+
+    Returns:
+        Value of the criterion
+    """
+    goal = np.asarray(goal, dtype=float)
+    n = len(goal)
+    rss = ((np.asarray(fit) - goal) ** 2).sum() + 1e-300  #Avoid log(0)
+    if criterion == 'bic':
+        penalty = num_parameters * np.log(n)
+    elif criterion == 'aic':
+        penalty = 2 * num_parameters
+    else:
+        raise ValueError('Unknown criterion: ' + str(criterion))
+    return n * np.log(rss / n) + penalty
+
+
+def select_means(x, goal, candidates, criterion='bic', max_peaks=None, 
+        patience=2, stats=None):
+    """Chooses how many (and which) of the candidate means to fit.
+
+    Means are added one at a time: first the candidate with the highest 
+    intensity, then each time the candidate where the current fit leaves the
+    largest residual. Each model is fitted with least_squares_fit, starting 
+    from the fit of the previous one, and scored with information_criterion,
+    with heights and standard deviations as the fitted parameters. The search
+    stops once patience models in a row score worse than the best one, or no
+    candidate is left above the fit, and the best (smallest) model is 
+    returned. Only the means are returned, so the caller fits them again 
+    with its own engine.
+
+    Args:
+        x: Arrival time series
+        goal: Given distribution
+        candidates: Candidate means as indices, e.g. from utils.find_means
+        criterion(optional): 'bic' or 'aic', see information_criterion
+        max_peaks(optional): Largest number of peaks tried. All candidates if
+            None.
+        patience(optional): Number of worse models in a row that end the 
+            search
+        stats(optional): Dictionary updated with the number of 'iterations'.
+            If profiling, a 'select_means' event is recorded with the scores.
+
+    Returns:
+        means: Chosen means as indices, in ascending order
+    """
+    opt_time = time.time()
+    goal = np.asarray(goal, dtype=float)
+    remaining = sorted(set(candidates))
+    if max_peaks is None:
+        max_peaks = len(remaining)
+    fit = np.zeros(len(goal))
+    previous = {}  #Fitted sd and height of each mean in the previous model
+    means = []
+    best = None
+    scores = []
+    worse = 0
+    while remaining and len(means) < max_peaks:
+        residual = goal[remaining] - fit[remaining]
+        if residual.max() <= 0:  #Nothing left above the fit
+            break
+        new = remaining.pop(int(np.argmax(residual)))
+        means = sorted(means + [new])
+        initial_sd = [previous.get(i, (0.01, 0))[0] for i in means]
+        initial_h = [previous.get(i, (0, goal[new]))[1] for i in means]
+        parameters, fit, _, _ = least_squares_fit(x, goal, initial_sd, 
+                initial_h, means, stats)
+        previous = dict((means[i], (parameters[i][2], parameters[i][0])) for
+                i in range(len(means)))
+        score = information_criterion(goal, fit, 2 * len(means), criterion)
+        scores.append(float(score))
+        if best is None or score < best[0]:
+            best = (score, means)
+            worse = 0
+        else:
+            worse += 1
+            if worse >= patience:
+                break
+    instrument.record(stats, 'select_means', time=time.time() - opt_time, 
+            candidates=len(set(candidates)), scores=scores, 
+            peaks=len(best[1]) if best else 0)
+    if best is None:
+        return []
+    return best[1]
+
+
+def global_fit(x, goals, means, widths='shared', smoothness=10.0, 
+        stats=None):
+    """Fits the ATDs of a whole CIU ramp jointly.
+
+    The means of the peaks are shared by all ATDs and are fitted as well, 
+    starting from the given means and staying within half the distance to the
+    neighbouring means. The heights are fitted for each ATD. The standard 
+    deviations are either shared by all ATDs ('shared') or fitted for each 
+    ATD with a penalty on their change between neighbouring voltages 
+    ('smooth'). Every ATD is weighted by its normalisation factor, so all 
+    voltages count the same.
+
+    Each residual only depends on the heights of its own ATD and on the peak
+    shapes, so the problem is solved as one sparse least squares problem with
+    an analytic Jacobian. On the demo data this takes about as long as 
+    fitting the ATDs separately with 'lsq': 0.8 s against 1.1 s and 0.5 s 
+    against 1.7 s, but 5.7 s against 4.9 s on the dataset with the most 
+    peaks.
+
+    Args:
+        x: Arrival time series
+        goals: ATDs in voltage order, array-like of shape [voltages, len(x)]
+        means: Initial mean values as indices
+        widths(optional): 'shared' or 'smooth', see above
+        smoothness(optional): Weight of the penalty on the change of the 
+            standard deviations between voltages ('smooth' only)
+        stats(optional): Dictionary updated with the number of 'iterations', 
+            counted as evaluations of the residuals. If profiling, a 'global'
+            event is recorded.
+
+    Returns:
+        parameters: Parameters of each ATD 
+            [[[height1, mean1, sd1], ...], ...]
+        fits: Sum of the fitted peaks of each ATD, array of shape 
+            [voltages, len(x)]
+    """
+    if widths not in WIDTHS:
+        raise ValueError('Unknown width model: ' + str(widths))
+    opt_time = time.time()
+    x = np.asarray(x, dtype=float)
+    goals = np.asarray(goals, dtype=float)
+    num_means = x[list(means)]
+    num_voltages = len(goals)
+    num_peaks = len(num_means)
+    step = np.median(np.diff(x))
+    weights = 100 / goals.max(axis=1)  #Normalisation factor of every ATD
+    if num_peaks > 1:
+        reach = np.diff(num_means).min() / 2
+    else:
+        reach = (x[-1] - x[0]) / 2
+    sds = np.ones(num_peaks) * max(step, reach / 2)
+    shapes = utils.gaussians(x, np.column_stack([np.ones(num_peaks), 
+            num_means, sds]))
+    heights = np.zeros((num_voltages, num_peaks))
+    for i in range(num_voltages):  #Linear solve for the starting heights
+        try:
+            heights[i] = nnls(shapes.T, goals[i])[0]
+        except RuntimeError:
+            heights[i] = goals[i][list(means)]
+    heights = np.minimum(heights, goals.max(axis=1)[:, None])
+    num_sds = num_peaks if widths == 'shared' else num_voltages * num_peaks
+    start = np.concatenate([heights.ravel(), num_means, 
+            np.resize(sds, num_sds)])
+    lower = np.concatenate([np.zeros(num_voltages * num_peaks), 
+            num_means - reach, np.ones(num_sds) * step / 10])
+    upper = np.concatenate([np.repeat(goals.max(axis=1), num_peaks), 
+            num_means + reach, np.ones(num_sds) * (x[-1] - x[0])])
+    start = np.clip(start, lower, upper)
+    args = (x, goals, weights, num_peaks, widths, smoothness)
+    #Heights, means and sds differ in scale by orders of magnitude, so the 
+    #steps are scaled by the Jacobian. The inner lsmr solves and the outer 
+    #convergence only need the precision of the data, not of the defaults.
+    solution = least_squares(_global_residuals, start, jac=_global_jacobian, 
+            bounds=(lower, upper), args=args, x_scale='jac', ftol=1e-6,
+            tr_solver='lsmr', tr_options={'atol': 1e-4, 'btol': 1e-4})
+    if stats is not None:
+        stats['iterations'] = stats.get('iterations', 0) + solution.nfev
+    heights, num_means, sds = _global_unpack(solution.x, num_voltages, 
+            num_peaks, widths)
+    parameters = [[[heights[i, j], num_means[j], sds[i, j]] for j in 
+            range(num_peaks)] for i in range(num_voltages)]
+    fits = np.array([utils.mixture(x, p) for p in parameters])
+    instrument.record(stats, 'global', time=time.time() - opt_time, 
+            iterations=int(solution.nfev), voltages=num_voltages,
+            exits=['converged' if solution.status > 0 else 'limit'])
+    instrument.log('optimisation time = ' + str(time.time() - opt_time))
+    return parameters, fits
+
+
+def _global_unpack(p, num_voltages, num_peaks, widths):
+    """Splits the parameters of global_fit into heights, means and sds.
+
+    Heights and sds are returned as arrays of shape [voltages, peaks].
+    """
+    split = num_voltages * num_peaks
+    heights = p[:split].reshape(num_voltages, num_peaks)
+    num_means = p[split:split + num_peaks]
+    sds = p[split + num_peaks:].reshape(-1, num_peaks)
+    if widths == 'shared':
+        sds = np.repeat(sds, num_voltages, axis=0)
+    return heights, num_means, sds
+
+
+def _global_shapes(x, num_means, sds):
+    """Unit height peaks of every ATD, array of shape 
+    [voltages, peaks, len(x)].
+    """
+    return np.exp(-((x - num_means[None, :, None]) ** 2) / 
+            (2 * sds[:, :, None] ** 2))
+
+
+def _global_residuals(p, x, goals, weights, num_peaks, widths, smoothness):
+    """Weighted residuals of all ATDs for global_fit, followed by the 
+    smoothness penalty of the sds if widths is 'smooth'."""
+    heights, num_means, sds = _global_unpack(p, len(goals), num_peaks, widths)
+    shapes = _global_shapes(x, num_means, sds)
+    fits = (heights[:, :, None] * shapes).sum(axis=1)
+    residuals = ((fits - goals) * weights[:, None]).ravel()
+    if widths == 'smooth':
+        residuals = np.concatenate([residuals, 
+                smoothness * np.diff(sds, axis=0).ravel()])
+    return residuals
+
+
+def _global_jacobian(p, x, goals, weights, num_peaks, widths, smoothness):
+    """Analytic sparse Jacobian of _global_residuals."""
+    num_voltages = len(goals)
+    num_bins = len(x)
+    heights, num_means, sds = _global_unpack(p, num_voltages, num_peaks, 
+            widths)
+    shapes = _global_shapes(x, num_means, sds) * weights[:, None, None]
+    distance = x - num_means[None, :, None]
+    d_means = shapes * heights[:, :, None] * distance / sds[:, :, None] ** 2
+    d_sds = shapes * heights[:, :, None] * distance ** 2 / sds[:, :, None] ** 3
+    #The sparsity pattern is known: the residual of every bin of a voltage 
+    #depends on the heights of that voltage, the means and the sds of that 
+    #voltage (or the shared sds), in this order of columns. The matrix is 
+    #therefore built directly in CSR form, 3 * num_peaks entries per row.
+    peaks = np.arange(num_peaks)
+    voltages = np.arange(num_voltages)[:, None]
+    split = num_voltages * num_peaks
+    if widths == 'shared':
+        sd_cols = np.broadcast_to(split + num_peaks + peaks, (num_voltages, 
+                num_peaks))
+    else:
+        sd_cols = split + num_peaks + voltages * num_peaks + peaks
+    columns = np.concatenate([voltages * num_peaks + peaks, 
+            np.broadcast_to(split + peaks, (num_voltages, num_peaks)), 
+            sd_cols], axis=1)
+    data = [np.concatenate([shapes, d_means, d_sds], axis=1).transpose(0, 2, 
+            1).ravel()]
+    indices = [np.repeat(columns, num_bins, axis=0).ravel()]
+    num_rows = num_voltages * num_bins
+    indptr = [np.arange(num_rows + 1) * 3 * num_peaks]
+    if widths == 'smooth':  #Penalty rows, sd[i + 1] - sd[i]
+        penalty = np.arange((num_voltages - 1) * num_peaks)
+        first = split + num_peaks + penalty
+        data.append(np.tile([-smoothness, smoothness], len(penalty)))
+        indices.append(np.column_stack([first, first + num_peaks]).ravel())
+        indptr.append(indptr[0][-1] + 2 * (penalty + 1))
+        num_rows += len(penalty)
+    return sparse.csr_matrix((np.concatenate(data), np.concatenate(indices),
+            np.concatenate(indptr)), shape=(num_rows, len(p)))
+
+
 def main():
     return
 
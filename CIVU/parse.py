@@ -5,8 +5,9 @@ Created by Simos Kalfas
     email:simos.kalfas@gmail.com
     github: https://github.com/simoskalfas/
 """
-from scipy.signal import  argrelmax
 import numpy as np
+import os
+import instrument
 
 
 # def handle_file(filename):
@@ -23,32 +24,157 @@ import numpy as np
 #             datdic['data'].append(float(spl[1]))
 #     return datdic
 
-def handle_file(filename, make_txt=False):
+#Version of the binary cache layout, bump to invalidate existing caches
+CACHE_VERSION = 1
+
+
+def data_path(filename):
+    """Path of a data file in the Data folder.
+
+    Args:
+        filename: Data file name without file extension
+
+    Returns:
+        Path of the text file
+    """
+    return '../Data/' + filename + '.txt'
+
+
+def cache_path(filename):
+    """Path of the binary cache kept next to a data file.
+
+    Args:
+        filename: Data file name without file extension
+
+    Returns:
+        Path of the .npz cache
+    """
+    return '../Data/' + filename + '.cache.npz'
+
+
+def heatmap_paths(filename):
+    """Paths of the memory-mapped heatmap made from a data file.
+
+    Args:
+        filename: Data file name without file extension
+
+    Returns:
+        Path of the .npy intensity matrix and of the .npz index holding the 
+        labels and arrival times
+    """
+    return ('../Data/' + filename + '.heatmap.npy', 
+            '../Data/' + filename + '.heatmap.npz')
+
+
+def source_stamp(filename):
+    """Stamp identifying the current version of a data file.
+
+    Args:
+        filename: Data file name without file extension
+
+    Returns:
+        Array of [cache version, size, modification time]
+    """
+    source = os.stat(data_path(filename))
+    return np.array([CACHE_VERSION, source.st_size, source.st_mtime])
+
+
+def read_matrix(path, filename):
+    """Parses a tab separated data file with NumPy.
+
+    Args:
+        path: Path of the data file
+        filename: Data file name without file extension, used as the label of
+            the arrival time column
+
+    Returns:
+        labels: Column labels [filename, voltage1, ...]
+        arrival_time: Arrival time series as an array
+        matrix: Intensities as an array of shape [voltages, drift bins]
+    """
+    with open(path, 'r') as f:
+        labels = f.readline().replace('\r', '').replace('\n', '').split('\t')
+        data = np.loadtxt(f, delimiter='\t', ndmin=2)
+    labels[0] = filename
+    return labels, data[:, 0], data[:, 1:].T
+
+
+def read_new_columns(path, known=()):
+    """Parses only the voltages of a data file that are not known yet.
+
+    Used to follow a data file that gains voltages while it is acquired.
+
+    Args:
+        path: Path of the data file
+        known(optional): Labels of the voltages already parsed
+
+    Returns:
+        labels: Labels of the new voltages
+        arrival_time: Arrival time series as an array
+        matrix: Intensities of the new voltages as an array of shape 
+            [new voltages, drift bins]
+    """
+    with open(path, 'r') as f:
+        labels = f.readline().replace('\r', '').replace('\n', '').split('\t')
+        columns = [i for i in range(1, len(labels)) if labels[i] not in known]
+        data = np.loadtxt(f, delimiter='\t', ndmin=2, usecols=[0] + columns)
+    return [labels[i] for i in columns], data[:, 0], data[:, 1:].T
+
+
+def load_matrix(filename, cache=True):
+    """Loads a data file as a matrix, using the binary cache when it is valid.
+
+    The cache is a .npz file next to the data file recording the size and
+    modification time of the text it was made from. If these do not match the
+    data file, the text is parsed again and the cache rewritten. A cache that
+    cannot be written (e.g. read-only folder) is skipped.
+
+    Args:
+        filename: Data file name without file extension
+        cache(optional): If False the text is always parsed and no cache is 
+            written
+
+    Returns:
+        Same as read_matrix
+    """
+    path = data_path(filename)
+    stamp = source_stamp(filename)
+    if cache and os.path.isfile(cache_path(filename)):
+        try:
+            with np.load(cache_path(filename)) as stored:
+                if np.array_equal(stored['stamp'], stamp):
+                    labels = [str(i) for i in stored['labels']]
+                    labels[0] = filename
+                    return labels, stored['arrival_time'], stored['matrix']
+        except (IOError, KeyError, ValueError):  #Unreadable cache, parse again
+            pass
+    labels, arrival_time, matrix = read_matrix(path, filename)
+    if cache:
+        try:
+            with open(cache_path(filename), 'wb') as f:
+                np.savez(f, stamp=stamp, labels=np.array(labels), 
+                        arrival_time=arrival_time, matrix=matrix)
+        except (IOError, OSError):
+            pass
+    return labels, arrival_time, matrix
+
+
+def handle_file(filename, make_txt=False, cache=True):
     """Parses the data file into a dictionary.
 
     Args:
         filename:Data file name without file extension
         make_txt:If True, outputs a text file with the parsed data
+        cache(optional): If True the binary cache of load_matrix is used
 
     Returns:
         datadic:Dictionary of data 
             {filename:arrival times, voltage1:intensities1, ...}
     """
-    datdic = {}
-    with open('../Data/' + filename + '.txt', 'r') as f:
-        fl = f.readline()
-        fl = fl.replace('\r', '')
-        fl = fl.replace('\n', '')
-        fl = fl.split('\t')
-        fl[0] = filename
-        for i in range(len(fl)):
-            datdic[str(fl[i])] = []
-        for line in f:
-            spl = line.replace('\r', '')
-            spl = spl.replace('\n', '')
-            spl = spl.split('\t')
-            for j in range(len(spl)):
-                datdic[fl[j]].append(float(spl[j]))
+    labels, arrival_time, matrix = load_matrix(filename, cache)
+    datdic = {filename: arrival_time.tolist()}
+    for i in range(len(matrix)):
+        datdic[labels[i + 1]] = matrix[i].tolist()
     if make_txt:
         with open('splitdata.txt', 'w') as f:
             for i in datdic:
@@ -58,43 +184,200 @@ def handle_file(filename, make_txt=False):
     return datdic
 
 
-def aline(datdic, filename, gen_text=False):
+def make_heatmap(filename):
+    """Converts a data file into a memory-mapped heatmap.
+
+    The text is read one line (drift bin) at a time and written into a .npy
+    matrix of shape [voltages, drift bins], so that each voltage is contiguous
+    on disk. Only one line of the text is held in memory, however large the 
+    file is.
+
+    Args:
+        filename: Data file name without file extension
+
+    Returns:
+        Nothing
+    """
+    matrix_path, index_path = heatmap_paths(filename)
+    stamp = source_stamp(filename)
+    with open(data_path(filename), 'r') as f:
+        labels = f.readline().replace('\r', '').replace('\n', '').split('\t')
+        bins = sum(1 for line in f if line.strip())
+    labels[0] = filename
+    arrival_time = np.zeros(bins)
+    heatmap = np.lib.format.open_memmap(matrix_path, mode='w+', 
+            dtype=float, shape=(len(labels) - 1, bins))
+    with open(data_path(filename), 'r') as f:
+        f.readline()
+        i = 0
+        for line in f:
+            if not line.strip():
+                continue
+            row = np.array(line.split('\t'), dtype=float)
+            arrival_time[i] = row[0]
+            heatmap[:, i] = row[1:]
+            i += 1
+    heatmap.flush()
+    del heatmap
+    #The index is written last, so an interrupted conversion is redone
+    with open(index_path, 'wb') as f:
+        np.savez(f, stamp=stamp, labels=np.array(labels), 
+                arrival_time=arrival_time)
+
+
+def open_heatmap(filename):
+    """Opens the memory-mapped heatmap of a data file.
+
+    The heatmap is made with make_heatmap the first time, and again whenever
+    the data file has changed since.
+
+    Args:
+        filename: Data file name without file extension
+
+    Returns:
+        labels: Column labels [filename, voltage1, ...]
+        arrival_time: Arrival time series as an array
+        heatmap: Read-only memory map of shape [voltages, drift bins]
+    """
+    matrix_path, index_path = heatmap_paths(filename)
+    stamp = source_stamp(filename)
+    index = None
+    if os.path.isfile(matrix_path) and os.path.isfile(index_path):
+        index = np.load(index_path)
+        if not np.array_equal(index['stamp'], stamp):
+            index.close()
+            index = None
+    if index is None:
+        make_heatmap(filename)
+        index = np.load(index_path)
+    with index:
+        labels = [str(i) for i in index['labels']]
+        arrival_time = index['arrival_time']
+    labels[0] = filename
+    return labels, arrival_time, np.load(matrix_path, mmap_mode='r')
+
+
+def stream_heatmap(filename, voltages=None):
+    """Yields the ATDs of a heatmap one voltage at a time.
+
+    Each ATD is copied out of the memory map on its own, so only the ATD being
+    yielded has to be held in memory.
+
+    Args:
+        filename: Data file name without file extension
+        voltages(optional): Voltage labels in the order they are yielded. All 
+            voltages in file order if None
+
+    Yields:
+        voltage: Voltage label
+        intensities: ATD as an array
+    """
+    labels, arrival_time, heatmap = open_heatmap(filename)
+    rows = dict((labels[i + 1], i) for i in range(len(heatmap)))
+    if voltages is None:
+        voltages = labels[1:]
+    for voltage in voltages:
+        yield voltage, np.array(heatmap[rows[voltage]])
+
+
+#Alignment methods of align_matrix
+ALIGN_METHODS = ['max', 'xcorr']
+
+
+def shift_rows(matrix, shifts):
+    """Shifts every row of a matrix to the left by its own (fractional) shift.
+
+    Done as one gather over the whole matrix. Fractional shifts are linearly 
+    interpolated and positions beyond the ends of a row are filled with 0.
+
+    Args:
+        matrix: Array of shape [rows, columns]
+        shifts: Shift of each row in columns, negative to shift right
+
+    Returns:
+        Shifted matrix as a new array
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    columns = matrix.shape[1]
+    positions = np.arange(columns)[None, :] + np.asarray(shifts, 
+            dtype=float)[:, None]
+    left = np.floor(positions).astype(int)
+    fraction = positions - left
+    padded = np.pad(matrix, ((0, 0), (1, 1)), 'constant') #Zeros at the ends
+    right = np.clip(left + 2, 0, columns + 1)
+    left = np.clip(left + 1, 0, columns + 1)
+    rows = np.arange(len(matrix))[:, None]
+    return padded[rows, left] * (1 - fraction) + padded[rows, right] * fraction
+
+
+def align_matrix(matrix, method='max'):
+    """Aligns the ATDs of a matrix.
+
+    Args:
+        matrix: ATDs as an array of shape [voltages, drift bins]
+        method(optional): 'max' to shift every ATD so that the first of its 
+            two highest points lines up with the earliest one in the dataset
+            (whole bins). 'xcorr' to shift every ATD by the lag (with sub-bin
+            precision) of its FFT cross-correlation with the ATD whose 
+            maximum comes first.
+
+    Returns:
+        aligned: Aligned matrix as a new array
+        shifts: Shift of each ATD to the left, in bins
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    columns = matrix.shape[1]
+    #Second highest value of each ATD; the first point at or above it is the 
+    #first of the two highest points
+    second = np.partition(matrix, columns - 2, axis=1)[:, columns - 2]
+    first = np.argmax(matrix >= second[:, None], axis=1)
+    if method == 'max':
+        shifts = first - first.min()
+    elif method == 'xcorr':
+        size = 2 * columns
+        reference = np.fft.rfft(matrix[np.argmin(first)], size)
+        correlation = np.fft.irfft(np.fft.rfft(matrix, size, axis=1) * 
+                np.conj(reference)[None, :], size, axis=1)
+        correlation = np.roll(correlation, columns, axis=1) #Lag 0 at columns
+        peak = np.clip(np.argmax(correlation, axis=1), 1, size - 2)
+        rows = np.arange(len(matrix))
+        below = correlation[rows, peak - 1]
+        at = correlation[rows, peak]
+        above = correlation[rows, peak + 1]
+        curvature = below - 2 * at + above
+        #Vertex of the parabola through the three points around the peak
+        offset = np.where(curvature < 0, 0.5 * (below - above) / 
+                np.where(curvature < 0, curvature, 1), 0)
+        shifts = peak + offset - columns
+    else:
+        raise ValueError('Unknown alignment method: ' + str(method))
+    return shift_rows(matrix, shifts), shifts
+
+
+def aline(datdic, filename, gen_text=False, method='max'):
     """Alines data using the global maximum of each set.
 
-    Do not use for CIU data. Only usefull for data with small folding evolution.
+    Do not use for CIU data. Only usefull for data with small folding 
+    evolution.
 
     Args:
         datdic: Dictionary of parsed data
         filename: Name of data file without file extension
         gen_text: If True, outputs a text file with alined data
+        method(optional): Alignment method, see align_matrix
 
     Returns:
         retdic: Dictionary of alined data
     """
-    fullkeys = sorted(datdic)
-    keys = fullkeys[:-1]
-    datamat = [datdic[i] for i in keys] #Make data into matrix
-    fullind = []
-    for i in range(0, len(datamat)):
-        alist = datamat[i][::]
-        alist.sort()
-        peaks = alist[-2:] #Get maximum
-        #If the maximum conformation changes, uncomment line 68 and comment line
-        #69
-        #alind = argrelmax(np.array(datamat[i]), order=5)[0][:2]
-        alind = [datamat[i].index(j) for j in peaks]
-        alind.sort()
-        fullind.append(alind)
-    firstind = [i[0] for i in fullind]
-    disp = [i - min(firstind) for i in firstind] #Displacement factor
-    print 'Alinement displacement:' + str(disp) 
-    for i in range(0, len(datamat)): #Aline data
-        datamat[i] = datamat[i][disp[i]:]
-        datamat[i] += [0 for _ in range(disp[i])]
+    keys = [i for i in sorted(datdic) if i != filename]
+    datamat, disp = align_matrix([datdic[i] for i in keys], method)
+    if method == 'max':
+        disp = [int(i) for i in disp]
+    instrument.log('Alinement displacement:' + str(list(disp)))
     retdic = {}
     for i in range(len(keys)):
-        retdic[keys[i]] = datamat[i]
-    retdic[fullkeys[-1]] = datdic[fullkeys[-1]]
+        retdic[keys[i]] = datamat[i].tolist()
+    retdic[filename] = datdic[filename]
     if gen_text:
         with open(filename + 'alined_' + '.txt', 'w') as f:
             for i in sorted(retdic):
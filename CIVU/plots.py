@@ -0,0 +1,183 @@
+"""Contains the plotting functions of the package.
+
+Kept apart from the numerical functions of utils, so that matplotlib and
+seaborn are only imported when plots are rendered. Import this module inside
+the functions that plot.
+
+
+Created by Simos Kalfas
+    email:simos.kalfas@gmail.com
+    github: https://github.com/simoskalfas/
+"""
+import numpy as np
+from matplotlib import pyplot as plt
+import seaborn as sns
+import utils
+import itertools
+import os
+
+#Fixed salt for the element ids of svg plots, so that repeated (or parallel)
+#runs write identical files
+plt.rcParams['svg.hashsalt'] = 'CIVU'
+
+#Figures and palettes reused across plots, see figure_template and palette
+_figures = {}
+_palettes = {}
+
+
+def palette(n):
+    """Husl colour palette of n colours, made once per process.
+
+    Args:
+        n: Number of colours
+
+    Returns:
+        List of RGB colours
+    """
+    if n not in _palettes:
+        _palettes[n] = sns.color_palette('husl', n)
+    return _palettes[n]
+
+
+def figure_template(kind, n_axes):
+    """Returns a cleared figure with n_axes stacked axes, reused between plots.
+
+    Building a new figure for every plot costs more than drawing on it, so one
+    figure of each kind and shape is kept per process and cleared before use.
+
+    Args:
+        kind: Name of the kind of plot, e.g. 'atd'
+        n_axes: Number of axes stacked vertically
+
+    Returns:
+        fig: Figure
+        axes: List of the figure's axes, cleared
+    """
+    key = (kind, n_axes)
+    if key not in _figures:
+        fig = plt.figure()
+        axes = [fig.add_subplot(n_axes, 1, i) for i in range(1, n_axes + 1)]
+        _figures[key] = fig, axes
+    fig, axes = _figures[key]
+    for ax in axes:
+        ax.cla()
+    return fig, axes
+
+
+def save_figure(fig, path, formats=utils.PLOT_FORMATS):
+    """Saves a figure in each of the given formats.
+
+    Args:
+        fig: Figure
+        path: Path of the file without extension
+        formats(optional): List of extensions, e.g. ['png', 'svg']
+
+    Returns:
+        Nothing
+    """
+    for extension in formats:
+        fig.savefig(path + '.' + extension)
+
+
+def plot_things(x, ylists, filename, voltage, ident, title, ciu, 
+        formats=utils.PLOT_FORMATS):
+    """Vesatile plotting function.
+
+    Args:
+        x: Arrival time series
+        ylists: Curves to be plotted. Each nested list or array's contents 
+            will be plotted at a separate set of axes in the same figure. 
+                [[list1, list2, ...],[listn, listm, ...], ...]
+        filename: Name of data file without file extension
+        voltage: Voltage value to be used as label
+        ident: Identifier for result file names
+        formats(optional): Image formats to write, see save_figure
+
+    Returns:
+        Nothing
+    """
+    fig, axes = figure_template('atd', len(ylists))
+    plotdic = {}
+    for i in range(1, len(ylists) + 1):  #Make enough axes
+        colours = itertools.cycle(palette(len(ylists[i - 1])))
+        plotdic[str(i)] = axes[i - 1]
+        plotdic[str(i)].plot(x, ylists[i-1][-2], color='b', label='Sum', 
+                linewidth=1.8)
+        plotdic[str(i)].plot(x, ylists[i-1][-1], color='r', label='Trace', 
+                linewidth=1.8)
+        for j in range(len(ylists[i - 1])-2): #Plot each data list in its axes
+            plotdic[str(i)].plot(x, ylists[i-1][j], color='k', linewidth=0.5)
+            plotdic[str(i)].fill_between(x, 0, ylists[i-1][j], 
+                    color=colours.next(), label=str(j+1), alpha=0.5)
+        plotdic[str(i)].legend()
+        plotdic[str(i)].set_xlabel('Adjusted time (ms)')
+        plotdic[str(i)].set_ylabel('Normalised intensity')
+    if ciu==True:
+        fig.suptitle(title + ' ' + voltage)
+    else:
+        fig.suptitle(title + ' ' + voltage[:-1] + 'ms')  #Make plot directory 
+    script_dir = os.path.abspath(os.path.join(__file__, "../.."))
+    results_dir = os.path.join(script_dir, filename + ident + '/')
+    if not os.path.isdir(results_dir):
+        os.makedirs(results_dir)
+    save_figure(fig, results_dir + filename + '_' + str(voltage), formats)
+    return
+
+
+def indiv_area_plot(areas, filename, results_dir, title, voltage, 
+        formats=utils.PLOT_FORMATS):
+    colours = itertools.cycle(palette(len(areas)))
+    fig, axes = figure_template('areas', 1)
+    ax = axes[0]
+    ax.bar(np.linspace(1, len(areas), len(areas)), areas, 
+            color=[colours.next() for _ in range(len(areas))], width=0.3)
+    ax.legend()
+    ax.set_xlabel('Population')
+    ax.set_ylabel('Percentage area under the curve')
+    ax.set_xticks(np.linspace(1, len(areas), len(areas)))
+    fig.suptitle(title + ' population relative abundance')
+    save_figure(fig, results_dir + filename + '_' + str(voltage) + 
+            'individual areas', formats)
+    return
+
+
+def area_tracking_plot(areas, labels, results_dir, filename, res_filename, 
+        title, xticks, formats=utils.PLOT_FORMATS):
+    """Plots the area of each population over the voltages.
+
+    Args:
+        areas: Areas of the peaks of each ATD, see analyse.results
+        labels: Column labels of the dataset
+        results_dir: Results directory name
+        filename: File name of data file without file extension
+        res_filename: Identifier for result file names
+        title: Title of the plot
+        xticks: Ticks of the x-axis
+        formats(optional): Image formats to write, see save_figure
+
+    Returns:
+        Nothing
+    """
+    fig2 = plt.figure() #Make area under the curve figure
+    ax2 = fig2.add_subplot(1, 1, 1)
+    areas = np.array(areas)
+    areas = np.transpose(areas)
+    colours = itertools.cycle(sns.color_palette('husl', len(areas)))
+    for i in range(len(areas)):
+        ax2.plot(np.sort([int(sorted(labels)[j][:-1]) for j in range(
+                len(areas[i]))]), areas[i], color=colours.next(), label=i+1)
+    ax2.legend()
+    ax2.set_xlabel('Activation energy (V)')
+    ax2.set_ylabel('Percentage area under the curve')
+    ax2.set_xticks(xticks)
+    fig2.suptitle(title + ' population tracking')
+    save_figure(fig2, results_dir + filename + res_filename + '_areas', 
+            formats)
+
+
+def main():
+    return
+
+
+if __name__ == '__main__':
+    main()
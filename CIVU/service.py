@@ -0,0 +1,406 @@
+"""Resident fitting service with a local HTTP API.
+
+Keeps the fitting engine loaded between analyses, so that ATDs can be submitted
+as they are acquired without paying the start up cost of deconvolute.py every
+time. Requests are queued in a bounded queue and fitted by a pool of worker
+processes started with the service. Results are returned as the records of
+analyse.result_record, no files are written.
+
+API (JSON bodies):
+    POST /fit           Submits a request, see fit_request. Answers 202 with
+                        {'id', 'status'}, or with the finished job if the
+                        request has "wait": true. 503 if the queue is full.
+    GET /jobs/<id>      Job status and, once done, its 'results' or 'error'
+    GET /status         Queue length, workers and job counts
+
+Example:
+    python service.py -w 4
+    curl -d '{"arrival_time": [...], "intensities": [...], "mean_mode": "auto",
+        "wait": true}' http://127.0.0.1:8642/fit
+
+
+Created by Simos Kalfas
+    email:simos.kalfas@gmail.com
+    github: https://github.com/simoskalfas/
+"""
+
+import deconvolute
+import analyse
+import optimisation
+import smoother
+import utils
+import instrument
+import argparse
+import collections
+import itertools
+import json
+import math
+import multiprocessing
+import threading
+import time
+import urllib2
+import uuid
+import BaseHTTPServer
+import Queue
+import SocketServer
+
+#Fit options of a request and their defaults, see deconvolute.deconvolve
+OPTIONS = {'smooth': [], 'smooth_kernel': 'box', 'smooth_voltages': 0,
+        'mean_mode': 'der', 'cycles': 5, 'backend': 'stepwise',
+        'criterion': 'bic', 'warm_start': False, 'warm_tolerance': 1.05,
+        'global_fit': False, 'widths': 'shared', 'profile': False, 
+        'search': 'fixed', 'ensemble': 0, 'support': 0}
+
+#Number of finished jobs kept for GET /jobs/<id>
+KEEP_JOBS = 1000
+
+
+def request_settings(request):
+    """Checks the fit options of a request and fills in the defaults.
+
+    Args:
+        request: Dictionary of a request, see fit_request
+
+    Returns:
+        settings: Dictionary with every entry of OPTIONS
+    """
+    settings = dict(OPTIONS)
+    settings.update((k, request[k]) for k in OPTIONS if k in request)
+    mean_mode = settings['mean_mode']
+    if isinstance(mean_mode, list):
+        if not mean_mode:
+            raise ValueError('mean_mode cannot be an empty list')
+    elif mean_mode not in ['der', 'rel_max', 'auto']:
+        raise ValueError('Unknown mean_mode: ' + str(mean_mode))
+    for option, choices in [('backend', optimisation.BACKENDS),
+            ('criterion', optimisation.CRITERIA),
+            ('widths', optimisation.WIDTHS),
+            ('search', optimisation.SEARCHES),
+            ('smooth_kernel', smoother.KERNELS)]:
+        if settings[option] not in choices:
+            raise ValueError('Unknown ' + option + ': ' + 
+                    str(settings[option]))
+    settings['smooth'] = [int(i) for i in settings['smooth']]
+    if settings['smooth'] and len(settings['smooth']) < 2:
+        raise ValueError('smooth needs [number of repeats, window size]')
+    settings['cycles'] = int(settings['cycles'])
+    settings['ensemble'] = int(settings['ensemble'])
+    settings['support'] = float(settings['support'])
+    if settings['ensemble'] > 1 and settings['backend'] != 'stepwise':
+        raise ValueError('Ensemble fits need the stepwise backend')
+    if (settings['global_fit'] or settings['backend'] == 'batched') and \
+            (settings['search'] != 'fixed' or settings['support'] > 0):
+        raise ValueError('search and support cannot be set for global and '
+                'batched fits')
+    return settings
+
+
+def finite(value):
+    """True if value is neither infinite nor NaN."""
+    return not (math.isinf(value) or math.isnan(value))
+
+
+def request_atds(request):
+    """Reads the ATDs of a request.
+
+    Mean indices given as mean_mode are checked against the arrival times.
+
+    Args:
+        request: Dictionary of a request, see fit_request
+
+    Returns:
+        arrival_time: Arrival time series as list of float
+        voltages: Voltage labels in natural order
+        matrix: ATDs as lists of float, one per voltage
+    """
+    if 'arrival_time' not in request:
+        raise ValueError('The request has no arrival_time')
+    arrival_time = [float(i) for i in request['arrival_time']]
+    if not all(finite(i) for i in arrival_time):
+        raise ValueError('arrival_time has values that are not finite')
+    mean_mode = request.get('mean_mode')
+    if isinstance(mean_mode, list) and mean_mode and not isinstance(
+            mean_mode[0], float): #Indices, see utils.find_means
+        for i in mean_mode:
+            if (not isinstance(i, (int, long)) or isinstance(i, bool) or 
+                    not 0 <= i < len(arrival_time)):
+                raise ValueError('Mean ' + str(i) + ' is not an index of '
+                        'arrival_time')
+    if 'atds' in request:
+        atds = request['atds']
+    elif 'intensities' in request:
+        atds = {request.get('voltage', 'atd'): request['intensities']}
+    else:
+        raise ValueError('The request has neither atds nor intensities')
+    voltages = sorted(atds, key=utils.natural_keys)
+    matrix = [[float(i) for i in atds[voltage]] for voltage in voltages]
+    for voltage, intensities in zip(voltages, matrix):
+        if len(intensities) != len(arrival_time):
+            raise ValueError('ATD ' + voltage + ' does not have as many points'
+                    ' as arrival_time')
+        if not all(finite(i) for i in intensities):
+            raise ValueError('ATD ' + voltage + ' has values that are not '
+                    'finite')
+        if max(intensities) <= 0:
+            raise ValueError('ATD ' + voltage + ' has no positive intensity')
+    return arrival_time, voltages, matrix
+
+
+def fit_request(request):
+    """Fits the ATDs of a request.
+
+    Kept at module level so that it can be sent to worker processes.
+
+    Args:
+        request: Dictionary with
+            'arrival_time': Arrival time series
+            'intensities': A single ATD, labelled by 'voltage' (optional) or
+            'atds': Dataset as {voltage: ATD}
+            'name'(optional): Label of the records, as the data file name
+            and any of the fit options in OPTIONS, e.g. 'mean_mode'
+
+    Returns:
+        records: One record per voltage in voltage order, see
+            analyse.result_record
+    """
+    settings = request_settings(request)
+    arrival_time, voltages, matrix = request_atds(request)
+    if settings['smooth'] or settings['smooth_voltages'] > 1:
+        matrix = smoother.smooth_matrix(matrix, settings['smooth'],
+                settings['smooth_kernel'], 
+                settings['smooth_voltages']).tolist()
+        settings['smooth'] = [] #Already smoothed
+    jobs = [(voltage, intensities, arrival_time, settings, None) for
+            voltage, intensities in zip(voltages, matrix)]
+    if settings['global_fit']:
+        fits = deconvolute.global_fits(jobs)
+    elif settings['warm_start']:
+        fits = deconvolute.warm_start_fits(jobs)
+    elif settings['ensemble'] > 1: #Chains run in turn within the worker
+        fits = deconvolute.ensemble_fits(jobs)
+    else:
+        fits = itertools.imap(deconvolute.fit_voltage, jobs)
+    name = request.get('name', '')
+    records = []
+    for fit in fits:
+        record = analyse.result_record(name, fit, arrival_time)
+        if settings['profile']:
+            record['events'] = fit['events']
+        records.append(record)
+    return records
+
+
+class Service(object):
+    """Queue, worker pool and job table of the fitting service.
+
+    Each of the workers threads takes requests from the queue and fits them in
+    the process pool, so at most workers requests are fitted at a time and at
+    most queue_size wait.
+    """
+
+    def __init__(self, workers=1, queue_size=16):
+        self.workers = workers
+        self.queue = Queue.Queue(queue_size)
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        #Started before any thread, so that the processes fork cleanly
+        self.pool = multiprocessing.Pool(workers)
+        for _ in range(workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, request):
+        """Queues a request.
+
+        The settings and ATDs are checked before the request is queued, so 
+        bad requests raise ValueError (TypeError or KeyError for values of 
+        the wrong type) here rather than failing in a worker.
+
+        Args:
+            request: Dictionary of a request, see fit_request
+
+        Returns:
+            job: Dictionary of the job, see job_view. None if the queue is 
+                full.
+        """
+        request_settings(request) #Bad requests are refused straight away
+        request_atds(request)
+        job = {'id': uuid.uuid4().hex, 'status': 'queued',
+                'submitted': time.time(), 'done': threading.Event()}
+        with self.lock:
+            try:
+                self.queue.put_nowait((job, request))
+            except Queue.Full:
+                return None
+            self.jobs[job['id']] = job
+            finished = [i for i in self.jobs if self.jobs[i]['done'].is_set()]
+            for i in finished[:max(0, len(finished) - KEEP_JOBS)]:
+                del self.jobs[i]
+        return job
+
+    def work(self):
+        """Fits queued requests in the process pool, runs in a thread."""
+        while True:
+            job, request = self.queue.get()
+            job['status'] = 'running'
+            job['started'] = time.time()
+            try:
+                job['results'] = self.pool.apply(fit_request, (request,))
+                job['status'] = 'done'
+            except Exception as e:
+                job['error'] = type(e).__name__ + ': ' + str(e)
+                job['status'] = 'failed'
+            job['finished'] = time.time()
+            instrument.log('Job', job['id'], job['status'],
+                    job['finished'] - job['started'])
+            job['done'].set()
+
+    def job(self, job_id):
+        """Finds a job by id, None if unknown."""
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def status(self):
+        """Summary of the service for GET /status."""
+        with self.lock:
+            counts = collections.Counter(i['status'] for i in
+                    self.jobs.values())
+        return {'workers': self.workers, 'queued': self.queue.qsize(),
+                'queue_size': self.queue.maxsize, 'jobs': dict(counts)}
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+def job_view(job):
+    """The JSON-serialisable part of a job.
+
+    Args:
+        job: Dictionary of a job, see Service.submit
+
+    Returns:
+        Dictionary with 'id', 'status', 'submitted' and, as available,
+        'started', 'finished', 'results' and 'error'
+    """
+    return dict((k, v) for k, v in job.items() if k != 'done')
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers the HTTP requests of the API, see the module documentation."""
+
+    def send_json(self, code, body):
+        text = json.dumps(body, sort_keys=True)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/status':
+            return self.send_json(200, service.status())
+        if self.path.startswith('/jobs/'):
+            job = service.job(self.path[len('/jobs/'):])
+            if job is not None:
+                return self.send_json(200, job_view(job))
+        self.send_json(404, {'error': 'Not found: ' + self.path})
+
+    def do_POST(self):
+        if self.path != '/fit':
+            return self.send_json(404, {'error': 'Not found: ' + self.path})
+        try:
+            length = int(self.headers.getheader('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            if not isinstance(request, dict):
+                raise ValueError('The request has to be a JSON object')
+            job = self.server.service.submit(request)
+        except (ValueError, TypeError, KeyError) as e: #Malformed request
+            return self.send_json(400, {'error': type(e).__name__ + ': ' + 
+                    str(e)})
+        if job is None:
+            return self.send_json(503, {'error': 'The queue is full'})
+        if request.get('wait'):
+            job['done'].wait()
+            return self.send_json(200, job_view(job))
+        self.send_json(202, {'id': job['id'], 'status': job['status']})
+
+    def log_message(self, format, *args):
+        instrument.log(self.address_string(), format % args)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server answering each connection in its own thread."""
+    daemon_threads = True
+
+
+def serve(host='127.0.0.1', port=8642, workers=1, queue_size=16):
+    """Runs the fitting service until interrupted.
+
+    Args:
+        host(optional): Address to listen on. Default is localhost only.
+        port(optional): Port to listen on
+        workers(optional): Number of processes fitting requests
+        queue_size(optional): Number of requests that can wait to be fitted
+
+    Returns:
+        Nothing
+    """
+    service = Service(workers, queue_size)
+    server = Server((host, port), Handler)
+    server.service = service
+    instrument.log('Serving on', host + ':' + str(server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+def submit(request, url='http://127.0.0.1:8642', timeout=None):
+    """Fits a request with a running service and waits for the results.
+
+    Args:
+        request: Dictionary of a request, see fit_request
+        url(optional): Address of the service
+        timeout(optional): Seconds to wait for the answer
+
+    Returns:
+        records: Same as fit_request
+    """
+    request = dict(request, wait=True)
+    try:
+        answer = urllib2.urlopen(url + '/fit', json.dumps(request), timeout)
+        job = json.loads(answer.read())
+    except urllib2.HTTPError as e:
+        raise RuntimeError('Service refused the request: ' + e.read())
+    if job['status'] != 'done':
+        raise RuntimeError('Fit failed: ' + job.get('error', job['status']))
+    return job['results']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Resident fitting service
+        with a local HTTP API.""")
+    parser.add_argument('--host', default='127.0.0.1', type=str, metavar='',
+        help="""Address to listen on. Default is 127.0.0.1, local only.""")
+    parser.add_argument('--port', default=8642, type=int, metavar='',
+        help="""Port to listen on. Default is 8642.""")
+    parser.add_argument('-w', '--workers', default=1, type=int, metavar='',
+        help="""Number of processes fitting requests. Default is 1.""")
+    parser.add_argument('-q', '--queue-size', default=16, type=int,
+        metavar='', help="""Number of requests that can wait to be fitted.
+        Further requests are refused until there is room. Default is 16.""")
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help="""Include to print requests and finished jobs.""")
+    args = parser.parse_args()
+    instrument.set_verbose(args.verbose)
+    serve(args.host, args.port, args.workers, args.queue_size)
+
+
+if __name__ == '__main__':
+    main()
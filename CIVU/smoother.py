@@ -1,4 +1,8 @@
-"""Contains functions used for moving average smoothing.
+"""Contains functions used for smoothing.
+
+The ATDs of a whole heatmap are smoothed at once by smooth_matrix, with a
+moving average (box), Savitzky-Golay or Gaussian kernel, and optionally
+across neighbouring voltages as well.
 
 
 Created by Simos Kalfas and Charlie Eldrid
@@ -7,6 +11,11 @@ Created by Simos Kalfas and Charlie Eldrid
 """
 
 import numpy as np
+from scipy import ndimage
+from scipy.signal import savgol_filter
+
+#Smoothing kernels of smooth_matrix
+KERNELS = ['box', 'savgol', 'gaussian']
 
 
 def movingaverage(interval, window_size):
@@ -23,31 +32,106 @@ def movingaverage(interval, window_size):
     return np.convolve(interval, window, 'same')
 
 
-def smooth(intensity, mode):
-    """Loops and averages the sequential smoothing.
+def box_passes(repeats):
+    """Number of moving average passes for a number of repeats.
+
+    Counted as in earlier versions of smooth, so that results stay the same:
+    1 or 2 repeats give one pass, more repeats give two passes.
+
+    Args:
+        repeats: Number of repeats of the smoothing mode
+
+    Returns:
+        Number of passes
+    """
+    if repeats <= 2:
+        return 1
+    return 2
+
+
+def box_kernel(window, passes):
+    """Collapses repeated moving averages into one equivalent kernel.
+
+    Args:
+        window: Size of the moving average window
+        passes: Number of moving average passes
+
+    Returns:
+        kernel: Array of length passes * (window - 1) + 1
+        origin: Origin of the kernel for ndimage.convolve1d, so that it is
+            centred like repeated np.convolve 'same' passes
+    """
+    box = np.ones(int(window)) / float(window)
+    kernel = np.array([1.0])
+    for _ in range(passes):
+        kernel = np.convolve(kernel, box)
+    origin = passes * ((int(window) - 1) // 2) - len(kernel) // 2
+    return kernel, origin
+
+
+def smooth_matrix(matrix, mode, kernel='box', voltage_window=0):
+    """Smooths all ATDs of a heatmap in one vectorised call.
+
+    The meaning of mode depends on the kernel:
+        'box': [repeats, window], moving averages of the window size, repeated
+            as in box_passes and collapsed into one kernel. Away from the ends
+            of the ATD (by repeats * window bins) this is the same as the
+            repeated moving average.
+        'savgol': [polynomial order, window], Savitzky-Golay filter. An even
+            window is widened by one bin.
+        'gaussian': [repeats, sd], Gaussian kernel with a standard deviation
+            of sd bins, repeated; collapsed into one Gaussian of sd *
+            sqrt(repeats).
+
+    Args:
+        matrix: ATDs, array-like of shape [voltages, drift bins]
+        mode: Smoothing mode, see above. If empty, only the voltage smoothing
+            is applied.
+        kernel(optional): 'box' (default), 'savgol' or 'gaussian'
+        voltage_window(optional): If more than 1, every ATD is also averaged
+            with its neighbours over a moving window of this many voltages.
+            The first and last ATDs are repeated at the ends.
+
+    Returns:
+        Smoothed matrix as an array of the same shape
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    if mode:
+        number, window = mode[0], mode[1]
+        if kernel == 'box':
+            weights, origin = box_kernel(window, box_passes(number))
+            matrix = ndimage.convolve1d(matrix, weights, axis=-1,
+                    mode='constant', origin=origin)
+        elif kernel == 'savgol':
+            window = int(window) // 2 * 2 + 1
+            matrix = savgol_filter(matrix, window, int(number), axis=-1)
+        elif kernel == 'gaussian':
+            matrix = ndimage.gaussian_filter1d(matrix, window *
+                    np.sqrt(max(number, 1)), axis=-1, mode='constant')
+        else:
+            raise ValueError('Unknown smoothing kernel: ' + str(kernel))
+    if voltage_window > 1 and matrix.ndim == 2:
+        matrix = ndimage.uniform_filter1d(matrix, int(voltage_window), axis=0,
+                mode='nearest')
+    return matrix
+
+
+def smooth(intensity, mode, kernel='box'):
+    """Smooths a single ATD, see smooth_matrix.
 
     Args:
         intensity: Arrival time series.
-        mode: Number of repeats and window size. If empty, returns the given 
+        mode: Number of repeats and window size. If empty, returns the given
             list.
-                [number, window] 
+                [number, window]
+        kernel(optional): Smoothing kernel, see smooth_matrix
+
+    Returns:
+        Smoothed ATD as an array
     """
     if not mode:
         return intensity
-    intensity_output = []
-    intensity_smooth = []
-    mean_smooth_counter = mode[0]
-    while mean_smooth_counter >= 1:
-        window_smooth = mode[1]
-        if len(intensity_output) == 0:
-            intensity_array = np.array(intensity)
-            intensity_smooth = movingaverage(intensity_array, window_smooth)
-            mean_smooth_counter = mean_smooth_counter - 1
-            intensity_output = intensity_smooth
-        else:
-            intensity_smooth = movingaverage(intensity_output, window_smooth)
-        mean_smooth_counter = mean_smooth_counter - 1
-    return intensity_smooth
+    return smooth_matrix(intensity, mode, kernel)
 
 
 def main():
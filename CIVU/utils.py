@@ -1,5 +1,8 @@
 """Contains general utility functions used by the rest of the package.
 
+Only the numerical functions are kept here, so that fitting does not load the
+plotting libraries. The plotting functions are in plots.
+
 
 Created by Simos Kalfas
     email:simos.kalfas@gmail.com
@@ -7,15 +10,18 @@ Created by Simos Kalfas
 """
 import numpy as np
 import numpy.ma as ma
-from matplotlib import pyplot as plt
 from scipy.signal import argrelmin, argrelmax
 from scipy.integrate import trapz
-import seaborn as sns
-import itertools
-import os
 import math
 import re
 
+#Image formats written by the plotting functions, see plots.save_figure
+PLOT_FORMATS = ['png', 'svg']
+
+#Half width of the support of truncated peaks in standard deviations, see 
+#peak_support. Beyond it a peak is below exp(-k**2 / 2) of its height, 1.3e-14
+#for 8.
+SUPPORT_SDS = 8
 
 
 def rmsd(predicted, actual):
@@ -43,12 +49,83 @@ def gaussian(x, a, b, s):
         s: Standard deviation 
 
     Returns:
-        y: Gaussian peak
+        y: Gaussian peak as an array
+    """
+    x = np.asarray(x, dtype=float)
+    return a * np.exp(-((x - b) ** 2) / (2 * (s ** 2)))
+
+
+def peak_support(x, mean, sd, k=SUPPORT_SDS):
+    """Finds the arrival times within k standard deviations of a mean.
+
+    Args:
+        x: Arrival time series as an array, in ascending order
+        mean: Mean of the peak
+        sd: Standard deviation of the peak
+        k(optional): Half width of the support in standard deviations
+
+    Returns:
+        start, end: Index range of the support in x
+    """
+    start = np.searchsorted(x, mean - k * sd, 'left')
+    end = np.searchsorted(x, mean + k * sd, 'right')
+    return int(start), int(end)
+
+
+def add_gaussian(curve, x, a, b, s, k=SUPPORT_SDS):
+    """Adds a Gaussian peak to a curve, evaluated only within its support.
+
+    The cost depends on the width of the peak rather than the length of x, 
+    and the result differs from adding the full peak by less than 
+    a * exp(-k**2 / 2) at any arrival time.
+
+    Args:
+        curve: Array of length len(x), updated in place
+        x: Arrival time series as an array, in ascending order
+        a: Height
+        b: Mean
+        s: Standard deviation
+        k(optional): Half width of the support in standard deviations, see 
+            peak_support
+
+    Returns:
+        curve
+    """
+    start, end = peak_support(x, b, s, k)
+    curve[start:end] += gaussian(x[start:end], a, b, s)
+    return curve
+
+
+def gaussians(x, parameters):
+    """Evaluates a set of Gaussian peaks over the arrival time series at once.
+
+    Args:
+        x: Arrival time series
+        parameters: Parameters of the peaks, array-like of shape [n_peaks, 3]
+            [[height1, mean1, sd1], ...]
+
+    Returns:
+        curves: Array of shape [n_peaks, len(x)] with one peak per row
+    """
+    x = np.asarray(x, dtype=float)
+    parameters = np.asarray(parameters, dtype=float).reshape(-1, 3)
+    heights = parameters[:, 0:1]
+    means = parameters[:, 1:2]
+    sds = parameters[:, 2:3]
+    return heights * np.exp(-((x - means) ** 2) / (2 * (sds ** 2)))
+
+
+def mixture(x, parameters):
+    """Sums a set of Gaussian peaks over the arrival time series.
+
+    Args:
+        x: Arrival time series
+        parameters: Parameters of the peaks [[height1, mean1, sd1], ...]
+
+    Returns:
+        Sum of the peaks as an array of length len(x)
     """
-    y = []
-    for i in x:
-        y.append(a * np.exp(-((i - b) ** 2) / (2 * (s ** 2))))  
-    return y
+    return gaussians(x, parameters).sum(axis=0)
 
 
 def mask_a(array, intervals):
@@ -70,51 +147,6 @@ def mask_a(array, intervals):
     return mar
 
 
-def plot_things(x, ylists, filename, voltage, ident, title, ciu):
-    """Vesatile plotting function.
-
-    Args:
-        x: Arrival time series
-        ylists: Lists to be plotted. Each nested list's contents will be plotted 
-            at a separate set of axes in the same figure. 
-                [[list1, list2, ...],[listn, listm, ...], ...]
-        filename: Name of data file without file extension
-        voltage: Voltage value to be used as label
-        ident: Identifier for result file names
-
-    Returns:
-        Nothing
-    """
-    plt.close('all')
-    fig = plt.figure()
-    plotdic = {}
-    for i in range(1, len(ylists) + 1):  #Make enough axes
-        colours = itertools.cycle(sns.color_palette('husl', len(ylists[i - 1])))
-        plotdic[str(i)] = fig.add_subplot(len(ylists), 1, i)
-        plotdic[str(i)].plot(x, ylists[i-1][-2], color='b', label='Sum', 
-                linewidth=1.8)
-        plotdic[str(i)].plot(x, ylists[i-1][-1], color='r', label='Trace', 
-                linewidth=1.8)
-        for j in range(len(ylists[i - 1])-2): #Plot each data list in their axes
-            plotdic[str(i)].plot(x, ylists[i-1][j], color='k', linewidth=0.5)
-            plotdic[str(i)].fill_between(x, 0, ylists[i-1][j], 
-                    color=colours.next(), label=str(j+1), alpha=0.5)
-        plotdic[str(i)].legend()
-        plotdic[str(i)].set_xlabel('Adjusted time (ms)')
-        plotdic[str(i)].set_ylabel('Normalised intensity')
-    if ciu==True:
-        fig.suptitle(title + ' ' + voltage)
-    else:
-        fig.suptitle(title + ' ' + voltage[:-1] + 'ms')  #Make plot directory 
-    script_dir = os.path.abspath(os.path.join(__file__, "../.."))
-    results_dir = os.path.join(script_dir, filename + ident + '/')
-    if not os.path.isdir(results_dir):
-        os.makedirs(results_dir)
-    fig.savefig(results_dir + filename + '_' + str(voltage) + '.png') 
-    fig.savefig(results_dir + filename + '_' + str(voltage) + '.svg') 
-    return
-
-
 def fwhm(sd):
     """Calculates full width half maximum of a normal distribution.
 
@@ -204,20 +236,6 @@ def natural_keys(text):
     '''
     return [ atoi(c) for c in re.split('(\d+)', text) ]
 
-def indiv_area_plot(areas, filename, results_dir, title, voltage):
-    colours = itertools.cycle(sns.color_palette('husl', len(areas)))
-    fig = plt.figure()
-    ax = fig.add_subplot(1,1,1)
-    ax.bar(np.linspace(1, len(areas), len(areas)), areas, color=[colours.next() for _ in range(len(areas))], width=0.3)
-    ax.legend()
-    ax.set_xlabel('Population')
-    ax.set_ylabel('Percentage area under the curve')
-    ax.set_xticks(np.linspace(1, len(areas), len(areas)))
-    fig.suptitle(title + ' population relative abundance')
-    fig.savefig(results_dir + filename + '_' + str(voltage) + 'individual areas' + '.png') 
-    fig.savefig(results_dir + filename + '_' + str(voltage) + 'individual areas' + '.svg')
-    return
-
 def main():
     return
 
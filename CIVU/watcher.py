@@ -0,0 +1,300 @@
+"""Live deconvolution of data files while they are acquired.
+
+Watches a folder for data files and follows them as the instrument exports
+them: new files, and voltages added to files already seen, are parsed (only the
+new columns) and sent to a pool of worker processes to be fitted. Every voltage
+is written out as soon as its fit is done, and the population tracking plot and
+error log are updated with it, so the results follow the CIU ramp instead of
+waiting for its end.
+
+A file is only read once its size and modification time have not changed
+between two polls, so that files still being written are not parsed.
+
+
+Created by Simos Kalfas
+    email:simos.kalfas@gmail.com
+    github: https://github.com/simoskalfas/
+"""
+
+import deconvolute
+import parse
+import analyse
+import optimisation
+import smoother
+import utils
+import instrument
+import fitcache
+import argparse
+import glob
+import multiprocessing
+import os
+import re
+import time
+
+
+def new_state(path, label):
+    """Makes the record of a watched data file.
+
+    Args:
+        path: Path of the data file
+        label: Identifier for result file names
+
+    Returns:
+        state: Dictionary
+            {'path', 'name', 'results_dir', 'stamp', 'seen', 'arrival_time',
+            'fits', 'pending', 'failed'}
+            stamp is the (size, modification time) last read and seen the one
+            of the last poll. fits holds the finished fits and pending the
+            fits still running, by voltage.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    script_dir = os.path.abspath(os.path.join(__file__, "../.."))
+    return {'path': path, 'name': name,
+            'results_dir': os.path.join(script_dir, name + label + '/'),
+            'stamp': None, 'seen': None, 'arrival_time': None, 'fits': {},
+            'pending': {}, 'failed': {}}
+
+
+def scan(directory, pattern):
+    """Stamps of the data files in a folder.
+
+    Args:
+        directory: Folder of the data files
+        pattern: Glob pattern of the data files, e.g. '*.txt'
+
+    Returns:
+        Dictionary {path: (size, modification time)}
+    """
+    stamps = {}
+    for path in glob.glob(os.path.join(directory, pattern)):
+        try:
+            source = os.stat(path)
+        except OSError: #Removed since the glob
+            continue
+        stamps[path] = (source.st_size, source.st_mtime)
+    return stamps
+
+
+def read_update(state):
+    """Parses the voltages of a data file that were not read before.
+
+    If the arrival times have changed, the file was rewritten with a different
+    drift range, and all its voltages are read and fitted again.
+
+    Args:
+        state: Record of the data file, see new_state
+
+    Returns:
+        Voltage labels and ATDs (as lists) of the new voltages
+    """
+    known = set(state['fits']) | set(state['pending']) | set(state['failed'])
+    voltages, arrival_time, matrix = parse.read_new_columns(state['path'],
+            known)
+    arrival_time = arrival_time.tolist()
+    if state['arrival_time'] is not None and \
+            arrival_time != state['arrival_time']:
+        instrument.log(state['name'], 'arrival times changed, refitting')
+        state['fits'] = {}
+        state['pending'] = {}
+        state['failed'] = {}
+        voltages, arrival_time, matrix = parse.read_new_columns(
+                state['path'])
+        arrival_time = arrival_time.tolist()
+    state['arrival_time'] = arrival_time
+    return voltages, matrix.tolist()
+
+
+def write_fit(state, fit, settings):
+    """Writes out the fit of one voltage as soon as it is done.
+
+    Appends the record of the fit to the results file, plots the ATD and
+    updates the error log and population tracking plot with every voltage
+    fitted so far.
+
+    Args:
+        state: Record of the data file, see new_state
+        fit: Results of deconvolute.fit_voltage
+        settings: Dictionary of watch settings, see watch
+
+    Returns:
+        Nothing
+    """
+    name = state['name']
+    results_dir = state['results_dir']
+    label = settings['label']
+    formats = settings['plot_formats']
+    with open(results_dir + name + label + '_results.jsonl', 'a') as r:
+        analyse.write_result(r, name, fit, state['arrival_time'])
+    if formats:
+        deconvolute.render_plot(('atd', (state['arrival_time'],
+            [fit['gausslist'][fit['erind']]], name, fit['voltage'], label,
+            name, settings['ciu'], formats)))
+    voltages = sorted(state['fits'], key=utils.natural_keys)
+    with open(results_dir + name + label + '_errorlog_' +
+            str(settings['cycles']) + '.txt', 'w') as f:
+        for voltage in voltages:
+            f.write(voltage + '\t' + str(state['fits'][voltage]['min_error'])
+                    + '\n')
+        f.write('\nAverage error: ')
+        analyse.results(f, [state['fits'][i]['min_error'] for i in voltages],
+                [state['fits'][i]['areas'] for i in voltages],
+                [state['fits'][i]['fwhms'] for i in voltages],
+                voltages + [name], results_dir, name, label, name, [],
+                formats)
+
+
+def watch(directory, label, settings, pattern='*.txt', workers=1,
+        interval=1.0, idle=0):
+    """Follows the data files of a folder and fits their voltages as they come.
+
+    Args:
+        directory: Folder of the data files
+        label: Identifier for result file names
+        settings: Dictionary of fit settings, see deconvolute.fit_voltage,
+            with also 'plot_formats' and 'ciu' of deconvolute.deconvolve
+        pattern(optional): Glob pattern of the data files
+        workers(optional): Number of processes fitting ATDs
+        interval(optional): Seconds between polls of the folder
+        idle(optional): If more than 0, stop once nothing has changed and no
+            fit has been running for this many seconds. Otherwise watch until
+            interrupted.
+
+    Returns:
+        fits: Dictionary of finished fits {file name: {voltage: fit}}
+    """
+    settings = dict(settings, label=label)
+    pool = multiprocessing.Pool(workers)
+    states = {}
+    last_change = time.time()
+    try:
+        while True:
+            for path, stamp in sorted(scan(directory, pattern).items()):
+                if path not in states:
+                    states[path] = new_state(path, label)
+                state = states[path]
+                if stamp == state['stamp']: #Already read
+                    continue
+                if stamp != state['seen']: #Still being written, wait a poll
+                    state['seen'] = stamp
+                    last_change = time.time()
+                    continue
+                try:
+                    voltages, matrix = read_update(state)
+                except (IOError, ValueError, IndexError) as e:
+                    instrument.log(state['name'], 'cannot be read yet:', e)
+                    state['seen'] = None #Try again
+                    continue
+                state['stamp'] = stamp
+                last_change = time.time()
+                if not os.path.isdir(state['results_dir']):
+                    os.makedirs(state['results_dir'])
+                if not state['fits'] and not state['pending']: #New results
+                    open(state['results_dir'] + state['name'] + label +
+                            '_results.jsonl', 'w').close()
+                for voltage, intensities in zip(voltages, matrix):
+                    instrument.log(state['name'], voltage, 'queued')
+                    state['pending'][voltage] = pool.apply_async(
+                            deconvolute.fit_voltage, ((voltage, intensities,
+                            state['arrival_time'], settings, None),))
+            for state in states.values():
+                for voltage in sorted(state['pending'],
+                        key=utils.natural_keys):
+                    result = state['pending'][voltage]
+                    if not result.ready():
+                        continue
+                    del state['pending'][voltage]
+                    last_change = time.time()
+                    try:
+                        fit = result.get()
+                    except Exception as e:
+                        #One bad ATD should not stop the watch
+                        state['failed'][voltage] = type(e).__name__ + ': ' + \
+                                str(e)
+                        instrument.log(state['name'], voltage, 'failed:', e)
+                        continue
+                    state['fits'][voltage] = fit
+                    instrument.log(state['name'], voltage, 'fitted, error',
+                            fit['min_error'])
+                    write_fit(state, fit, settings)
+            running = any(state['pending'] for state in states.values())
+            if idle > 0 and not running and time.time() - last_change > idle:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.terminate()
+        pool.join()
+    if settings.get('cache'):
+        fitcache.evict(settings['cache'])
+    return dict((state['name'], state['fits']) for state in states.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Live deconvolution of the
+        data files in a folder while they are acquired.""")
+    parser.add_argument('directory_label', type=str, help="""Label for the
+        results directories, created a level above the script.""")
+    parser.add_argument('-d', '--directory', default='../Data/', type=str,
+        metavar='', help="""Folder to watch. Default is the Data folder.""")
+    parser.add_argument('-g', '--glob', default='*.txt', type=str, metavar='',
+        help="""Pattern of the data files. Default is '*.txt'.""")
+    parser.add_argument('-n', '--means', default='der', type=str, metavar='',
+        help="""Mode of mean determination, see deconvolute.py. Default is
+        'der'.""")
+    parser.add_argument('-s', '--smooth', default='', type=str, metavar='',
+        help="""Smoothing as [number of repeats, window size]. No smoothing if
+        left empty.""")
+    parser.add_argument('-k', '--kernel', default='box',
+        choices=smoother.KERNELS, metavar='', help="""Smoothing kernel, see
+        deconvolute.py. Default is 'box'.""")
+    parser.add_argument('-r', '--repeats', default=5, type=int, metavar='',
+        help="""Number of recursions (depth of analysis). Default is 5.""")
+    parser.add_argument('-b', '--backend', default='stepwise',
+        choices=optimisation.BACKENDS, metavar='',
+        help="""Fitting engine, see deconvolute.py. Default is 'stepwise'.""")
+    parser.add_argument('--search', default='fixed',
+        choices=optimisation.SEARCHES, metavar='', help="""Parameter search
+        of the stepwise optimiser, see deconvolute.py. Default is
+        'fixed'.""")
+    parser.add_argument('--support', default=0, type=float, metavar='',
+        help="""Support of the peaks in standard deviations, see
+        deconvolute.py. Default is 0, the whole series.""")
+    parser.add_argument('--criterion', default='bic',
+        choices=optimisation.CRITERIA, metavar='', help="""Information
+        criterion of the 'auto' mean mode. Default is 'bic'.""")
+    parser.add_argument('-c', '--not_ciu', action='store_true',
+        help="""Include if data is not CIU.""")
+    parser.add_argument('--fit-cache', action='store_true',
+        help="""Include to reuse fits from the fit cache, see
+        deconvolute.py.""")
+    parser.add_argument('--no-plots', action='store_true',
+        help="""Include to skip all plots.""")
+    parser.add_argument('-w', '--workers', default=1, type=int, metavar='',
+        help="""Number of processes fitting ATDs. Default is 1.""")
+    parser.add_argument('-i', '--interval', default=1.0, type=float,
+        metavar='', help="""Seconds between polls of the folder. Default is
+        1.""")
+    parser.add_argument('--idle', default=0, type=float, metavar='',
+        help="""Stop after this many seconds without changes. Default is 0,
+        watch until interrupted.""")
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help="""Include to print progress messages.""")
+    args = parser.parse_args()
+    instrument.set_verbose(args.verbose)
+    settings = {'smooth': [int(i) for i in re.findall(r'\d+', args.smooth)],
+            'smooth_kernel': args.kernel,
+            'mean_mode': deconvolute.parse_means(args.means),
+            'criterion': args.criterion, 'cycles': args.repeats,
+            'search': args.search, 'ensemble': 0, 'support': args.support,
+            'backend': args.backend, 'warm_tolerance': 1.05, 'profile': False,
+            'cache': fitcache.CACHE_DIR if args.fit_cache else None,
+            'ciu': not args.not_ciu,
+            'plot_formats': [] if args.no_plots else utils.PLOT_FORMATS}
+    watch(args.directory, args.directory_label, settings, args.glob,
+            args.workers, args.interval, args.idle)
+    return
+
+
+if __name__ == '__main__':
+    main()